@@ -0,0 +1,182 @@
+import os
+import time
+import uuid
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from loguru import logger
+import apichat
+from apichat import ResponseAborted
+from ratelimit import estimate_tokens
+
+
+STAGES = ["names", "aggregation", "name_translation", "body", "titles"]
+# Shared by the worker processes of a run, which inherit the environment
+RUN_ENV = "EPUBTRANSLATOR_RUN"
+_scope = threading.local()
+
+
+def current_run():
+    """Id of this run, the same in every process it started."""
+    if RUN_ENV not in os.environ:
+        os.environ[RUN_ENV] = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    return os.environ[RUN_ENV]
+
+
+@contextmanager
+def usage_scope(stage=None, chapter=None):
+    """Attribute the calls of the chat apps created in this block, in this thread, to a stage and chapter."""
+    previous = getattr(_scope, "value", None)
+    _scope.value = (stage or (previous or (None, None))[0], chapter)
+    try:
+        yield
+    finally:
+        _scope.value = previous
+
+
+def cost(price, prompt_tokens, completion_tokens):
+    """Cost of a call from the `price` of a translation config entry, [input, output] per million tokens."""
+    if not price:
+        return None
+    return (price[0] * prompt_tokens + price[1] * completion_tokens) / 1e6
+
+
+class UsageLedger:
+    """
+    Tokens and cost of every provider call, in an SQLite file next to the caches of the book.
+
+    A call is counted with the usage the provider reported (OpenAI, Claude), otherwise with the
+    `estimate_tokens` approximation of its prompt and response (Gemini, Poe, streamed responses).
+    Rows carry the run, stage and chapter, so a report can be broken down by any of them. Dry runs
+    record what each request would have cost instead, and calls answered from a cassette are recorded
+    as replays at no cost.
+
+    Args:
+        path (str): Ledger file, usually output/[book]/usage.db
+        book (str): Book the calls are made for
+        stage (str): Stage of the calls made outside of a `usage_scope`, one of STAGES
+    """
+
+    def __init__(self, path, book=None, stage=None):
+        self.path = path
+        self.book = book
+        self.stage = stage
+        self.run = current_run()
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        # Connections are neither shared between threads nor inherited by forked workers
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage (run TEXT, book TEXT, stage TEXT, chapter TEXT, provider TEXT, "
+                "model TEXT, kind TEXT, prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL, "
+                "latency REAL, error TEXT, created REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS usage_run ON usage (run)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def scope(self):
+        """Stage and chapter of the calls made in this thread now."""
+        stage, chapter = getattr(_scope, "value", None) or (None, None)
+        return stage or self.stage, chapter
+
+    def _insert(self, scope, provider, model, kind, prompt_tokens, completion_tokens, price, latency, error):
+        stage, chapter = scope or self.scope()
+        with self.conn as conn:
+            conn.execute(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.run, self.book, stage, chapter, provider, model, kind, prompt_tokens, completion_tokens,
+                 cost(price, prompt_tokens, completion_tokens), latency, error, time.time())
+            )
+
+    def record(self, app, latency, prompt_tokens, error=None):
+        """
+        Record a call of a chat app.
+
+        Args:
+            app (APIChatApp): App after the call
+            latency (float): Seconds the call took
+            prompt_tokens (int): Estimated prompt tokens, counted if the call failed after generating
+            error (APITranslationFailure): Error the call raised, None if it succeeded
+        """
+        if error is None:
+            usage = app.usage or {}
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+            kind = "reported" if app.reported_usage is not None else "estimated"
+        elif isinstance(error, ResponseAborted):
+            # Generated until it was aborted, so billed
+            completion_tokens = estimate_tokens(error.partial)
+            kind = "estimated"
+        else:
+            prompt_tokens, completion_tokens = 0, 0
+            kind = "failed"
+        price = app.price
+        if apichat.cassette is not None and apichat.cassette.mode == "replay":
+            # Answered from the recording, no provider was called
+            kind = "failed" if kind == "failed" else "replay"
+            price = (0, 0)
+        self._insert(app.scope, app.provider or type(app).__name__, app.model_name, kind, prompt_tokens,
+                     completion_tokens, price, latency, None if error is None else str(error)[:200])
+
+    def estimate(self, provider, model, prompt_tokens, completion_tokens):
+        """Record the tokens a dry run would have used for a request to the translation config entry `model`."""
+        self._insert(None, provider, model['name'], "dryrun", prompt_tokens, completion_tokens, model.get('price'),
+                     None, None)
+
+    def report(self, by, run=None):
+        """
+        Sum the usage of a run, or of every provider call (no dry run or replay) with run "all".
+
+        Returns:
+            list: (value of `by`, calls, failed calls, prompt tokens, completion tokens, cost) per value,
+                most expensive first; cost is None when no call of the group has a price
+        """
+        if by not in ("provider", "stage", "chapter", "run", "model"):
+            raise ValueError(f"Cannot group usage by {by}")
+        where, args = ("kind NOT IN ('dryrun', 'replay')", ()) if run == "all" else ("run = ?", (run or self.run,))
+        return self.conn.execute(
+            f"SELECT COALESCE({by}, '-'), COUNT(*), SUM(kind = 'failed'), SUM(prompt_tokens), "
+            f"SUM(completion_tokens), SUM(cost) FROM usage WHERE {where} GROUP BY 1 "
+            f"ORDER BY SUM(cost) DESC, SUM(prompt_tokens) + SUM(completion_tokens) DESC",
+            args
+        ).fetchall()
+
+    def log_report(self, run=None, by=("provider", "stage", "chapter")):
+        run = run or self.run
+        kinds = {kind for kind, in self.conn.execute("SELECT DISTINCT kind FROM usage WHERE run = ?", (run,))}
+        note = " (dry-run estimate)" if "dryrun" in kinds else " (replayed from a cassette)" if "replay" in kinds else ""
+        logger.info(f"Token usage of run {run}{note}:")
+        for group in by:
+            for value, calls, failed, prompt_tokens, completion_tokens, total in self.report(group, run):
+                price = "" if total is None else f", ${total:.4f}"
+                failures = f" ({failed} failed)" if failed else ""
+                logger.info(f"  {group} {value}: {calls} calls{failures}, {prompt_tokens} prompt + "
+                            f"{completion_tokens} completion tokens{price}")
+
+
+def use_ledger(path, book=None, stage=None):
+    """Record the usage of every chat of this process in a ledger, return it."""
+    apichat.ledger = UsageLedger(path, book=book, stage=stage)
+    return apichat.ledger
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the token usage and cost recorded in a ledger")
+    parser.add_argument("path", help="Ledger file, e.g. output/[book]/usage.db")
+    parser.add_argument("--run", help="Run to report, the latest by default, 'all' for every provider call")
+    parser.add_argument("--by", nargs="+", default=["provider", "stage", "chapter"],
+                        choices=["provider", "stage", "chapter", "run", "model"])
+    args = parser.parse_args()
+
+    ledger = UsageLedger(args.path)
+    latest = ledger.conn.execute("SELECT run FROM usage ORDER BY created DESC LIMIT 1").fetchone()
+    if latest is None:
+        logger.error(f"No usage recorded in {args.path}")
+    else:
+        ledger.log_report(args.run or latest[0], by=args.by)
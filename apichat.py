@@ -1,16 +1,50 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import openai
 import google.generativeai as genai
 import yaml
-import time
 import asyncio
 import fastapi_poe as fp
 from fastapi_poe import BotError
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic
 import random
+import time
+import threading
+from loguru import logger
+from ratelimit import limiter, rate_limit_for, estimate_tokens
+from chatcontext import fit_context
+
+
+RATE_LIMIT_BACKOFF = 30  # Seconds every worker pauses after a provider answered 429
+STREAM_CHECK_INTERVAL = 200  # Characters streamed between two checks of the partial response
+_genai_key = None
+_genai_lock = threading.Lock()
+_loop = None
+_loop_lock = threading.Lock()
+# Cassette recording or replaying every chat of the process, see cassette.use_cassette
+cassette = None
+# Ledger of the token usage of every chat of the process, see accounting.use_ledger
+ledger = None
+
+
+def event_loop():
+    """
+    Return the event loop shared by the async SDK clients, running forever in a daemon thread.
 
+    Async clients keep their connection pools bound to the loop they were first used on, so every
+    `achat` call should run on this loop, e.g. through `run_async`.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="apichat-loop", daemon=True).start()
+            _loop = loop
+        return _loop
 
-last_chat_time = None
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop from synchronous code and return its result."""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop()).result()
 
 
 class APITranslationFailure(Exception):
@@ -18,6 +52,13 @@ class APITranslationFailure(Exception):
         super().__init__(message, *args)
 
 
+class ResponseAborted(APITranslationFailure):
+    """A streamed response was stopped early, because it was rejected or no longer needed."""
+    def __init__(self, message="Streamed response aborted.", partial=""):
+        super().__init__(message)
+        self.partial = partial
+
+
 class APIChatApp:
     def __init__(self, api_key, model_name, temperature):
         self.api_key = api_key
@@ -25,18 +66,155 @@ class APIChatApp:
         self.messages = [{"role": "system", "content": "API_PROMPT"}]  # Replace API_PROMPT with actual prompt if needed
         self.response = None
         self.temperature = temperature
+        self.rate_limit = None
+        self.cancelled = threading.Event()
+        self.stream = False
+        # guard(partial_text) -> reason to abort a streamed response, None to continue
+        self.guard = None
+        # Tokens of the last successful call: {"prompt_tokens": int, "completion_tokens": int}, as reported
+        # by the provider in `reported_usage` when it does, estimated otherwise
+        self.usage = None
+        self.reported_usage = None
+        # Entry of the translation config and its price, set by ProviderRegistry.session
+        self.provider = None
+        self.price = None
+        # Stage and chapter the calls are accounted to, those of the thread creating the app
+        self.scope = ledger.scope() if ledger is not None else None
+        # Tokens of previous messages sent along with a request, older turns are dropped or compressed
+        self.context_budget = None
+
+    def cancel(self):
+        """Ask an in-flight streamed request to stop, its result is no longer needed."""
+        self.cancelled.set()
+
+    def _acquire(self, prompt_tokens, message):
+        bucket, rpm, tpm, burst = self.rate_limit
+        # Prompt tokens plus roughly as many completion tokens as the new message
+        limiter.acquire(bucket, rpm=rpm, tpm=tpm, burst=burst, tokens=prompt_tokens + estimate_tokens(message))
+
+    def _on_failure(self, e):
+        if self.rate_limit is not None and ("429" in str(e) or "rate limit" in str(e).lower()):
+            limiter.backoff(self.rate_limit[0], RATE_LIMIT_BACKOFF)
+
+    def _prompt_tokens(self, message):
+        return estimate_tokens(message) + sum(estimate_tokens(m['content']) for m in self.messages)
+
+    def _meter(self, start, prompt_tokens, error=None):
+        if ledger is not None:
+            ledger.record(self, time.time() - start, prompt_tokens, error)
 
     def chat(self, message):
+        self.messages = fit_context(self.messages, self.context_budget)
+        start = time.time()
+        prompt_tokens = self._prompt_tokens(message)
+        try:
+            if cassette is not None:
+                response = cassette.chat(self, message, self._call)
+            else:
+                response = self._call(message)
+        except APITranslationFailure as e:
+            self._meter(start, prompt_tokens, e)
+            raise
+        self._meter(start, prompt_tokens)
+        return response
+
+    def _call(self, message):
+        prompt_tokens = self._prompt_tokens(message)
+        if self.rate_limit is not None:
+            self._acquire(prompt_tokens, message)
+        self.reported_usage = None
+        try:
+            response = self._chat(message)
+        except APITranslationFailure as e:
+            self._on_failure(e)
+            raise
+        self.usage = self.reported_usage or {"prompt_tokens": prompt_tokens,
+                                             "completion_tokens": estimate_tokens(response)}
+        return response
+
+    async def achat(self, message):
+        """
+        Async version of `chat`, to be awaited on the shared event loop (`event_loop`, `run_async`) so
+        that many requests are multiplexed in one thread. Rate limit waits do not block the loop.
+        """
+        self.messages = fit_context(self.messages, self.context_budget)
+        start = time.time()
+        prompt_tokens = self._prompt_tokens(message)
+        try:
+            if cassette is not None:
+                response = await cassette.achat(self, message, self._acall)
+            else:
+                response = await self._acall(message)
+        except APITranslationFailure as e:
+            # The ledger writes to SQLite, off the loop
+            await asyncio.to_thread(self._meter, start, prompt_tokens, e)
+            raise
+        await asyncio.to_thread(self._meter, start, prompt_tokens)
+        return response
+
+    async def _acall(self, message):
+        prompt_tokens = self._prompt_tokens(message)
+        if self.rate_limit is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._acquire, prompt_tokens, message)
+        self.reported_usage = None
+        try:
+            response = await self._achat(message)
+        except APITranslationFailure as e:
+            self._on_failure(e)
+            raise
+        self.usage = self.reported_usage or {"prompt_tokens": prompt_tokens,
+                                             "completion_tokens": estimate_tokens(response)}
+        return response
+
+    def _collect(self, chunks):
+        """Join the text chunks of a streamed response, aborting it as soon as the guard rejects it."""
+        text = ""
+        checked = 0
+        for chunk in chunks:
+            text += chunk
+            checked = self._check_partial(text, checked)
+        return text
+
+    async def _acollect(self, chunks):
+        """Async version of `_collect` for the chunks of an async stream."""
+        text = ""
+        checked = 0
+        async for chunk in chunks:
+            text += chunk
+            checked = self._check_partial(text, checked)
+        return text
+
+    def _check_partial(self, text, checked):
+        """Raise if the partial response was cancelled or is rejected by the guard, return the length checked."""
+        if self.cancelled.is_set():
+            raise ResponseAborted("Streamed response cancelled", partial=text)
+        if self.guard is not None and len(text) - checked >= STREAM_CHECK_INTERVAL:
+            reason = self.guard(text)
+            if reason is not None:
+                raise ResponseAborted(f"Streamed response aborted after {len(text)} characters: {reason}",
+                                      partial=text)
+            return len(text)
+        return checked
+
+    def _chat(self, message):
         raise NotImplementedError("Subclasses must implement this method")
 
+    async def _achat(self, message):
+        # Providers without an async client run the blocking call in a worker thread
+        return await asyncio.to_thread(self._chat, message)
+
 
 class OpenAIChatApp(APIChatApp):
-    def __init__(self, api_key, model_name, temperature=0.7, endpoint="https://api.openai.com/v1"):
+    def __init__(self, api_key, model_name, temperature=0.7, endpoint="https://api.openai.com/v1", client=None,
+                 async_client=None):
         super().__init__(api_key, model_name, temperature)
-        self.client = OpenAI(
+        self.endpoint = endpoint
+        self.client = client or OpenAI(
             api_key=api_key,
             base_url=endpoint
         )
+        # Created on first use, inside the event loop it is bound to
+        self.async_client = async_client
         
         self.messages = [
             {
@@ -45,85 +223,172 @@ class OpenAIChatApp(APIChatApp):
             }
         ]
 
-    def chat(self, message):
+    def _request(self, message):
         self.messages.append(
             {
                 "role": "user", 
                 "content": message
             }
         )
+        return {
+            "model": self.model_name,
+            "messages": self.messages,
+            "temperature": self.temperature,
+            "stop": ["<|im_end|>"],
+            "frequency_penalty": 0.5,
+            "stream": self.stream,
+        }
+
+    def _read_usage(self, response):
+        # Streamed responses carry no usage before stream_options, they stay estimated
+        if response.usage is not None:
+            self.reported_usage = {"prompt_tokens": response.usage.prompt_tokens,
+                                   "completion_tokens": response.usage.completion_tokens}
+
+    def _chat(self, message):
         try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=self.messages,
-                temperature=self.temperature,
-                stop=["<|im_end|>"],
-                frequency_penalty=0.5
-            )
-            self.messages = [{"role": "assistant", "content": response.choices[0].message.content}]
+            response = self.client.chat.completions.create(**self._request(message))
+            if self.stream:
+                try:
+                    content = self._collect(chunk.choices[0].delta.content or "" for chunk in response if chunk.choices)
+                finally:
+                    response.close()
+            else:
+                content = response.choices[0].message.content
+                self._read_usage(response)
+            self.messages = [{"role": "assistant", "content": content}]
             self.response = response
-            return response.choices[0].message.content
+            return content
         except openai.APIError as e:
             raise APITranslationFailure(f"OpenAI API connection failed: {str(e)}")
 
+    async def _achat(self, message):
+        if self.async_client is None:
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.endpoint)
+        try:
+            response = await self.async_client.chat.completions.create(**self._request(message))
+            if self.stream:
+                try:
+                    content = await self._acollect(
+                        chunk.choices[0].delta.content or "" async for chunk in response if chunk.choices
+                    )
+                finally:
+                    await response.close()
+            else:
+                content = response.choices[0].message.content
+                self._read_usage(response)
+            self.messages = [{"role": "assistant", "content": content}]
+            self.response = response
+            return content
+        except openai.APIError as e:
+            raise APITranslationFailure(f"OpenAI API connection failed: {str(e)}")
+
+
+def configure_genai(api_key):
+    """Configure the process-wide Gemini SDK, only when the key differs from the current one."""
+    global _genai_key
+    with _genai_lock:
+        if _genai_key != api_key:
+            genai.configure(api_key=api_key)
+            _genai_key = api_key
+
 
 class GoogleChatApp(APIChatApp):
-    def __init__(self, api_key, model_name, temperature=0.2):
+    # Gemini conversations only have user and model turns
+    ROLES = {"user": "user", "system": "user", "assistant": "model", "bot": "model"}
+    SAFETY_SETTINGS = [
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    ]
+
+    def __init__(self, api_key, model_name, temperature=0.2, model=None):
         super().__init__(api_key, model_name, temperature)
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel(self.model_name)
+        configure_genai(self.api_key)
+        self.model = model or genai.GenerativeModel(self.model_name)
+        self.messages = []
 
-    def chat(self, message):
-        global last_chat_time
-        
-        if last_chat_time is not None:
-            elapsed_time = time.time() - last_chat_time
-            if elapsed_time < 1:
-                time_to_wait = 1 - elapsed_time
-                time.sleep(time_to_wait)
-        last_chat_time = time.time()
-            
+    def _request(self, message):
         self.messages.append({"role": "user", "content": message})
+        # One turn per message, consecutive messages of the same role are merged into one turn
+        contents = []
+        for m in self.messages:
+            role = self.ROLES.get(m["role"], "user")
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"][0] += "\n\n" + m["content"]
+            else:
+                contents.append({"role": role, "parts": [m["content"]]})
+        return contents, {
+            "safety_settings": self.SAFETY_SETTINGS,
+            "generation_config": {"temperature": self.temperature, "max_output_tokens": 8192},
+            "stream": self.stream,
+        }
+
+    @staticmethod
+    def _check_blocked(response):
+        if 'block_reason' in response.prompt_feedback:
+            logger.warning(f"Gemini blocked the request: {response.prompt_feedback}")
+            raise APITranslationFailure("Content generation blocked due to safety settings.")
+
+    @staticmethod
+    def _text(response):
         try:
-            prompt = "".join([m["content"] for m in self.messages])
-            response = self.model.generate_content(
-                prompt,
-                safety_settings=[
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                ],
-                generation_config={"temperature": self.temperature, "max_output_tokens": 8192}
-            )
-            if 'block_reason' in response.prompt_feedback:
-                print(vars(response))
-                raise APITranslationFailure("Content generation blocked due to safety settings.")
+            rtn = response.text
+        except Exception:
+            for candidate in response.candidates:
+                rtn = "\n".join([part.text for part in candidate.content.parts])
+        return rtn
+
+    def _chat(self, message):
+        configure_genai(self.api_key)
+        try:
+            contents, kwargs = self._request(message)
+            response = self.model.generate_content(contents, **kwargs)
+            self._check_blocked(response)
             
-            try:
-                rtn = response.text
-            except Exception:
-                for candidate in response.candidates:
-                    rtn = "\n".join([part.text for part in candidate.content.parts])
+            if self.stream:
+                rtn = self._collect(chunk.text for chunk in response if chunk.parts)
+            else:
+                rtn = self._text(response)
             self.messages = [{"role": "assistant", "content": rtn}]
             return rtn
+        except ResponseAborted:
+            raise
+        except Exception as e:
+            raise APITranslationFailure(f"Google API connection failed: {str(e)}")
+
+    async def _achat(self, message):
+        configure_genai(self.api_key)
+        try:
+            contents, kwargs = self._request(message)
+            response = await self.model.generate_content_async(contents, **kwargs)
+            self._check_blocked(response)
+            if self.stream:
+                rtn = await self._acollect(chunk.text async for chunk in response if chunk.parts)
+            else:
+                rtn = self._text(response)
+            self.messages = [{"role": "assistant", "content": rtn}]
+            return rtn
+        except ResponseAborted:
+            raise
         except Exception as e:
             raise APITranslationFailure(f"Google API connection failed: {str(e)}")
 
 
-class PoeAPIChatApp:
+class PoeAPIChatApp(APIChatApp):
     # Backoff variables
     MAX_BACKOFF_TIME = 20  # Maximum backoff time in seconds
     BASE_BACKOFF_TIME = 5  # Base backoff time in seconds
     _BACKOFF_TIME = BASE_BACKOFF_TIME  # Current backoff time
     
     def __init__(self, api_key, model_name):
-        self.api_key = api_key
-        self.model_name = model_name
+        super().__init__(api_key, model_name, None)
         self.messages = []
         
-    def chat(self, message):
-        return asyncio.run(self._async_chat(message))
+    def _chat(self, message):
+        # On the shared loop rather than a new event loop per request
+        return run_async(self._achat(message))
     
     @classmethod
     def get_backoff_time(cls):
@@ -137,13 +402,15 @@ class PoeAPIChatApp:
     def reset_backoff_time(cls):
         cls._BACKOFF_TIME = cls.BASE_BACKOFF_TIME
 
-    async def _async_chat(self, message):
+    async def _achat(self, message):
         self.messages.append({"role": "user", "content": message})
         final_message = ""
+        checked = 0
         try:
             async for partial in fp.get_bot_response(messages=self.messages, bot_name=self.model_name, 
                                                      api_key=self.api_key):
                 final_message += partial.text
+                checked = self._check_partial(final_message, checked)
         except BotError as e:
             if "rate limit" in str(e):
                 # Exponential backoff
@@ -162,26 +429,160 @@ class PoeAPIChatApp:
 
 
 class AnthropicChatApp(APIChatApp):
-    def __init__(self, api_key, model_name, temperature=1.0):
+    def __init__(self, api_key, model_name, temperature=1.0, client=None, async_client=None):
         super().__init__(api_key, model_name, temperature)
-        self.client = Anthropic(api_key=self.api_key)
+        self.client = client or Anthropic(api_key=self.api_key)
+        # Created on first use, inside the event loop it is bound to
+        self.async_client = async_client
         self.messages = []
 
-    def chat(self, message):
+    def _read_usage(self, response):
+        self.reported_usage = {"prompt_tokens": response.usage.input_tokens,
+                               "completion_tokens": response.usage.output_tokens}
+
+    def _chat(self, message):
         self.messages.append({"role": "user", "content": message})
         try:
-            response = self.client.messages.create(
-                model=self.model_name,
-                messages=self.messages,
-                max_tokens=1000,
-                temperature=self.temperature
-            )
-            assistant_message = response.content[0].text
+            if self.stream:
+                with self.client.messages.stream(
+                    model=self.model_name,
+                    messages=self.messages,
+                    max_tokens=1000,
+                    temperature=self.temperature
+                ) as stream:
+                    assistant_message = self._collect(stream.text_stream)
+                    self._read_usage(stream.get_final_message())
+            else:
+                response = self.client.messages.create(
+                    model=self.model_name,
+                    messages=self.messages,
+                    max_tokens=1000,
+                    temperature=self.temperature
+                )
+                assistant_message = response.content[0].text
+                self._read_usage(response)
             self.messages.append({"role": "assistant", "content": assistant_message})
             return assistant_message
+        except ResponseAborted:
+            raise
         except Exception as e:
             raise APITranslationFailure(f"Anthropic API connection failed: {str(e)}")
 
+    async def _achat(self, message):
+        if self.async_client is None:
+            self.async_client = AsyncAnthropic(api_key=self.api_key)
+        self.messages.append({"role": "user", "content": message})
+        try:
+            if self.stream:
+                async with self.async_client.messages.stream(
+                    model=self.model_name,
+                    messages=self.messages,
+                    max_tokens=1000,
+                    temperature=self.temperature
+                ) as stream:
+                    assistant_message = await self._acollect(stream.text_stream)
+                    self._read_usage(await stream.get_final_message())
+            else:
+                response = await self.async_client.messages.create(
+                    model=self.model_name,
+                    messages=self.messages,
+                    max_tokens=1000,
+                    temperature=self.temperature
+                )
+                assistant_message = response.content[0].text
+                self._read_usage(response)
+            self.messages.append({"role": "assistant", "content": assistant_message})
+            return assistant_message
+        except ResponseAborted:
+            raise
+        except Exception as e:
+            raise APITranslationFailure(f"Anthropic API connection failed: {str(e)}")
+
+
+def provider_kind(name):
+    """Map the name of a translation.yaml entry to the kind of API it uses, None if unknown."""
+    if 'Gemini' in name:
+        return "gemini"
+    if 'OpenAI' in name or 'Sakura' in name:
+        return "openai"
+    if 'Poe' in name:
+        return "poe"
+    if 'Claude' in name:
+        return "claude"
+    return None
+
+
+class ProviderRegistry:
+    """
+    Build the long-lived client of every configured provider once per process, and hand out chat
+    sessions that only carry their own conversation state on top of the shared client.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._async_clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, name, model):
+        kind = provider_kind(name)
+        key = (kind, model.get('key'), model.get('name'), model.get('endpoint'))
+        with self._lock:
+            if key not in self._clients:
+                if kind == "openai":
+                    self._clients[key] = OpenAI(api_key=model['key'], base_url=model['endpoint'])
+                elif kind == "claude":
+                    self._clients[key] = Anthropic(api_key=model['key'])
+                elif kind == "gemini":
+                    configure_genai(model['key'])
+                    self._clients[key] = genai.GenerativeModel(model['name'])
+                else:
+                    self._clients[key] = None
+            return self._clients[key]
+
+    def async_client(self, name, model):
+        """Async SDK client of an entry, shared by the sessions awaited on the shared event loop."""
+        kind = provider_kind(name)
+        key = (kind, model.get('key'), model.get('name'), model.get('endpoint'))
+        with self._lock:
+            if key not in self._async_clients:
+                if kind == "openai":
+                    self._async_clients[key] = AsyncOpenAI(api_key=model['key'], base_url=model['endpoint'])
+                elif kind == "claude":
+                    self._async_clients[key] = AsyncAnthropic(api_key=model['key'])
+                else:
+                    # Gemini models serve both kinds of calls, Poe has no client
+                    self._async_clients[key] = None
+            return self._async_clients[key]
+
+    def session(self, name, model):
+        """Return a fresh chat app for the entry `name` of a translation config, None if unsupported."""
+        kind = provider_kind(name)
+        if kind == "gemini":
+            app = GoogleChatApp(api_key=model['key'], model_name=model['name'], model=self.client(name, model))
+        elif kind == "openai":
+            app = OpenAIChatApp(api_key=model['key'], model_name=model['name'], endpoint=model['endpoint'],
+                                client=self.client(name, model), async_client=self.async_client(name, model))
+        elif kind == "poe":
+            app = PoeAPIChatApp(api_key=model['key'], model_name=model['name'])
+        elif kind == "claude":
+            app = AnthropicChatApp(api_key=model['key'], model_name=model['name'], client=self.client(name, model),
+                                   async_client=self.async_client(name, model))
+        else:
+            return None
+        app.rate_limit = rate_limit_for(kind, model)
+        app.stream = model.get('stream', False)
+        app.provider = name
+        app.price = model.get('price')
+        app.context_budget = model.get('context_tokens')
+        return app
+
+
+registry = ProviderRegistry()
+
+
+def create_chat_app(name, model):
+    return registry.session(name, model)
+
 
 if __name__ == "__main__":
     # Example usage:
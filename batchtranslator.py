@@ -1,14 +1,14 @@
-from utils import load_config, SqlWrapper, gemini_fix
+from utils import load_config, gemini_fix
 from epubparser import main
 import os
 import yaml
 from loguru import logger
 import json
 from p_tqdm import p_map
-from epubloader import translate
+from epubloader import translate, store_translation, build_context
+from cache import TranslationCache
 from argparse import ArgumentParser
 from typing import List
-from prompt import generate_prompt
 from apichat import APITranslationFailure
 
 
@@ -41,33 +41,37 @@ def translate_wrapper(cn_title: str, content: str, context: List[dict] = None) -
     logger.remove()
     logger.add(f"output/{cn_title}/info.log", colorize=True, level="DEBUG")
     
-    buffer = SqlWrapper(os.path.join('output', cn_title, 'buffer.db'))
-    # Already translated
-    if (
-        content in buffer
-    ):
-        return
-    try:
-        cn_text = translate(content, context=context)
-    except UnboundLocalError:
-        cn_text = translate(content, context=None)
-    except APITranslationFailure as e:
-        logger.critical(f"API translation failed: {e}")
-        return
-    cn_text = gemini_fix(cn_text)
-    buffer[content] = cn_text
-    return cn_text
+    with TranslationCache(os.path.join('output', cn_title, 'buffer.db')) as buffer:
+        # Already translated
+        if (
+            content in buffer
+        ):
+            return
+        # Only one worker requests a text repeated across chapters, the others wait for its result
+        with buffer.translating(content) as owner:
+            if not owner:
+                return buffer[content]
+            meta = {}
+            try:
+                cn_text = translate(content, context=context, meta=meta)
+            except UnboundLocalError:
+                cn_text = translate(content, context=None, meta=meta)
+            except APITranslationFailure as e:
+                logger.critical(f"API translation failed: {e}")
+                return
+            cn_text = gemini_fix(cn_text)
+            store_translation(buffer, content, cn_text, meta)
+            return cn_text
 
 
 def chapterwise_translate_wrapper(cn_title: str, contents: List[str]):
     # Already translated
-    context = None
+    prev = None
     for content in contents:
+        context = build_context([prev[0]], [prev[1]], jp_text=content) if prev is not None else None
         cn_text = translate_wrapper(cn_title, content, context=context)
-        context = [
-            {"role": "user", "content": generate_prompt(content, mode="sakura")},
-            {"role": "bot", "content": cn_text},
-        ]
+        # Cached or failed segments return no translation to continue from
+        prev = (content, cn_text) if cn_text is not None else None
 
 
 if __name__ == "__main__":
@@ -91,15 +95,22 @@ if __name__ == "__main__":
     if args.jp_title:
         config['JP_TITLE'] = args.jp_title
     
-    buffer = SqlWrapper(os.path.join('output', config['CN_TITLE'], 'buffer.db'))
-    update_buffer = SqlWrapper(os.path.join('output', config['CN_TITLE'], 'update_buffer.db'))
+    buffer = TranslationCache(os.path.join('output', config['CN_TITLE'], 'buffer.db'))
+    update_buffer = TranslationCache(os.path.join('output', config['CN_TITLE'], 'update_buffer.db'))
         
     if args.independent:
         book_contents = main(os.path.join('output', config['CN_TITLE'], 'input.epub'))
         cn_title = config['CN_TITLE']
+        # Only start workers for the paragraphs not translated yet
+        buffer.preload(book_contents, max_mb=config.get('CACHE_PRELOAD_MB', 256))
+        book_contents = list(dict.fromkeys(content for content in book_contents if content not in buffer))
         p_map(lambda x, t=cn_title: translate_wrapper(t, x), book_contents, num_cpus=config['NUM_PROCS'])
     else:
         book_contents = main(os.path.join('output', config['CN_TITLE'], 'input.epub'), chapterwise=True)
         book_contents = list(book_contents.values())
         cn_title = config['CN_TITLE']
+        # Only start workers for the chapters not fully translated yet
+        buffer.preload([content for contents in book_contents for content in contents],
+                       max_mb=config.get('CACHE_PRELOAD_MB', 256))
+        book_contents = [contents for contents in book_contents if any(content not in buffer for content in contents)]
         p_map(lambda x, t=cn_title: chapterwise_translate_wrapper(t, x), book_contents, num_cpus=config['NUM_PROCS'])
@@ -0,0 +1,772 @@
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import hashlib
+import sqlite3
+import socket
+import argparse
+import threading
+import concurrent.futures
+from contextlib import contextmanager
+from loguru import logger
+from utils import SqlWrapper, Glossary, get_appeared_names, unpack_value
+from chaptercache import ChapterCache
+from ratelimit import estimate_tokens
+
+
+SCHEMA_VERSION = 4
+PRELOAD_CHUNK = 500  # Hashes per query when preloading given source texts
+CLAIM_POLL = 0.5  # Seconds between checks while another process translates the same text
+COLUMNS = [
+    "hash", "source", "translation", "provider", "model", "mode", "glossary",
+    "latency", "prompt_tokens", "completion_tokens", "verdict", "created",
+]
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def align_lines(source, translation):
+    """
+    Pair the lines of a translation with the lines of its source.
+
+    Returns:
+        list: (source line, translated line) pairs, empty unless both have as many non-empty lines
+    """
+    source_lines = [line.strip() for line in source.split("\n") if line.strip()]
+    translated_lines = [line.strip() for line in translation.split("\n") if line.strip()]
+    if len(source_lines) != len(translated_lines):
+        return []
+    return list(zip(source_lines, translated_lines))
+
+
+def glossary_value(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False)
+
+
+def glossary_fingerprint(text, name_convention):
+    """Hash of the glossary entries appearing in a text, changes when one of them is edited."""
+    if not name_convention:
+        return None
+    glossary = get_appeared_names(text, name_convention)
+    return hashlib.sha256(json.dumps(glossary, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def open_chapter_cache(path):
+    """Open the chapters of the same book built from the entries of a cache, None if it has none (see ChapterCache)."""
+    chapters_path = os.path.join(os.path.dirname(path), "chapter_cache.db")
+    return ChapterCache(chapters_path) if os.path.exists(chapters_path) else None
+
+
+class TranslationCache(SqlWrapper):
+    """
+    Translations keyed by the SHA-256 of their source text, with how each one was produced.
+
+    Reads and writes like SqlWrapper (`cache[jp_text] = cn_text`); `put` also records the provider,
+    model, prompt mode, glossary fingerprint, latency and token usage, so entries produced by a bad
+    model or an outdated glossary can be invalidated selectively. The `data` table of a buffer written
+    by an older version is migrated when the file is first opened.
+
+    Translations with as many lines as their source are also stored line by line, so that a text
+    segmented differently can be assembled from the lines of earlier segments (`cover`).
+
+    Each entry can carry the verdict of the validator that last accepted it (`set_verdict`), so that a
+    cache hit is only validated again once the validator or the glossary entries of its text change.
+
+    The glossary names appearing in each entry are indexed with the translation of each name at the
+    time, so that after a glossary edit `glossary_impact` finds the entries to translate again without
+    scanning every cached text.
+
+    After `preload`, reads are served from memory and writes go through to both.
+
+    With a `chapter_cache`, deleting entries also drops the cached chapters built from them.
+    """
+
+    INSERT = f"INSERT OR REPLACE INTO translations ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+    memory = None  # hash -> translation of the preloaded entries
+    verdicts = None  # hash -> verdict of the preloaded entries
+    preloaded = None  # Hashes looked up by the preload, None if the whole table was loaded
+
+    LINE_INSERT = "INSERT OR REPLACE INTO lines (hash, translation, segment) VALUES (?, ?, ?)"
+    NAME_INSERT = "INSERT OR REPLACE INTO glossary_index (name, segment, value) VALUES (?, ?, ?)"
+
+    def __init__(self, *args, chapter_cache=None, **kwargs):
+        self.chapter_cache = chapter_cache
+        self.pending_lines = []
+        self.pending_verdicts = {}  # source -> verdict to record
+        self.pending_names = {}  # hash -> index rows replacing those of the entry
+        super().__init__(*args, **kwargs)
+
+    def _create(self):
+        self.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "hash BLOB PRIMARY KEY, source TEXT NOT NULL, translation TEXT NOT NULL, "
+            "provider TEXT, model TEXT, mode TEXT, glossary TEXT, "
+            "latency REAL, prompt_tokens INTEGER, completion_tokens INTEGER, verdict TEXT, created REAL"
+            ") WITHOUT ROWID"
+        )
+        # hash of a source line -> its translation, and the hash of the segment it was aligned from
+        self.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS lines (hash BLOB PRIMARY KEY, translation TEXT NOT NULL, segment BLOB) "
+            "WITHOUT ROWID"
+        )
+        # glossary name -> entries whose source contains it, with the glossary value they were translated
+        # with (NULL if the name was not in the glossary yet); the empty name marks every indexed entry
+        self.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS glossary_index (name TEXT, segment BLOB, value TEXT, "
+            "PRIMARY KEY (name, segment)) WITHOUT ROWID"
+        )
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS glossary_index_segment ON glossary_index (segment)")
+        # Glossary the index was last brought up to date with
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS glossary_state (name TEXT PRIMARY KEY, value TEXT)")
+        # Source texts some process is translating right now, see `translating`
+        self.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS inflight (hash BLOB PRIMARY KEY, owner TEXT, started REAL) WITHOUT ROWID"
+        )
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            migrated = self.migrate()
+            if migrated:
+                logger.info(f"Migrated {migrated} entries of {self.db_path} to the translation cache")
+        if version < 2:
+            rows = self.cursor.execute("SELECT hash, source, translation FROM translations").fetchall()
+            self.cursor.executemany(self.LINE_INSERT, [
+                line for key, source, translation in rows
+                for line in self._line_rows(key, unpack_value(source), unpack_value(translation))
+            ])
+        if version < 3:
+            columns = {row[1] for row in self.cursor.execute("PRAGMA table_info(translations)")}
+            if "verdict" not in columns:
+                self.cursor.execute("ALTER TABLE translations ADD COLUMN verdict TEXT")
+        if version < SCHEMA_VERSION:
+            self.cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    @staticmethod
+    def _line_rows(key, source, translation):
+        return [(text_hash(jp_line), cn_line, key) for jp_line, cn_line in align_lines(source, translation)]
+
+    @staticmethod
+    def _name_rows(key, names):
+        return [("", key, None)] + [(name, key, value) for name, value in names.items()]
+
+    def migrate(self):
+        """Copy the entries of the legacy `data` table that are not cached yet, return how many."""
+        legacy = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='data'"
+        ).fetchone()
+        if legacy is None:
+            return 0
+        rows = [(key, unpack_value(value)) for key, value in
+                self.cursor.execute("SELECT key, value FROM data WHERE value IS NOT NULL").fetchall()]
+        existing = {key for key, in self.cursor.execute("SELECT hash FROM translations")}
+        rows = [(text_hash(key), key, value) for key, value in rows if text_hash(key) not in existing]
+        # When legacy entries were translated is unknown, created stays NULL
+        self.cursor.executemany(
+            "INSERT OR IGNORE INTO translations (hash, source, translation) VALUES (?, ?, ?)", rows
+        )
+        self.cursor.executemany(self.LINE_INSERT, [
+            line for key, source, translation in rows for line in self._line_rows(key, source, translation)
+        ])
+        self.conn.commit()
+        return len(rows)
+
+    def preload(self, sources=None, max_mb=256):
+        """
+        Read the cached translations into memory, so that lookups no longer query the database.
+
+        Args:
+            sources (iterable): Source texts about to be looked up, None to load the whole table
+            max_mb (float): Memory budget, the preload is abandoned if the entries do not fit
+
+        Returns:
+            bool: Whether the entries were loaded
+        """
+        self.flush()
+        if sources is None:
+            hashes = None
+            rows = self.cursor.execute("SELECT hash, translation, verdict FROM translations")
+        else:
+            hashes = {text_hash(source) for source in sources}
+            hash_list = list(hashes)
+            chunks = [hash_list[i:i + PRELOAD_CHUNK] for i in range(0, len(hash_list), PRELOAD_CHUNK)]
+            rows = (row for chunk in chunks for row in self.conn.execute(
+                f"SELECT hash, translation, verdict FROM translations WHERE hash IN ({', '.join('?' * len(chunk))})", chunk
+            ))
+        memory = {}
+        verdicts = {}
+        size = 0
+        for key, translation, verdict in rows:
+            translation = unpack_value(translation)
+            size += sys.getsizeof(key) + sys.getsizeof(translation) + 100
+            if size > max_mb * 2 ** 20:
+                logger.warning(f"{self.db_path} does not fit in {max_mb} MB, reading it from disk")
+                self.memory = self.preloaded = self.verdicts = None
+                return False
+            memory[key] = translation
+            if verdict is not None:
+                verdicts[key] = verdict
+        self.memory = memory
+        self.verdicts = verdicts
+        self.preloaded = hashes
+        logger.info(f"Preloaded {len(memory)} entries of {self.db_path} ({size / 2 ** 20:.1f} MB)")
+        return True
+
+    def _select(self, key):
+        key = text_hash(key)
+        if self.memory is not None:
+            if key in self.memory:
+                return self.memory[key]
+            if self.preloaded is None or key in self.preloaded:
+                return None
+        self.cursor.execute("SELECT translation FROM translations WHERE hash=?", (key,))
+        result = self.cursor.fetchone()
+        return unpack_value(result[0]) if result else None
+
+    def _delete(self, key):
+        key = text_hash(key)
+        if self.memory is not None:
+            self.memory.pop(key, None)
+            self.verdicts.pop(key, None)
+        self.cursor.execute("DELETE FROM translations WHERE hash=?", (key,))
+        self.cursor.execute("DELETE FROM lines WHERE segment=?", (key,))
+        self.cursor.execute("DELETE FROM glossary_index WHERE segment=?", (key,))
+
+    def put(self, source, translation, provider=None, model=None, mode=None, glossary=None, latency=None,
+            prompt_tokens=None, completion_tokens=None, verdict=None, names=None):
+        """
+        Store a translation with how it was produced.
+
+        `names` are the glossary entries appearing in the source ({name: glossary value}) that it was
+        translated with; entries stored without them are indexed by the next `glossary_impact`.
+        """
+        row = (text_hash(source), source, translation, provider, model, mode, glossary, latency,
+               prompt_tokens, completion_tokens, verdict, time.time())
+        # A verdict recorded for the previous translation does not apply to this one
+        self.pending_verdicts.pop(source, None)
+        if self.memory is not None:
+            self.memory[row[0]] = translation
+            self.verdicts.pop(row[0], None)
+            if verdict is not None:
+                self.verdicts[row[0]] = verdict
+        self.pending_lines += self._line_rows(row[0], source, translation)
+        if names is not None:
+            self.pending_names[row[0]] = self._name_rows(row[0], {
+                name: glossary_value(value) for name, value in names.items()
+            })
+        else:
+            self.pending_names.pop(row[0], None)
+        self._write(source, row, translation)
+        if self.flush_interval is None:
+            self.flush()
+
+    def verdict(self, source):
+        """Return the verdict recorded for the cached translation of a source text, None if there is none."""
+        if source in self.pending_verdicts:
+            return self.pending_verdicts[source]
+        if source in self.pending:
+            return self.pending[source][0][COLUMNS.index("verdict")]
+        key = text_hash(source)
+        if self.memory is not None and key in self.memory:
+            return self.verdicts.get(key)
+        self.cursor.execute("SELECT verdict FROM translations WHERE hash=?", (key,))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def set_verdict(self, source, verdict):
+        """Record the verdict of the validator that accepted the cached translation of a source text."""
+        self.pending_verdicts[source] = verdict
+        if self.memory is not None:
+            self.verdicts[text_hash(source)] = verdict
+        if self.flush_interval is None:
+            self.flush()
+
+    def flush(self):
+        # Entries first, the verdicts update them
+        super().flush()
+        lines, self.pending_lines = self.pending_lines, []
+        verdicts, self.pending_verdicts = self.pending_verdicts, {}
+        names, self.pending_names = self.pending_names, {}
+        if (lines or verdicts or names) and self.conn is not None:
+            try:
+                with self.conn:
+                    self.conn.executemany(self.LINE_INSERT, lines)
+                    self.conn.executemany("UPDATE translations SET verdict=? WHERE hash=?", [
+                        (verdict, text_hash(source)) for source, verdict in verdicts.items()
+                    ])
+                    self.conn.executemany("DELETE FROM glossary_index WHERE segment=?", [(key,) for key in names])
+                    self.conn.executemany(self.NAME_INSERT, [row for rows in names.values() for row in rows])
+            except sqlite3.Error:
+                self.pending_lines = lines + self.pending_lines
+                self.pending_verdicts = {**verdicts, **self.pending_verdicts}
+                self.pending_names = {**names, **self.pending_names}
+                raise
+
+    @staticmethod
+    def _owner_alive(owner):
+        host, _, pid = owner.rpartition(":")
+        if host != socket.gethostname():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, ValueError):
+            pass
+        return True
+
+    def claim(self, source, timeout=600):
+        """
+        Become the only process translating a source text, waiting while another one is.
+
+        Args:
+            source (str): Source text about to be translated
+            timeout (float): Seconds after which a claim is considered abandoned
+
+        Returns:
+            bool: True if the caller holds the claim and should translate the text, False if it was
+                translated by the process it waited for and is cached now
+        """
+        key = text_hash(source)
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        start = time.time()
+        waited = False
+        while True:
+            with self.conn:
+                self.conn.execute("DELETE FROM inflight WHERE hash=? AND started<?", (key, time.time() - timeout))
+                claimed = self.conn.execute(
+                    "INSERT OR IGNORE INTO inflight (hash, owner, started) VALUES (?, ?, ?)", (key, owner, time.time())
+                ).rowcount == 1
+            if claimed:
+                break
+            holder = self.conn.execute("SELECT owner FROM inflight WHERE hash=?", (key,)).fetchone()
+            if holder is not None and not self._owner_alive(holder[0]):
+                with self.conn:
+                    self.conn.execute("DELETE FROM inflight WHERE hash=? AND owner=?", (key, holder[0]))
+                continue
+            waited = True
+            time.sleep(CLAIM_POLL)
+        if waited:
+            result = self.conn.execute(
+                "SELECT translation, verdict FROM translations WHERE hash=? AND created>=?", (key, start)
+            ).fetchone()
+            if result is not None:
+                self.release(source)
+                if self.memory is not None:
+                    self.memory[key] = unpack_value(result[0])
+                    self.verdicts[key] = result[1]
+                return False
+        return True
+
+    def release(self, source):
+        """Commit the translation of a claimed source text and let the waiting processes go on."""
+        self.flush()
+        with self.conn:
+            self.conn.execute("DELETE FROM inflight WHERE hash=? AND owner=?",
+                              (text_hash(source), f"{socket.gethostname()}:{os.getpid()}"))
+
+    @contextmanager
+    def translating(self, source, timeout=600):
+        """
+        Context manager around the translation of a source text, so that concurrent processes sharing
+        the cache send one request per text. Yields whether the caller should translate it; if not,
+        the translation is cached.
+        """
+        owner = self.claim(source, timeout=timeout)
+        try:
+            yield owner
+        finally:
+            if owner:
+                self.release(source)
+
+    def cover(self, source):
+        """
+        Look up every line of a text in the line table.
+
+        Returns:
+            list: Translation of each line of the source, "" for blank lines, None for lines never translated
+        """
+        if self.pending_lines:
+            self.flush()
+        covered = []
+        for line in source.split("\n"):
+            if not line.strip():
+                covered.append("")
+                continue
+            self.cursor.execute("SELECT translation FROM lines WHERE hash=?", (text_hash(line.strip()),))
+            result = self.cursor.fetchone()
+            covered.append(result[0] if result else None)
+        return covered
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def items(self):
+        self.flush()
+        self.cursor.execute("SELECT source, translation FROM translations")
+        return [(unpack_value(source), unpack_value(translation)) for source, translation in self.cursor.fetchall()]
+
+    def entry(self, source):
+        """Return every column of the entry of a source text as a dict, None if it is not cached."""
+        self.flush()
+        self.cursor.execute(f"SELECT {', '.join(COLUMNS)} FROM translations WHERE hash=?", (text_hash(source),))
+        result = self.cursor.fetchone()
+        if result is None:
+            return None
+        entry = dict(zip(COLUMNS, result))
+        entry["source"], entry["translation"] = unpack_value(entry["source"]), unpack_value(entry["translation"])
+        return entry
+
+    def stats(self):
+        """Return (provider, model, mode, entries) for every group of entries."""
+        self.flush()
+        self.cursor.execute(
+            "SELECT provider, model, mode, COUNT(*) FROM translations GROUP BY provider, model, mode ORDER BY 4 DESC"
+        )
+        return self.cursor.fetchall()
+
+    def invalidate(self, provider=None, model=None, mode=None, before=None, stale_glossary=None):
+        """
+        Delete the entries matching every given filter.
+
+        Args:
+            provider (str): Translation config entry that produced the entry
+            model (str): Model name that produced the entry
+            mode (str): Prompt mode the entry was translated with
+            before (float): Only entries created before this timestamp, or migrated from a legacy buffer
+            stale_glossary (dict): Only entries whose glossary fingerprint differs from the one
+                computed with this name convention (entries without a fingerprint are kept)
+
+        Returns:
+            int: Number of entries deleted
+        """
+        self.flush()
+        conditions, params = [], []
+        for column, value in [("provider", provider), ("model", model), ("mode", mode)]:
+            if value is not None:
+                conditions.append(f"{column}=?")
+                params.append(value)
+        if before is not None:
+            conditions.append("(created IS NULL OR created<?)")
+            params.append(before)
+        where = " AND ".join(conditions) or "1"
+        if stale_glossary is None:
+            stale = [key for key, in self.cursor.execute(f"SELECT hash FROM translations WHERE {where}", params)]
+        else:
+            rows = self.cursor.execute(
+                f"SELECT hash, source, glossary FROM translations WHERE {where} AND glossary IS NOT NULL", params
+            ).fetchall()
+            stale = [key for key, source, fingerprint in rows
+                     if glossary_fingerprint(unpack_value(source), stale_glossary) != fingerprint]
+        self.cursor.executemany("DELETE FROM translations WHERE hash=?", [(key,) for key in stale])
+        self.cursor.execute("DELETE FROM lines WHERE segment NOT IN (SELECT hash FROM translations)")
+        self.cursor.execute("DELETE FROM glossary_index WHERE segment NOT IN (SELECT hash FROM translations)")
+        self.conn.commit()
+        # Entries may be gone from disk, read from it again
+        self.memory = self.preloaded = self.verdicts = None
+        self.drop_chapters(stale)
+        return len(stale)
+
+    def drop_chapters(self, hashes):
+        """Drop the cached chapters built from the given entries, if a chapter cache is attached."""
+        if self.chapter_cache is None or not hashes:
+            return []
+        dropped = self.chapter_cache.drop_segments(hashes)
+        if dropped:
+            logger.info(f"Dropped {len(dropped)} cached chapters built from the deleted or replaced entries: "
+                        f"{', '.join(dropped)}")
+        return dropped
+
+    def glossary_impact(self, glossary, baseline=None):
+        """
+        Find the entries translated with other glossary entries than the current ones.
+
+        Entries not indexed yet are scanned once, assuming they were translated with `baseline`; names
+        new to the glossary are looked up once in the indexed entries. Everything else is answered by
+        the index.
+
+        Args:
+            glossary (dict): Current name convention
+            baseline (dict): Name convention the entries not indexed yet were translated with, e.g.
+                names.json before the edits of names_updated.json; defaults to the current one
+
+        Returns:
+            dict: hash -> (source, changed names, estimated tokens to translate it again)
+        """
+        self.flush()
+        baseline = glossary if baseline is None else baseline
+        state = dict(self.cursor.execute("SELECT name, value FROM glossary_state"))
+        rows = []
+
+        unindexed = self.cursor.execute(
+            "SELECT hash, source FROM translations WHERE hash NOT IN (SELECT segment FROM glossary_index WHERE name='')"
+        ).fetchall()
+        if unindexed:
+            known = Glossary(sorted({**baseline, **glossary}.items(), key=lambda item: len(item[0]), reverse=True))
+            for key, source in unindexed:
+                appeared = get_appeared_names(unpack_value(source), known)
+                rows += self._name_rows(key, {
+                    name: glossary_value(baseline[name]) if name in baseline else None for name in appeared
+                })
+            logger.info(f"Indexed the glossary names of {len(unindexed)} entries of {self.db_path}")
+
+        # Names missing from the glossary of the last update, or from the baseline before the first one
+        added = [name for name in glossary if name not in (state or baseline)]
+        if added:
+            indexed = self.cursor.execute(
+                "SELECT hash, source FROM translations WHERE hash IN (SELECT segment FROM glossary_index WHERE name='')"
+            ).fetchall()
+            for key, source in indexed:
+                appeared = get_appeared_names(unpack_value(source), glossary)
+                rows += [(name, key, None) for name in added if name in appeared]
+        if rows:
+            # Entries retranslated since keep their values
+            self.conn.executemany(self.NAME_INSERT.replace("OR REPLACE", "OR IGNORE"), rows)
+            self.conn.commit()
+
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS current_glossary (name TEXT PRIMARY KEY, value TEXT)")
+        self.cursor.execute("DELETE FROM current_glossary")
+        self.cursor.executemany("INSERT INTO current_glossary VALUES (?, ?)", [
+            (name, glossary_value(value)) for name, value in glossary.items()
+        ])
+        impact = {}
+        for key, name, source, prompt_tokens, completion_tokens in self.cursor.execute(
+            "SELECT i.segment, i.name, t.source, t.prompt_tokens, t.completion_tokens FROM glossary_index i "
+            "JOIN current_glossary g ON g.name = i.name JOIN translations t ON t.hash = i.segment "
+            "WHERE i.value IS NOT g.value"
+        ).fetchall():
+            if key not in impact:
+                source = unpack_value(source)
+                # Recorded usage of the last translation, or prompt and completion of the size of the source
+                tokens = (prompt_tokens or 0) + (completion_tokens or 0) or 2 * estimate_tokens(source)
+                impact[key] = (source, [], tokens)
+            impact[key][1].append(name)
+        return impact
+
+    def apply_glossary(self, glossary):
+        """Record the glossary the index is up to date with, so its new names are not looked up again."""
+        state = [(name, glossary_value(value)) for name, value in glossary.items()]
+        if sorted(state) != sorted(self.cursor.execute("SELECT name, value FROM glossary_state").fetchall()):
+            self.cursor.execute("DELETE FROM glossary_state")
+            self.cursor.executemany("INSERT INTO glossary_state (name, value) VALUES (?, ?)", state)
+            self.conn.commit()
+
+    def delete_entries(self, hashes):
+        """
+        Delete entries by hash with their lines and index rows, and the cached chapters built from them,
+        so they are translated again.
+        """
+        self.flush()
+        for key in hashes:
+            self.cursor.execute("DELETE FROM translations WHERE hash=?", (key,))
+            self.cursor.execute("DELETE FROM lines WHERE segment=?", (key,))
+            self.cursor.execute("DELETE FROM glossary_index WHERE segment=?", (key,))
+            if self.memory is not None:
+                self.memory.pop(key, None)
+                self.verdicts.pop(key, None)
+        self.conn.commit()
+        self.drop_chapters(list(hashes))
+
+
+class AsyncTranslationCache:
+    """
+    TranslationCache for asyncio code. Lookups run on a pool of read connections and writes go through
+    a single writer thread, so the event loop never waits on SQLite and no connection is shared
+    between threads.
+
+    Written entries are visible to lookups at once and committed in batches like the write-behind of
+    TranslationCache; `flush` waits until they are on disk.
+
+    Args:
+        db_path (str): Path of the cache, in the format of TranslationCache
+        readers (int): Read connections, further lookups wait for a free one
+        flush_interval (float): Seconds between commits of the writer thread
+        batch_size (int): Pending writes committed at once
+    """
+
+    def __init__(self, db_path, readers=4, flush_interval=1, batch_size=100):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}  # source -> translation queued but not committed yet
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self._local = threading.local()
+        self._conns = []
+        ready = concurrent.futures.Future()
+        self.writer = threading.Thread(target=self._write_loop, args=(ready,), name="cache-writer", daemon=True)
+        self.writer.start()
+        # The writer creates the tables before the first lookup
+        ready.result()
+        self.readers = concurrent.futures.ThreadPoolExecutor(max_workers=readers, thread_name_prefix="cache-reader")
+
+    def _write_loop(self, ready):
+        try:
+            cache = TranslationCache(self.db_path, flush_interval=self.flush_interval, batch_size=self.batch_size)
+        except sqlite3.Error as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+        written = {}
+        with cache:
+            while True:
+                try:
+                    op, args, done = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    op, args, done = "flush", None, None
+                try:
+                    if op == "put":
+                        for source, translation, meta in args:
+                            cache.put(source, translation, **meta)
+                            written[source] = translation
+                    else:
+                        cache.flush()
+                    # Forget the entries committed by now, lookups find them on disk
+                    committed = [source for source in written if source not in cache.pending]
+                    with self.lock:
+                        for source in committed:
+                            if self.pending.get(source) is written.pop(source):
+                                del self.pending[source]
+                    if done is not None:
+                        done.set_result(None)
+                except sqlite3.Error as e:
+                    logger.error(f"Writing to {self.db_path} failed, retrying with the next batch: {e}")
+                    if done is not None:
+                        done.set_exception(e)
+                if op == "close":
+                    return
+
+    def _read_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA busy_timeout=60000")
+            conn.execute("PRAGMA query_only=1")
+            self._local.conn = conn
+            with self.lock:
+                self._conns.append(conn)
+        return conn
+
+    def _lookup(self, sources):
+        hashes = {text_hash(source): source for source in sources}
+        keys = list(hashes)
+        found = {}
+        conn = self._read_conn()
+        for i in range(0, len(keys), PRELOAD_CHUNK):
+            chunk = keys[i:i + PRELOAD_CHUNK]
+            for key, translation in conn.execute(
+                f"SELECT hash, translation FROM translations WHERE hash IN ({', '.join('?' * len(chunk))})", chunk
+            ):
+                found[hashes[key]] = unpack_value(translation)
+        return found
+
+    async def get_many(self, sources):
+        """Return {source: translation} for the given source texts that are cached."""
+        sources = list(dict.fromkeys(sources))
+        with self.lock:
+            found = {source: self.pending[source] for source in sources if source in self.pending}
+        missing = [source for source in sources if source not in found]
+        if missing:
+            found.update(await asyncio.get_running_loop().run_in_executor(self.readers, self._lookup, missing))
+        return found
+
+    async def get(self, source, default=None):
+        return (await self.get_many([source])).get(source, default)
+
+    async def set_many(self, translations, **meta):
+        """
+        Store translations without waiting for the database.
+
+        Args:
+            translations (dict): source -> translation
+            **meta: Provenance of every entry, as for TranslationCache.put
+        """
+        with self.lock:
+            self.pending.update(translations)
+        self.queue.put(("put", [(source, translation, meta) for source, translation in translations.items()], None))
+
+    async def set(self, source, translation, **meta):
+        await self.set_many({source: translation}, **meta)
+
+    async def flush(self):
+        """Wait until everything stored so far is committed."""
+        done = concurrent.futures.Future()
+        self.queue.put(("flush", None, done))
+        await asyncio.wrap_future(done)
+
+    async def close(self):
+        if not self.writer.is_alive():
+            return
+        done = concurrent.futures.Future()
+        self.queue.put(("close", None, done))
+        try:
+            await asyncio.wrap_future(done)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, self.writer.join)
+            self.readers.shutdown(wait=True)
+            for conn in self._conns:
+                conn.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the translation caches (buffer.db, title_buffer.db)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Copy legacy entries into the translation cache")
+    migrate_parser.add_argument("paths", nargs="+")
+    stats_parser = subparsers.add_parser("stats", help="Count entries by provider, model and mode")
+    stats_parser.add_argument("paths", nargs="+")
+    invalidate_parser = subparsers.add_parser("invalidate", help="Delete entries so they are translated again")
+    invalidate_parser.add_argument("paths", nargs="+")
+    invalidate_parser.add_argument("--provider", type=str)
+    invalidate_parser.add_argument("--model", type=str)
+    invalidate_parser.add_argument("--mode", type=str)
+    invalidate_parser.add_argument("--before", type=float, help="Unix timestamp")
+    invalidate_parser.add_argument("--stale-glossary", action="store_true",
+                                   help="Only entries translated with different glossary entries than today's")
+    glossary_parser = subparsers.add_parser("glossary", help="Report the entries affected by the glossary edits")
+    glossary_parser.add_argument("paths", nargs="+")
+    glossary_parser.add_argument("--apply", action="store_true", help="Delete them so they are translated again")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        chapter_cache = open_chapter_cache(path)
+        try:
+            with TranslationCache(path, chapter_cache=chapter_cache) as cache:
+                if args.command == "migrate":
+                    logger.info(f"{path}: {cache.migrate()} entries migrated")
+                elif args.command == "stats":
+                    for provider, model, mode, count in cache.stats():
+                        logger.info(f"{path}: {provider or '-'} / {model or '-'} / {mode or '-'}: {count}")
+                elif args.command == "glossary":
+                    from prompt import name_convention, base_name_convention
+                    impact = cache.glossary_impact(name_convention, base_name_convention)
+                    for source, changed, tokens in impact.values():
+                        logger.info(f"{', '.join(changed)}: {source[:40]!r} (~{tokens} tokens)")
+                    logger.info(f"{path}: {len(impact)} entries to translate again, "
+                                f"about {sum(tokens for _, _, tokens in impact.values())} tokens")
+                    if args.apply:
+                        cache.delete_entries(impact)
+                        cache.apply_glossary(name_convention)
+                else:
+                    stale_glossary = None
+                    if args.stale_glossary:
+                        from prompt import name_convention
+                        stale_glossary = name_convention
+                    deleted = cache.invalidate(provider=args.provider, model=args.model, mode=args.mode,
+                                               before=args.before, stale_glossary=stale_glossary)
+                    logger.info(f"{path}: {deleted} entries invalidated")
+        except sqlite3.Error as e:
+            logger.error(f"{path}: {e}")
+        finally:
+            if chapter_cache is not None:
+                chapter_cache.close()
@@ -0,0 +1,278 @@
+import os
+import json
+import sqlite3
+import argparse
+from loguru import logger
+from utils import SqlWrapper, pack_value, unpack_value
+from cache import TranslationCache, open_chapter_cache, text_hash
+
+
+# Columns holding cached text, compressed by `compress` and read through `unpack_value`
+COMPRESSIBLE = {
+    "data": ["value"],
+    "translations": ["source", "translation"],
+}
+TRANSLATION_COLUMNS = [
+    "source", "translation", "provider", "model", "mode", "glossary",
+    "latency", "prompt_tokens", "completion_tokens", "verdict", "created",
+]
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA busy_timeout=60000")
+    return conn
+
+
+def tables(conn, schema="main"):
+    return {name for name, in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table'")}
+
+
+def file_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ["", "-wal"] if os.path.exists(path + suffix))
+
+
+def open_like(path, names):
+    """Create the tables of a cache holding the given tables, in the format its wrapper expects."""
+    if "translations" in names:
+        TranslationCache(path).close()
+    if "data" in names:
+        with connect(path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT)")
+
+
+def replaced_translations(conn):
+    """Translation of every entry of the cache that the attached cache `src` holds too, by hash."""
+    return {key: unpack_value(translation) for key, translation in conn.execute(
+        "SELECT hash, translation FROM translations WHERE hash IN (SELECT hash FROM src.translations)"
+    )}
+
+
+def drop_chapters(path, hashes):
+    """Drop the cached chapters of the book built from entries of a cache whose translation was replaced."""
+    chapter_cache = open_chapter_cache(path) if hashes else None
+    if chapter_cache is None:
+        return
+    with chapter_cache, TranslationCache(path, chapter_cache=chapter_cache) as cache:
+        cache.drop_chapters(hashes)
+
+
+def merge(target, sources):
+    """
+    Merge caches into one, e.g. the buffer.db of every book of a series.
+
+    Translation entries keep the most recent translation of each source text, plain entries are
+    taken from the last source holding them. Legacy entries are folded into the translation table.
+    The cached chapters built from the replaced translations are dropped.
+    """
+    changed = set()
+    for source in sources:
+        with connect(source) as conn:
+            names = tables(conn)
+        # Bring both to the current schema, a cache written by an older version lacks some columns
+        open_like(source, names)
+        open_like(target, names)
+        conn = connect(target)
+        conn.execute("ATTACH DATABASE ? AS src", (source,))
+        with conn:
+            if "translations" in names:
+                before = replaced_translations(conn)
+                conn.execute(
+                    f"INSERT INTO translations (hash, {', '.join(TRANSLATION_COLUMNS)}) "
+                    f"SELECT hash, {', '.join(TRANSLATION_COLUMNS)} FROM src.translations WHERE true "
+                    f"ON CONFLICT(hash) DO UPDATE SET "
+                    f"{', '.join(f'{column}=excluded.{column}' for column in TRANSLATION_COLUMNS)} "
+                    f"WHERE translations.created IS NULL OR excluded.created > translations.created"
+                )
+                after = replaced_translations(conn)
+                changed.update(key for key, translation in before.items() if after[key] != translation)
+            if "lines" in names:
+                conn.execute("INSERT OR REPLACE INTO lines SELECT hash, translation, segment FROM src.lines")
+            if "translations" in names:
+                # Glossary index rows follow the translation kept for each entry, entries taken from a source
+                # without an index are indexed again by the next glossary update
+                taken = ("SELECT s.hash FROM src.translations s JOIN translations t ON t.hash = s.hash "
+                         "WHERE t.created IS s.created")
+                conn.execute(f"DELETE FROM glossary_index WHERE segment IN ({taken})")
+                if "glossary_index" in names:
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO glossary_index SELECT name, segment, value FROM src.glossary_index "
+                        f"WHERE segment IN ({taken})"
+                    )
+            if "data" in names:
+                conn.execute("INSERT OR REPLACE INTO data (key, value) SELECT key, value FROM src.data")
+        conn.execute("DETACH DATABASE src")
+        conn.close()
+        logger.info(f"Merged {source} into {target}")
+    with connect(target) as conn:
+        names = tables(conn)
+    if "translations" in names and "data" in names:
+        with TranslationCache(target) as cache:
+            logger.info(f"{cache.migrate()} legacy entries of {target} added to its translation table")
+    drop_chapters(target, changed)
+
+
+def dedup(path):
+    """Drop legacy entries already in the translation table, empty entries and lines of deleted segments."""
+    conn = connect(path)
+    names = tables(conn)
+    removed = 0
+    with conn:
+        if "data" in names:
+            removed += conn.execute("DELETE FROM data WHERE value IS NULL").rowcount
+        if "translations" in names:
+            if "data" in names:
+                existing = {key for key, in conn.execute("SELECT hash FROM translations")}
+                duplicates = [(key,) for key, in conn.execute("SELECT key FROM data") if text_hash(key) in existing]
+                conn.executemany("DELETE FROM data WHERE key=?", duplicates)
+                removed += len(duplicates)
+                if conn.execute("SELECT COUNT(*) FROM data").fetchone()[0] == 0:
+                    conn.execute("DROP TABLE data")
+            removed += conn.execute("DELETE FROM translations WHERE translation=''").rowcount
+            removed += conn.execute(
+                "DELETE FROM lines WHERE segment NOT IN (SELECT hash FROM translations)"
+            ).rowcount
+            removed += conn.execute(
+                "DELETE FROM glossary_index WHERE segment NOT IN (SELECT hash FROM translations)"
+            ).rowcount
+    conn.close()
+    logger.info(f"{path}: {removed} duplicate or dead entries removed")
+
+
+def vacuum(path):
+    before = file_size(path)
+    conn = connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    logger.info(f"{path}: {before / 2 ** 20:.2f} MB -> {file_size(path) / 2 ** 20:.2f} MB")
+
+
+def compress(path, method="zlib", min_size=64):
+    """
+    Compress the cached text values longer than `min_size` characters, or decompress all with method None.
+
+    Wrappers read both forms, so a cache can be compressed while it is in use elsewhere.
+    """
+    conn = connect(path)
+    names = tables(conn)
+    changed = 0
+    with conn:
+        for table, columns in COMPRESSIBLE.items():
+            if table not in names:
+                continue
+            key = "key" if table == "data" else "hash"
+            for column in columns:
+                updates = []
+                for row_key, value in conn.execute(f"SELECT {key}, {column} FROM {table} WHERE {column} IS NOT NULL"):
+                    text = unpack_value(value)
+                    if method is None:
+                        packed = text
+                    elif len(text) >= min_size:
+                        packed = pack_value(text, method)
+                    else:
+                        continue
+                    if packed != value:
+                        updates.append((packed, row_key))
+                conn.executemany(f"UPDATE {table} SET {column}=? WHERE {key}=?", updates)
+                changed += len(updates)
+    conn.close()
+    logger.info(f"{path}: {changed} values {'decompressed' if method is None else f'compressed with {method}'}")
+
+
+def export_jsonl(path, output):
+    """Write every entry as one JSON object per line, uncompressed, with the table it comes from."""
+    conn = connect(path)
+    names = tables(conn)
+    count = 0
+    with open(output, "w", encoding="utf-8") as f:
+        if "translations" in names:
+            for row in conn.execute(f"SELECT {', '.join(TRANSLATION_COLUMNS)} FROM translations"):
+                entry = dict(zip(TRANSLATION_COLUMNS, row))
+                entry["source"], entry["translation"] = unpack_value(entry["source"]), unpack_value(entry["translation"])
+                f.write(json.dumps({"table": "translations", **entry}, ensure_ascii=False) + "\n")
+                count += 1
+        if "data" in names:
+            for key, value in conn.execute("SELECT key, value FROM data"):
+                f.write(json.dumps({"table": "data", "key": key, "value": unpack_value(value)}, ensure_ascii=False) + "\n")
+                count += 1
+    conn.close()
+    logger.info(f"Exported {count} entries of {path} to {output}")
+
+
+def import_jsonl(path, input_path):
+    """
+    Add the entries of an export to a cache, replacing the entries of the same key and dropping the
+    cached chapters built from the translations replaced.
+    """
+    with open(input_path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    translations = [entry for entry in entries if entry["table"] == "translations"]
+    data = [entry for entry in entries if entry["table"] == "data"]
+    if translations:
+        chapter_cache = open_chapter_cache(path)
+        try:
+            with TranslationCache(path, chapter_cache=chapter_cache) as cache:
+                changed = set()
+                for entry in translations:
+                    previous = cache.entry(entry["source"])
+                    if previous is not None and previous["translation"] != entry["translation"]:
+                        changed.add(text_hash(entry["source"]))
+                    cache.put(*[entry.get(column) for column in TRANSLATION_COLUMNS[:-1]])
+                # Keep when the entries were translated
+                cache.conn.executemany("UPDATE translations SET created=? WHERE hash=?", [
+                    (entry.get("created"), text_hash(entry["source"])) for entry in translations
+                ])
+                cache.conn.commit()
+                cache.drop_chapters(changed)
+        finally:
+            if chapter_cache is not None:
+                chapter_cache.close()
+    if data:
+        with SqlWrapper(path) as wrapper:
+            wrapper.conn.executemany(SqlWrapper.INSERT, [(entry["key"], entry["value"]) for entry in data])
+            wrapper.conn.commit()
+    logger.info(f"Imported {len(entries)} entries of {input_path} into {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the SQLite caches in output/ (buffer.db, name.db, ...)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    merge_parser = subparsers.add_parser("merge", help="Merge caches, e.g. per-book caches into a series cache")
+    merge_parser.add_argument("target")
+    merge_parser.add_argument("sources", nargs="+")
+    for command, help in [("dedup", "Remove duplicate and dead entries"), ("vacuum", "Reclaim free space")]:
+        subparsers.add_parser(command, help=help).add_argument("paths", nargs="+")
+    compress_parser = subparsers.add_parser("compress", help="Compress cached values")
+    compress_parser.add_argument("paths", nargs="+")
+    compress_parser.add_argument("--method", choices=["zlib", "zstd"], default="zlib")
+    compress_parser.add_argument("--min-size", type=int, default=64, help="Only values of at least this many characters")
+    subparsers.add_parser("decompress", help="Store every value uncompressed again").add_argument("paths", nargs="+")
+    export_parser = subparsers.add_parser("export", help="Export a cache to JSONL")
+    export_parser.add_argument("path")
+    export_parser.add_argument("output")
+    import_parser = subparsers.add_parser("import", help="Import a JSONL export into a cache")
+    import_parser.add_argument("path")
+    import_parser.add_argument("input")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "merge":
+            merge(args.target, args.sources)
+        elif args.command == "export":
+            export_jsonl(args.path, args.output)
+        elif args.command == "import":
+            import_jsonl(args.path, args.input)
+        else:
+            for path in args.paths:
+                if args.command == "dedup":
+                    dedup(path)
+                elif args.command == "vacuum":
+                    vacuum(path)
+                elif args.command == "compress":
+                    compress(path, method=args.method, min_size=args.min_size)
+                else:
+                    compress(path, method=None)
+    except (sqlite3.Error, ValueError) as e:
+        logger.error(e)
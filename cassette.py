@@ -0,0 +1,153 @@
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import argparse
+import threading
+from collections import Counter
+from loguru import logger
+import apichat
+from apichat import APITranslationFailure, ResponseAborted
+from utils import pack_value, unpack_value
+
+
+class Cassette:
+    """
+    Provider requests and responses recorded to an SQLite file, to replay a run without network access.
+
+    A request is identified by the chat app class, the model, the conversation so far and the new
+    message. The n-th identical request of a replay gets the n-th recorded response, errors included,
+    and leaves the conversation state of the app as the recorded call did.
+
+    Args:
+        path (str): Cassette file
+        mode (str): "record" to call the providers and record, "replay" to answer from the file
+        latency (bool): Wait as long as the recorded call took when replaying
+    """
+
+    def __init__(self, path, mode="replay", latency=False):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.replayed = Counter()  # key -> responses served
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS calls (key BLOB, seq INTEGER, app TEXT, model TEXT, message TEXT, "
+            "response TEXT, error TEXT, error_type TEXT, partial TEXT, latency REAL, usage TEXT, "
+            "messages TEXT, created REAL, PRIMARY KEY (key, seq)) WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def key(app, message):
+        request = [type(app).__name__, app.model_name, app.messages, message]
+        return hashlib.sha256(json.dumps(request, ensure_ascii=False).encode("utf-8")).digest()
+
+    def record(self, app, key, message, response, error, latency):
+        with self.lock:
+            seq = self.conn.execute("SELECT COALESCE(MAX(seq), -1) + 1 FROM calls WHERE key=?", (key,)).fetchone()[0]
+            self.conn.execute(
+                "INSERT INTO calls (key, seq, app, model, message, response, error, error_type, partial, latency, "
+                "usage, messages, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, seq, type(app).__name__, app.model_name, pack_value(message, "zlib"),
+                 None if response is None else pack_value(response, "zlib"),
+                 None if error is None else str(error), None if error is None else type(error).__name__,
+                 getattr(error, "partial", None), latency, json.dumps(app.usage),
+                 pack_value(json.dumps(app.messages, ensure_ascii=False), "zlib"), time.time())
+            )
+            self.conn.commit()
+
+    def lookup(self, app, message):
+        """Return the recorded call answering a request, raise APITranslationFailure if there is none."""
+        key = self.key(app, message)
+        with self.lock:
+            seq = self.replayed[key]
+            self.replayed[key] += 1
+            row = self.conn.execute(
+                "SELECT response, error, error_type, partial, latency, usage, messages FROM calls "
+                "WHERE key=? AND seq<=? ORDER BY seq DESC LIMIT 1", (key, seq)
+            ).fetchone()
+        if row is None:
+            logger.warning(f"No recorded response of {type(app).__name__} ({app.model_name}) in {self.path}")
+            raise APITranslationFailure("No recorded response in the cassette.")
+        return row
+
+    def restore(self, app, row):
+        response, error, error_type, partial, _, usage, messages = row
+        app.messages = json.loads(unpack_value(messages))
+        # Nothing was reported by a provider for this call, see UsageLedger
+        app.reported_usage = None
+        if error is not None:
+            if error_type == "ResponseAborted":
+                raise ResponseAborted(error, partial=partial or "")
+            raise APITranslationFailure(error)
+        app.usage = json.loads(usage)
+        return unpack_value(response)
+
+    def chat(self, app, message, call):
+        """Answer `app.chat(message)` from the cassette, or through `call` while recording."""
+        if self.mode == "replay":
+            row = self.lookup(app, message)
+            if self.latency and row[4]:
+                time.sleep(row[4])
+            return self.restore(app, row)
+        key = self.key(app, message)
+        start = time.time()
+        try:
+            response = call(message)
+        except APITranslationFailure as e:
+            self.record(app, key, message, None, e, time.time() - start)
+            raise
+        self.record(app, key, message, response, None, time.time() - start)
+        return response
+
+    async def achat(self, app, message, call):
+        """Async version of `chat`, the blocking database work runs in a thread."""
+        if self.mode == "replay":
+            row = await asyncio.to_thread(self.lookup, app, message)
+            if self.latency and row[4]:
+                await asyncio.sleep(row[4])
+            return self.restore(app, row)
+        key = self.key(app, message)
+        start = time.time()
+        try:
+            response = await call(message)
+        except APITranslationFailure as e:
+            await asyncio.to_thread(self.record, app, key, message, None, e, time.time() - start)
+            raise
+        await asyncio.to_thread(self.record, app, key, message, response, None, time.time() - start)
+        return response
+
+    def stats(self):
+        """Return (app, model, calls, errors, total latency) for every recorded model."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT app, model, COUNT(*), COUNT(error), SUM(latency) FROM calls GROUP BY app, model"
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def use_cassette(path, mode="replay", latency=False):
+    """Route every chat of this process through a cassette, return it."""
+    apichat.cassette = Cassette(path, mode=mode, latency=latency)
+    logger.info(f"{'Recording provider calls to' if mode == 'record' else 'Replaying provider calls from'} {path}")
+    return apichat.cassette
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show what a cassette recorded")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    cassette = Cassette(args.path)
+    for app, model, calls, errors, latency in cassette.stats():
+        logger.info(f"{app} / {model}: {calls} calls, {errors} errors, {latency:.1f}s of provider time")
+    cassette.close()
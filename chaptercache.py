@@ -0,0 +1,119 @@
+import json
+import hashlib
+from utils import SqlWrapper, get_appeared_names
+
+
+# Bump whenever extraction, translation post-processing or assembly changes the output of a chapter
+PIPELINE_VERSION = 2
+# Settings that only shape requests for segments not translated yet, a stored chapter has none left
+REQUEST_KEYS = {
+    "CONCURRENCY", "CONTEXT_LEN", "TITLE_CONTEXT_LEN", "TITLE_SPLIT_LEN", "TRANSLATION_TITLE_RETRY_COUNT",
+    "NAME_VIOLATION_LIMIT", "OUTAGE_ROUNDS", "HEDGING", "HEDGE_PERCENTILE", "HEDGE_DEADLINE", "NUM_PROCS",
+}
+
+
+def chapter_key(content, config, name_convention, title_buffer, text, titles):
+    """
+    Hash everything the assembled XHTML of a chapter depends on.
+
+    Args:
+        content (str): Original XHTML of the chapter
+        config (dict): Configuration loaded from .env, settings in REQUEST_KEYS are ignored
+        name_convention (dict): Glossary, only the entries appearing in `text` are hashed
+        title_buffer (TranslationCache): Translated titles
+        text (str): Text of the segments extracted from the chapter, without markup such as ruby
+        titles (list): Headings and link texts of the chapter, only their translations are hashed
+
+    Returns:
+        str: Hex digest identifying this build of the chapter
+    """
+    glossary = get_appeared_names(text, name_convention)
+    config = {k: v for k, v in config.items() if k not in REQUEST_KEYS}
+    digest = hashlib.sha256()
+    for part in [
+        str(PIPELINE_VERSION),
+        content,
+        json.dumps(config, sort_keys=True, ensure_ascii=False, default=str),
+        json.dumps(glossary, sort_keys=True, ensure_ascii=False),
+        json.dumps([(title, title_buffer.get(title)) for title in titles], ensure_ascii=False),
+    ]:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ChapterCache:
+    """
+    Assembled bilingual and Chinese-only XHTML of every fully translated chapter, so that a re-run
+    only rebuilds the chapters whose content, glossary entries, config or titles changed.
+
+    Each entry also keeps the translation context at the end of the chapter, which the first segment
+    of the next chapter is translated with, and the hashes of the cached segments it was built from,
+    so that invalidating a translation (see `TranslationCache.invalidate`) drops the chapters using it.
+    """
+
+    def __init__(self, db_path):
+        self.db = SqlWrapper(db_path)
+        # hash of a segment in buffer.db -> chapters built with its translation
+        self.db.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS segments (hash BLOB, item_id TEXT, PRIMARY KEY (hash, item_id)) WITHOUT ROWID"
+        )
+        self.db.cursor.execute("CREATE INDEX IF NOT EXISTS segments_item ON segments (item_id)")
+        self.db.conn.commit()
+
+    def get(self, item_id, content, config, name_convention, title_buffer):
+        """Return the artifact of a chapter if none of its inputs changed since it was built, None otherwise."""
+        if item_id not in self.db:
+            return None
+        artifact = json.loads(self.db[item_id])
+        # The text and titles stored with it follow from the content and config, which the key covers
+        key = chapter_key(content, config, name_convention, title_buffer, artifact.get("text", ""),
+                          artifact.get("titles", []))
+        if artifact["key"] != key:
+            return None
+        return artifact
+
+    def put(self, item_id, key, cnjp, cn, stylesheets, tail, text="", titles=(), segments=()):
+        """
+        Store a chapter built with `key` (see `chapter_key`) from its extracted `text` and `titles`,
+        `segments` being the hashes of the cached translations it was built from.
+        """
+        self.db.cursor.execute("DELETE FROM segments WHERE item_id=?", (item_id,))
+        self.db.cursor.executemany("INSERT OR IGNORE INTO segments (hash, item_id) VALUES (?, ?)",
+                                   [(segment, item_id) for segment in segments])
+        self.db[item_id] = json.dumps({
+            "key": key,
+            "cnjp": cnjp,
+            "cn": cn,
+            "stylesheets": stylesheets,
+            "tail": tail,
+            "text": text,
+            "titles": list(titles),
+        }, ensure_ascii=False)
+
+    def drop_segments(self, hashes):
+        """
+        Drop the chapters built from any of the given segments, so they are rebuilt with new translations.
+
+        Returns:
+            list: Ids of the dropped chapters
+        """
+        dropped = set()
+        for key in hashes:
+            dropped.update(item_id for item_id, in self.db.cursor.execute(
+                "SELECT item_id FROM segments WHERE hash=?", (key,)
+            ).fetchall())
+        for item_id in dropped:
+            self.db.cursor.execute("DELETE FROM data WHERE key=?", (item_id,))
+            self.db.cursor.execute("DELETE FROM segments WHERE item_id=?", (item_id,))
+        self.db.conn.commit()
+        return sorted(dropped)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from ratelimit import estimate_tokens
+
+
+# Below this many tokens left, the oldest turn that does not fit is dropped rather than compressed
+MIN_COMPRESSED_TOKENS = 32
+
+
+@lru_cache(maxsize=4096)
+def message_tokens(content):
+    return estimate_tokens(content)
+
+
+def split_turns(messages):
+    """Group the messages into turns: a user message with the replies to it, or replies without a request."""
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def compress_turn(turn, budget):
+    """
+    Keep the last lines of every message of a turn, as many as fit in `budget` tokens together.
+
+    Source and translation have the same lines, so the kept lines still match. None if no line fits.
+    """
+    lines = [message["content"].split("\n") for message in turn]
+    for keep in range(max(len(message_lines) for message_lines in lines) - 1, 0, -1):
+        contents = ["\n".join(message_lines[-keep:]) for message_lines in lines]
+        if sum(message_tokens(content) for content in contents) <= budget:
+            return [{**message, "content": content} for message, content in zip(turn, contents)]
+    return None
+
+
+def fit_context(messages, budget):
+    """
+    Keep the system messages and the most recent turns of a conversation within `budget` tokens.
+
+    Turns are dropped from the oldest, the oldest one kept is compressed to its last lines when it
+    only partly fits. Returns the messages unchanged when they fit or `budget` is None.
+    """
+    if budget is None or sum(message_tokens(message["content"]) for message in messages) <= budget:
+        return messages
+    system = [message for message in messages if message["role"] == "system"]
+    left = budget - sum(message_tokens(message["content"]) for message in system)
+    kept = []
+    for turn in reversed(split_turns([message for message in messages if message["role"] != "system"])):
+        tokens = sum(message_tokens(message["content"]) for message in turn)
+        if tokens <= left:
+            kept.insert(0, turn)
+            left -= tokens
+            continue
+        if left >= MIN_COMPRESSED_TOKENS:
+            compressed = compress_turn(turn, left)
+            if compressed is not None:
+                kept.insert(0, compressed)
+        break
+    return system + [message for turn in kept for message in turn]
+
+
+class ContextRenderer:
+    """
+    Render previous segments into the context turns of a request, as prompt requests and their replies.
+
+    Each glossary entry is listed once: not at all for the names of the segment being translated, whose
+    prompt lists them already, otherwise in the first turn the name appears in. Consecutive segments
+    share all but one of their previous segments, so rendered turns are cached and reused.
+
+    Args:
+        glossary (Glossary): Name convention of the book
+        prompt (callable): prompt(text, glossary, mode) rendering a request, e.g. `sakura_prompt`
+        max_entries (int): Rendered turns kept in the cache
+    """
+
+    def __init__(self, glossary, prompt, max_entries=1024):
+        self.glossary = glossary
+        self.prompt = prompt
+        self.max_entries = max_entries
+        self.rendered = OrderedDict()  # (source, listed names) -> request
+        self.lock = threading.Lock()
+
+    def request(self, jp_text, listed):
+        key = (jp_text, listed)
+        with self.lock:
+            if key in self.rendered:
+                self.rendered.move_to_end(key)
+                return self.rendered[key]
+        content = self.prompt(jp_text, {name: self.glossary[name] for name in listed}, mode="soft")
+        with self.lock:
+            self.rendered[key] = content
+            if len(self.rendered) > self.max_entries:
+                self.rendered.popitem(last=False)
+        return content
+
+    def render(self, prev_jp_text, prev_cn_text, jp_text=None):
+        """
+        Return the context turns of the previous segments and their translations, None without any.
+
+        jp_text (str): Segment the context is for, the names appearing in it are not listed again
+        """
+        seen = set(self.glossary.appeared(jp_text)) if jp_text else set()
+        context = []
+        for pj, pc in zip(prev_jp_text, prev_cn_text):
+            listed = tuple(name for name in self.glossary.appeared(pj) if name not in seen)
+            seen.update(listed)
+            context += [
+                {"role": "user", "content": self.request(pj, listed)},
+                {"role": "bot", "content": pc},
+            ]
+        return context or None
@@ -0,0 +1,121 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from tqdm import tqdm
+
+
+_provider_slots = {}
+_provider_slots_lock = threading.Lock()
+
+
+def provider_slot(name, model):
+    """
+    Return a context manager bounding the number of in-flight requests sent to one provider entry.
+
+    The limit is read from the optional `concurrency` key of the entry in translation.yaml. Entries
+    without it are not limited beyond the number of engine workers.
+    """
+    if 'concurrency' not in model:
+        return nullcontext()
+    with _provider_slots_lock:
+        if name not in _provider_slots:
+            _provider_slots[name] = threading.BoundedSemaphore(model['concurrency'])
+        return _provider_slots[name]
+
+
+class Coalescer:
+    """
+    Run a function once per key among concurrent callers. Callers arriving while the call for their
+    key is in flight wait for it and share its result or exception, e.g. workers of different
+    chapters reaching the same short line.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn):
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        future.set_result(result)
+        return result
+
+
+def make_chains(chapters, independent=False):
+    """
+    Arrange the segments of a book into chains of jobs for `run_chains`.
+
+    Args:
+        chapters (list): List of segment lists, one per chapter
+        independent (bool): Context-free mode, every segment becomes its own chain
+
+    Returns:
+        list: Chains of segments
+    """
+    if independent:
+        return [[segment] for segments in chapters for segment in segments]
+    return [segments for segments in chapters if segments]
+
+
+def run_chains(chains, worker, on_result=None, max_workers=1, desc=None):
+    """
+    Run chains of jobs with up to `max_workers` chains in flight.
+
+    Jobs in one chain run strictly in order, and the worker receives the (job, result) history of the
+    chain so far, so it can build the previous-segment context it needs. Different chains do not
+    depend on each other and run in parallel.
+
+    Args:
+        chains (list): List of job lists
+        worker (callable): worker(job, history) -> result, called from a worker thread
+        on_result (callable): on_result(job, result), always called from the calling thread
+        max_workers (int): Number of chains processed concurrently
+        desc (str): Progress bar description
+
+    Returns:
+        list: (job, result) pairs in completion order
+    """
+    results = queue.Queue()
+
+    def run_chain(chain):
+        history = []
+        for job in chain:
+            result = worker(job, history)
+            history.append((job, result))
+            results.put((job, result))
+
+    completed = []
+    total = sum(len(chain) for chain in chains)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(total=total, desc=desc, unit="seg") as bar:
+        futures = [executor.submit(run_chain, chain) for chain in chains if chain]
+        while True:
+            try:
+                job, result = results.get(timeout=0.1)
+            except queue.Empty:
+                if all(future.done() for future in futures) and results.empty():
+                    break
+                continue
+            if on_result is not None:
+                on_result(job, result)
+            completed.append((job, result))
+            bar.update(1)
+
+        # Surface exceptions raised inside worker threads
+        for future in futures:
+            future.result()
+
+    return completed
@@ -4,14 +4,26 @@ from copy import deepcopy
 import argparse
 import re
 from tqdm import tqdm
-from apichat import OpenAIChatApp, GoogleChatApp, PoeAPIChatApp, AnthropicChatApp, APITranslationFailure
-from utils import txt_to_html, split_string_by_length, sep, postprocessing, remove_duplicate, gemini_fix
-from utils import validate, remove_header, load_config, remove_leading_numbers, get_leading_numbers
+from apichat import create_chat_app, APITranslationFailure, ResponseAborted
+from utils import txt_to_tags, split_string_by_length, sep, postprocessing, remove_duplicate, gemini_fix
+from utils import validate, validate_partial, remove_header, load_config, remove_leading_numbers, get_leading_numbers
 from utils import has_chinese, fix_repeated_chars, update_content, has_kana, replace_section_titles
-from utils import get_filtered_tags, extract_toc_titles, remove_vertical_rl
-from utils import SqlWrapper, zip_folder_7z, convert_san, concat_kanji_rubi, validate_name_convention
+from utils import extract_toc_titles, remove_vertical_rl, append_item
+from utils import zip_folder_7z, convert_san, validate_name_convention, get_appeared_names, VALIDATOR_VERSION
 from loguru import logger
-from prompt import generate_prompt, change_list, name_convention, sakura_prompt
+from prompt import generate_prompt, name_convention, base_name_convention, sakura_prompt
+from engine import Coalescer, provider_slot, make_chains, run_chains
+from health import provider_health, wait_for_recovery, log_health
+from hedging import Attempt, hedge_deadline, hedged_request
+from epubparser import clean_html_content, clone_soup, extract_paragraphs, extract_segments
+from chaptercache import ChapterCache, chapter_key
+from cache import TranslationCache, glossary_fingerprint, text_hash
+from tm import TranslationMemory
+from cassette import use_cassette
+from accounting import use_ledger, usage_scope
+from chatcontext import ContextRenderer
+from ratelimit import estimate_tokens
+import apichat
 import re
 import warnings
 import yaml
@@ -33,116 +45,165 @@ name_convention[config['JP_TITLE']] = {
     'alias': [config['JP_TITLE']],
     'info': ["标题"]
 }
-
-
-def translate(jp_text, mode="translation", dryrun=False, skip_name_valid=False, context=None):       
+# Not an edit of the glossary, the cached translations of the title stay valid
+base_name_convention[config['JP_TITLE']] = name_convention[config['JP_TITLE']]
+context_renderer = ContextRenderer(name_convention, sakura_prompt)
+memory = None
+if config.get('TRANSLATION_MEMORY'):
+    memory = TranslationMemory(config['TRANSLATION_MEMORY'], book=config['CN_TITLE'],
+                               threshold=config.get('TM_THRESHOLD', 0.7))
+
+
+def translate(jp_text, mode="translation", dryrun=False, skip_name_valid=False, context=None, meta=None):       
+    """
+    meta (dict): If given, filled with the provider, model, mode, latency and token usage of the
+        call that produced the translation, as stored by TranslationCache.put
+
+    Raises:
+        APITranslationFailure: If every provider failed without returning any translation
+    """
     flag = True
+    answer = None
+    cn_text = None
     
     jp_text = fix_repeated_chars(jp_text)
     
     if dryrun:
+        estimate_usage(jp_text, mode=mode, context=context)
         return "待翻译……"
     
     ruuid = uuid.uuid4()
 
     logger.info(f"\n------ {ruuid} JP ------\n\n" + jp_text + "\n------------------------\n\n")
     
-    for name, model in translation_config.items():
+    # Hedged attempts run concurrently: the losers are cancelled, the tokens they generated are billed
+    if config.get('HEDGING', False):
+        cn_text = hedged_translate(jp_text, mode=mode, skip_name_valid=skip_name_valid, context=context,
+                                   meta=meta)
+        flag = cn_text is None
+        if flag:
+            logger.critical(f"-------- {ruuid} Hedged request failed, falling back to sequential translation.")
+    
+    for _ in range(config.get('OUTAGE_ROUNDS', 3)):
+        if not flag:
+            break
+        unavailable = []
+        for name, model in translation_config.items():
+            health = provider_health(name, model)
+            if not health.allow():
+                logger.warning(f"-------- {ruuid} Skipping {name}, circuit open.")
+                unavailable.append(health)
+                continue
         
-        if "Sakura" in name:
-            mode = "sakura"
-        prompt = generate_prompt(jp_text, mode=mode)
-        logger.info(f"\n-------- {ruuid} Prompt --------\n\n" + prompt + "\n------------------------\n\n")
+            if "Sakura" in name:
+                mode = "sakura"
+            prompt = generate_prompt(jp_text, mode=mode)
+            logger.info(f"\n-------- {ruuid} Prompt --------\n\n" + prompt + "\n------------------------\n\n")
     
-        retry_count = model['retry_count']
+            retry_count = model['retry_count']
         
-        logger.info("Translating using " + name + " ...")
+            logger.info("Translating using " + name + " ...")
         
-        ### API translation
-        if model['type'] == 'api':
-            if 'Gemini' in name:
-                api_app = GoogleChatApp(api_key=model['key'], model_name=model['name'])
-            elif 'OpenAI' in name:
-                api_app = OpenAIChatApp(api_key=model['key'], model_name=model['name'], endpoint=model['endpoint'])
-            elif 'Poe' in name:
-                api_app = PoeAPIChatApp(api_key=model['key'], model_name=model['name'])
-            elif 'Claude' in name:
-                api_app = AnthropicChatApp(api_key=model['key'], model_name=model['name'])
-            else:
-                raise ValueError("Invalid model name.")
+            ### API translation
+            if model['type'] == 'api':
+                api_app = create_chat_app(name, model)
+                if api_app is None:
+                    raise ValueError("Invalid model name.")
             
-            if context:
-                api_app.messages = context
+                if context:
+                    api_app.messages = context
+                api_app.guard = lambda partial: validate_partial(jp_text, partial)
             
-            name_violation_count = 0
-            min_violate_count = 10000
-            cn_text_bck = None
-            if "Poe" in name and api_app.messages:
-                # Replace all role assistant by bot
-                for i, message in enumerate(api_app.messages):
-                    if message['role'] == 'assistant':
-                        api_app.messages[i]['role'] = 'bot'
-            else:
-                # Replace all role bot by assistant
-                for i, message in enumerate(api_app.messages):
-                    if message['role'] == 'bot':
-                        api_app.messages[i]['role'] = 'assistant'
-            while flag and retry_count > 0:
-                try:
-                    cn_text = api_app.chat(prompt)
-                    cn_text = remove_header(cn_text)
+                name_violation_count = 0
+                min_violate_count = 10000
+                cn_text_bck = None
+                if "Poe" in name and api_app.messages:
+                    # Replace all role assistant by bot
+                    for i, message in enumerate(api_app.messages):
+                        if message['role'] == 'assistant':
+                            api_app.messages[i]['role'] = 'bot'
+                else:
+                    # Replace all role bot by assistant
+                    for i, message in enumerate(api_app.messages):
+                        if message['role'] == 'bot':
+                            api_app.messages[i]['role'] = 'assistant'
+                while flag and retry_count > 0:
+                    start = time.time()
+                    try:
+                        with provider_slot(name, model):
+                            cn_text = api_app.chat(prompt)
+                        latency = time.time() - start
+                        health.record_success(latency)
+                        answer = {"provider": name, "model": model['name'], "mode": mode, "latency": latency,
+                                  **(api_app.usage or {})}
+                        cn_text = remove_header(cn_text)
                     
-                    valid = validate(jp_text, cn_text, name_convention)
-                    text_new_line_count = cn_text.count("\n")
-                    input_new_line_count = jp_text.count("\n")
-                    if input_new_line_count > 3:
-                        if text_new_line_count / input_new_line_count < 0.5:
-                            retry_count += 1
+                        valid = validate(jp_text, cn_text, name_convention)
+                        text_new_line_count = cn_text.count("\n")
+                        input_new_line_count = jp_text.count("\n")
+                        if input_new_line_count > 3:
+                            if text_new_line_count / input_new_line_count < 0.5:
+                                retry_count += 1
                     
-                    violate_count = validate_name_convention(jp_text, cn_text, name_convention)
-                    valid_name = violate_count == 0
-                    if skip_name_valid:
-                        valid_name = True
-                    if not valid or not valid_name:
-                        if valid and not valid_name:
-                            name_violation_count += 1
-                            logger.critical(f"-------- {ruuid} Violation count {name_violation_count}")
-                            if violate_count < min_violate_count:
-                                min_violate_count = violate_count
-                                cn_text_bck = deepcopy(cn_text)
-                        if 'NAME_VIOLATION_LIMIT' in config and name_violation_count >= config['NAME_VIOLATION_LIMIT']:
-                            cn_text = cn_text_bck
-                            logger.critical(f"-------- {ruuid} Fallback to min violate translation.")
+                        violate_count = validate_name_convention(jp_text, cn_text, name_convention)
+                        valid_name = violate_count == 0
+                        if skip_name_valid:
+                            valid_name = True
+                        if not valid or not valid_name:
+                            if valid and not valid_name:
+                                name_violation_count += 1
+                                logger.critical(f"-------- {ruuid} Violation count {name_violation_count}")
+                                if violate_count < min_violate_count:
+                                    min_violate_count = violate_count
+                                    cn_text_bck = deepcopy(cn_text)
+                            if 'NAME_VIOLATION_LIMIT' in config and name_violation_count >= config['NAME_VIOLATION_LIMIT']:
+                                cn_text = cn_text_bck
+                                logger.critical(f"-------- {ruuid} Fallback to min violate translation.")
+                                flag = False
+                                break
+                            logger.critical(f"-------- {ruuid} API invalid response: ---------\n" + cn_text)
+                        else:
                             flag = False
+                    # finally:
+                    #     pass
+                    except APITranslationFailure as e:
+                        if isinstance(e, ResponseAborted):
+                            # Keep the rejected output, as with a complete but invalid response
+                            cn_text = remove_header(e.partial)
+                        else:
+                            health.record_failure(outage="503 Service Unavailable" in str(e))
+                        if "Connection error" in str(e) and retry_count == 1:
+                            raise
+                        if "rate limit" in str(e):
+                            retry_count += 1
+                        logger.critical(f"-------- {ruuid} API translation failed: {e} ----------")
+                        if not health.allow():
+                            # Route the segment to the next provider while this one recovers
+                            unavailable.append(health)
                             break
-                        logger.critical(f"-------- {ruuid} API invalid response: ---------\n" + cn_text)
-                    else:
-                        flag = False
-                # finally:
-                #     pass
-                except APITranslationFailure as e:
-                    if "Connection error" in str(e) and retry_count == 1:
-                        raise
-                    if "rate limit" in str(e):
-                        retry_count += 1
-                    if "503 Service Unavailable" in str(e):
-                        retry_count += 1
-                        # Sleep for 10 minutes
-                        time.sleep(600)
-                    logger.critical(f"-------- {ruuid} API translation failed: {e} ----------")
-                    pass
-                retry_count -= 1
+                    retry_count -= 1
                 
-        if not flag:
-            break
+            if not flag:
+                break
                 
-        ### Web translation
-        elif model['type'] == 'web':
-            raise ValueError("Web translation is not supported.")
+            ### Web translation
+            elif model['type'] == 'web':
+                raise ValueError("Web translation is not supported.")
                 
-        if not flag:
+            if not flag:
+                break
+
+        if not flag or not unavailable:
             break
-        
+        logger.warning(f"-------- {ruuid} No healthy provider left, waiting for one to recover ...")
+        wait_for_recovery(unavailable)
+
+    if cn_text is None:
+        raise APITranslationFailure(f"No provider returned a translation for {ruuid}.")
+
+    if meta is not None and answer is not None and flag is False:
+        meta.update(answer)
+
     # Fix san
     cn_text = convert_san(cn_text, name_convention=name_convention)
     logger.info(f"\n-------- {ruuid} CN ------\n\n" + cn_text + "\n------------------------\n\n")
@@ -150,6 +211,86 @@ def translate(jp_text, mode="translation", dryrun=False, skip_name_valid=False,
     return cn_text
 
 
+def estimate_usage(jp_text, mode="translation", context=None):
+    """
+    Record in the usage ledger what translating a segment would cost with the first API provider.
+
+    Translations in the context of a dry run are placeholders, each counts as long as its prompt.
+    """
+    if apichat.ledger is None:
+        return
+    for name, model in translation_config.items():
+        if model['type'] == 'api':
+            prompt = generate_prompt(jp_text, mode="sakura" if "Sakura" in name else mode)
+            context_tokens = 2 * sum(estimate_tokens(m['content']) for m in context or [] if m['role'] == 'user')
+            apichat.ledger.estimate(name, model, estimate_tokens(prompt) + context_tokens, estimate_tokens(jp_text))
+            return
+
+
+def hedged_translate(jp_text, mode="translation", skip_name_valid=False, context=None, meta=None):
+    """
+    Translate with every healthy API provider as one hedged request.
+
+    The next provider is only asked once the previous one is slower than its usual latency
+    (the HEDGE_PERCENTILE of its recent calls), and the first valid translation wins. Attempts are
+    streamed so the others are cancelled right away, the tokens they generated until then are billed.
+    """
+    def make_attempt(name, model, health):
+        api_app = create_chat_app(name, model)
+        if api_app is None:
+            raise ValueError("Invalid model name.")
+        if context:
+            # Each attempt runs concurrently, so it gets its own copy of the context
+            api_app.messages = deepcopy(context)
+            role_from, role_to = ('assistant', 'bot') if "Poe" in name else ('bot', 'assistant')
+            for message in api_app.messages:
+                if message['role'] == role_from:
+                    message['role'] = role_to
+        api_app.guard = lambda partial: validate_partial(jp_text, partial)
+        # Cancelling only takes effect between streamed chunks, so a losing attempt stops generating
+        # (and being billed), frees its provider slot and stops drawing rate-limit tokens at once
+        api_app.stream = True
+        attempt_mode = "sakura" if "Sakura" in name else mode
+        prompt = generate_prompt(jp_text, mode=attempt_mode)
+
+        def call():
+            with provider_slot(name, model):
+                start = time.time()
+                try:
+                    cn_text = api_app.chat(prompt)
+                except APITranslationFailure as e:
+                    if not isinstance(e, ResponseAborted):
+                        health.record_failure(outage="503 Service Unavailable" in str(e))
+                    raise
+                latency = time.time() - start
+                health.record_success(latency)
+            answers[name] = {"provider": name, "model": model['name'], "mode": attempt_mode, "latency": latency,
+                             **(api_app.usage or {})}
+            return cn_text
+
+        deadline = hedge_deadline(health, percentile=config.get('HEDGE_PERCENTILE', 0.95),
+                                  default=config.get('HEDGE_DEADLINE', 60))
+        return Attempt(name, call, api_app.cancel, deadline)
+
+    def accept(name, cn_text):
+        cn_text = remove_header(cn_text)
+        if not validate(jp_text, cn_text, name_convention):
+            return None
+        if not skip_name_valid and validate_name_convention(jp_text, cn_text, name_convention) != 0:
+            return None
+        if meta is not None:
+            meta.update(answers[name])
+        return cn_text
+
+    answers = {}
+    attempts = []
+    for name, model in translation_config.items():
+        health = provider_health(name, model)
+        if model['type'] == 'api' and health.allow():
+            attempts.append(make_attempt(name, model, health))
+    return hedged_request(attempts, accept)
+
+
 def post_translate(cn_text):
     lines = []
     for line in cn_text.split('\n'):
@@ -162,19 +303,642 @@ def post_translate(cn_text):
     return "\n".join(lines)
 
 
+def build_context(prev_jp_text, prev_cn_text, jp_text=None):
+    """Context turns of the previous segments, for translating `jp_text` when given (see ContextRenderer)."""
+    return context_renderer.render(prev_jp_text, prev_cn_text, jp_text=jp_text)
+
+
+def cached_translation(jp_text, buffer, dryrun=False):
+    """Cached translation of a segment, else one assembled from the line cache, stored unless `dryrun`."""
+    cn_text = buffer.get(jp_text)
+    assembled = False
+    if cn_text is None:
+        # Segmented differently before, use the translations of its lines if all of them are known
+        lines = buffer.cover(jp_text)
+        if None not in lines:
+            cn_text = "\n".join(lines)
+            assembled = True
+    if cn_text is None:
+        return None
+    if assembled:
+        if not validate(jp_text, cn_text, name_convention):
+            return None
+        if not dryrun:
+            buffer.put(jp_text, cn_text, provider="line-cache", verdict=verdict_of(jp_text, name_convention),
+                       names=get_appeared_names(jp_text, name_convention))
+        return cn_text
+    return cn_text if verified(buffer, jp_text, cn_text, name_convention) else None
+
+
+def verdict_of(jp_text, glossary):
+    return f"{VALIDATOR_VERSION}:{glossary_fingerprint(jp_text, glossary) or '-'}"
+
+
+def verified(buffer, jp_text, cn_text, glossary):
+    """
+    validate() the cached translation of a segment, unless the same validator version already
+    accepted it with the same glossary entries, and record the verdict when it passes.
+    """
+    verdict = verdict_of(jp_text, glossary)
+    if buffer.verdict(jp_text) == verdict:
+        return True
+    if not validate(jp_text, cn_text, glossary):
+        return False
+    buffer.set_verdict(jp_text, verdict)
+    return True
+
+
+def cached_lines(jp_text, buffer):
+    """Translation of every line of a segment from the line cache, None for the lines to translate."""
+    return buffer.cover(jp_text)
+
+
+def store_translation(buffer, jp_text, cn_text, meta):
+    """Store a translation with how it was produced and the glossary entries it was translated with."""
+    buffer.put(jp_text, cn_text, glossary=glossary_fingerprint(jp_text, name_convention),
+               names=get_appeared_names(jp_text, name_convention), **meta)
+
+
+def invalidate_stale_glossary(buffer):
+    """
+    Delete the cached translations made with glossary entries edited since, and the cached chapters
+    built from them, reporting what they cost.
+    """
+    impact = buffer.glossary_impact(name_convention, base_name_convention)
+    if impact:
+        names = sorted({name for _, changed, _ in impact.values() for name in changed})
+        logger.info(f"Glossary changed ({', '.join(names)}): {len(impact)} cached segments will be translated "
+                    f"again, about {sum(tokens for _, _, tokens in impact.values())} tokens")
+        buffer.delete_entries(impact)
+    buffer.apply_glossary(name_convention)
+
+
+def recall(jp_text):
+    """
+    Look a segment up in the series translation memory.
+
+    Returns:
+        tuple: (translation of the same text if it is still valid, context of similar segments)
+    """
+    matches = memory.lookup(jp_text, limit=config.get('TM_FEW_SHOT', 2))
+    if matches and matches[0].exact:
+        cn_text = matches[0].translation
+        if validate(jp_text, cn_text, name_convention) \
+                and validate_name_convention(jp_text, cn_text, name_convention) == 0:
+            logger.info(f"Reusing the translation of {matches[0].book} from the translation memory")
+            return cn_text, None
+        return None, None
+    if matches:
+        logger.info(f"Translating with {len(matches)} similar segments from the translation memory "
+                    f"(similarity {', '.join(f'{match.similarity:.2f}' for match in matches)})")
+    return None, build_context([match.source for match in matches], [match.translation for match in matches],
+                               jp_text=jp_text)
+
+
+def add_usage(total, meta):
+    """Add the latency and token usage of a translation to `total`, which keeps its provider and model."""
+    for key, value in meta.items():
+        if key in ("latency", "prompt_tokens", "completion_tokens"):
+            total[key] = total.get(key, 0) + (value or 0)
+        else:
+            total[key] = value
+
+
+def translate_segment(jp_text, context=None, dryrun=False, meta=None, lines=None):
+    """
+    Translate a paragraph segment.
+
+    lines (list): Known translation of each line (`cached_lines`). If some are known, only the runs of
+        consecutive unknown lines are translated, and the whole segment if a run is translated to
+        a different number of lines. `meta` then adds up the usage of every request.
+    """
+    if lines is not None and not dryrun and None in lines and any(lines):
+        jp_lines = jp_text.split("\n")
+        logger.info(f"Translating {lines.count(None)} of {len(jp_lines)} lines, the others are in the line cache")
+        cn_lines = []
+        usage = {}
+        i = 0
+        while i < len(jp_lines):
+            if lines[i] is not None:
+                cn_lines.append(lines[i])
+                i += 1
+                continue
+            j = i
+            while j < len(jp_lines) and lines[j] is None:
+                j += 1
+            run_meta = {}
+            cn_run = translate_segment("\n".join(jp_lines[i:j]), context=context, meta=run_meta)
+            add_usage(usage, run_meta)
+            cn_run = [line.strip() for line in cn_run.split("\n") if line.strip()]
+            if len(cn_run) != j - i:
+                # Joined as is, every later line would be paired with the wrong source line
+                logger.warning(f"Got {len(cn_run)} lines for {j - i} uncached lines, translating the whole segment")
+                whole_meta = {}
+                cn_text = translate_segment(jp_text, context=context, meta=whole_meta)
+                add_usage(usage, whole_meta)
+                if meta is not None:
+                    meta.update(usage)
+                return cn_text
+            cn_lines += cn_run
+            i = j
+        if meta is not None:
+            meta.update(usage)
+        return "\n".join(cn_lines)
+
+    if memory is not None and not dryrun:
+        cn_text, examples = recall(jp_text)
+        if cn_text is not None:
+            if meta is not None:
+                meta.update(provider="translation-memory", mode="exact")
+            return cn_text
+        if examples:
+            context = examples + (context or [])
+    cn_text = translate(
+        jp_text,
+        dryrun=dryrun,
+        context=context,
+        skip_name_valid=False,
+        meta=meta
+    )
+    cn_text = gemini_fix(cn_text)
+    cn_text = post_translate(cn_text)
+    cn_text = remove_duplicate(cn_text)
+    if memory is not None and not dryrun and validate(jp_text, cn_text, name_convention):
+        memory.add(jp_text, cn_text)
+    return cn_text
+
+
+def is_chapter(item):
+    return isinstance(item, epub.EpubHtml) and not isinstance(item, epub.EpubNav) \
+        and "TOC" not in item.id and "toc" not in item.id
+
+
+def translate_toc_titles(book, title_buffer, dryrun=False):
+    jp_titles = extract_toc_titles(book)
+    output = ""
+    for i, name in enumerate(jp_titles):
+        output += str(i) + " " + name + "\n"
+    jp_titles_parts = split_string_by_length(output, config["TITLE_SPLIT_LEN"])
+
+    # Traverse the aggregated chapter titles
+    prev_jp_text = []
+    prev_cn_text = []
+
+    for jp_text in jp_titles_parts:
+        jp_titles_ = jp_text.strip().split('\n')
+        if len(jp_text.strip()) == 0:
+            continue
+        new_jp_titles = []
+        # Concatenate title to the previous one if it's a continuation
+        for jp_title in jp_titles_:
+            if jp_title[0].isdigit():
+                new_jp_titles.append(jp_title)
+            else:
+                new_jp_titles[-1] += jp_title
+        jp_titles_ = new_jp_titles
+
+        start_idx = get_leading_numbers(jp_titles_[0])
+        end_idx = get_leading_numbers(jp_titles_[-1])
+
+        if not all([remove_leading_numbers(title) in title_buffer for title in jp_titles_]):
+            cn_titles_ = []
+            title_retry_count = config['TRANSLATION_TITLE_RETRY_COUNT'] + 1
+
+            while len(cn_titles_) != len(jp_titles_) and title_retry_count > 0:
+                ### Start translation
+                if not has_kana(jp_text) and not has_chinese(jp_text):
+                    cn_text = jp_text
+                elif dryrun:
+                    if jp_text not in title_buffer:
+                        estimate_usage(jp_text, mode="title_translation",
+                                       context=build_context(prev_jp_text, prev_cn_text))
+                    cn_text = jp_text
+                elif jp_text in title_buffer and verified(title_buffer, jp_text, title_buffer[jp_text],
+                                                          name_convention):
+                    cn_text = title_buffer[jp_text]
+                else:
+                    context = build_context(prev_jp_text, prev_cn_text)
+                    meta = {}
+                    cn_text = translate(
+                        jp_text,
+                        mode="title_translation",
+                        dryrun=dryrun,
+                        skip_name_valid=False,
+                        context=context,
+                        meta=meta,
+                    )
+                    store_translation(title_buffer, jp_text, cn_text, meta)
+                ### Translation finished
+
+                ### Match translated title to the corresponding indices
+                cn_text = postprocessing(cn_text)
+                cn_titles_ = cn_text.strip().split('\n')
+                cn_titles_ = [title for title in cn_titles_ if get_leading_numbers(title) is not None]
+                if len(cn_titles_) == 0:
+                    continue
+                if get_leading_numbers(cn_titles_[0]) == start_idx and \
+                    get_leading_numbers(cn_titles_[-1]) == end_idx and \
+                        len(cn_titles_) == len(jp_titles_) and validate(jp_text, cn_text, name_convention):
+                    break
+                else:
+                    title_retry_count -= 1
+
+            if len(cn_titles_) != len(jp_titles_):
+                logger.error("Title translation failed.")
+                cn_titles_ = jp_titles_
+
+            prev_jp_text.append(jp_text)
+            prev_cn_text.append(cn_text)
+            if len(prev_jp_text) > config["TITLE_CONTEXT_LEN"]:
+                prev_jp_text.pop(0)
+                prev_cn_text.pop(0)
+
+            if not dryrun:
+                for cn_title, jp_title in zip(cn_titles_, jp_titles_):
+                    if not has_kana(jp_title) and not has_chinese(jp_title):
+                        cn_title = jp_title
+                    title_buffer[remove_leading_numbers(jp_title)] = remove_leading_numbers(cn_title)
+
+    return jp_titles
+
+
+def load_reusable_chapters(book, chapter_cache, title_buffer):
+    """
+    Return the cached artifacts of the chapters whose inputs did not change since they were built.
+    """
+    reused = {}
+    for item in book.get_items():
+        if is_chapter(item):
+            artifact = chapter_cache.get(item.id, item.content.decode("utf-8"), config, name_convention,
+                                         title_buffer)
+            if artifact is not None:
+                reused[item.id] = artifact
+    logger.info(f"Reusing {len(reused)} unchanged chapters")
+    return reused
+
+
+def extract_book(book, reused=None):
+    """
+    Pass 1: extract the segments of every chapter of the book, except the reused ones.
+
+    Returns the segments, and the translation context each chapter following reused chapters
+    starts with.
+    """
+    reused = reused or {}
+    segments = []
+    contexts = {}
+    tail = None
+    for item in book.get_items():
+        if not is_chapter(item):
+            continue
+        if item.id in reused:
+            if reused[item.id]["tail"] is not None:
+                tail = reused[item.id]["tail"]
+            continue
+        soup = clean_html_content(item.content.decode("utf-8"), config, item.id)
+        item_segments = extract_segments(item.id, soup, config)
+        if item_segments and tail is not None:
+            contexts[item.id] = tail
+            tail = None
+        segments += item_segments
+    return segments, contexts
+
+
+def prefetch_translations(segments, buffer, concurrency, independent=False):
+    """
+    Translate all uncached paragraph segments with `concurrency` segments in flight and store them
+    in the buffer, so the sequential translation pass only hits the cache.
+
+    By default each chapter is a chain translated in order with its own previous-segment context, and
+    chapters run in parallel. In independent mode every segment is translated without context.
+    """
+    chapters = {}
+    chapter_of = {}
+    for segment in segments:
+        if segment.kind == "p" and len(segment.jp_text.strip()) != 0:
+            chapters.setdefault(segment.item_id, []).append(segment.jp_text)
+            chapter_of.setdefault(segment.jp_text, segment.item_id)
+    chapters = list(chapters.values())
+
+    cached = {}
+    covered = {}
+    for chapter in chapters:
+        for jp_text in chapter:
+            if not has_kana(jp_text) and not has_chinese(jp_text):
+                cached[jp_text] = jp_text
+            elif jp_text not in cached:
+                cn_text = cached_translation(jp_text, buffer)
+                if cn_text is not None:
+                    cached[jp_text] = cn_text
+                else:
+                    covered[jp_text] = cached_lines(jp_text, buffer)
+
+    if all(jp_text in cached for chapter in chapters for jp_text in chapter):
+        return
+    logger.info(f"Translating uncached segments with concurrency {concurrency} ...")
+
+    def worker(jp_text, history):
+        if jp_text in cached:
+            return cached[jp_text]
+        context = None
+        if not independent:
+            history = [(pj, pc) for pj, pc in history if pc is not None][-config["CONTEXT_LEN"]:]
+            context = build_context(
+                [pj for pj, _ in history],
+                [postprocessing(pc, verbose=False) for _, pc in history],
+                jp_text=jp_text
+            )
+        def translate_once():
+            meta = {}
+            with usage_scope("body", chapter_of[jp_text]):
+                cn_text = translate_segment(jp_text, context=context, meta=meta, lines=covered.get(jp_text))
+            metas[jp_text] = meta
+            return cn_text
+
+        try:
+            # A segment repeated in chapters translated in parallel is requested once
+            return inflight.run(jp_text, translate_once)
+        except APITranslationFailure as e:
+            logger.critical(f"Segment translation failed, retrying sequentially later: {e}")
+            return None
+
+    def on_result(jp_text, cn_text):
+        if cn_text is not None and jp_text not in cached:
+            store_translation(buffer, jp_text, cn_text, metas.pop(jp_text, {}))
+            cached[jp_text] = cn_text
+
+    metas = {}
+    inflight = Coalescer()
+    run_chains(
+        make_chains(chapters, independent=independent),
+        worker,
+        on_result=on_result,
+        max_workers=concurrency,
+        desc="Prefetch"
+    )
+
+
+def translate_book(segments, buffer, title_buffer, dryrun=False, contexts=None):
+    """
+    Pass 2: fill `cn_text` of every segment from the buffers or by translating it in order.
+
+    Returns the translation context at the end of every chapter whose segments all have a valid
+    translation, the chapters that can be stored in the chapter cache.
+    """
+    prev_jp_text = []
+    prev_cn_text = []
+    item_ids = list(dict.fromkeys(segment.item_id for segment in segments))
+    current_item = None
+    contexts = contexts or {}
+    tails = {}
+    invalid = set()
+
+    for segment in tqdm(segments, unit="seg"):
+        if segment.item_id != current_item:
+            if current_item is not None:
+                tails[current_item] = [list(prev_jp_text), list(prev_cn_text)]
+            current_item = segment.item_id
+            if current_item in contexts:
+                prev_jp_text, prev_cn_text = (list(texts) for texts in contexts[current_item])
+            logger.info(f"Translating {current_item} ({item_ids.index(current_item)}/{len(item_ids)}) ...")
+
+        jp_text = segment.jp_text
+        # Handle paragraph
+        if segment.kind == "p":
+            if len(jp_text.strip()) == 0:
+                cn_text = ""
+            elif (not has_kana(jp_text) and not has_chinese(jp_text)):
+                cn_text = jp_text
+            else:
+                cn_text = cached_translation(jp_text, buffer, dryrun=dryrun)
+                if cn_text is None:
+                    ### Start translation
+                    context = build_context(prev_jp_text, prev_cn_text, jp_text=jp_text)
+                    meta = {}
+                    with usage_scope("body", current_item):
+                        cn_text = translate_segment(jp_text, context=context, dryrun=dryrun, meta=meta,
+                                                    lines=cached_lines(jp_text, buffer))
+                    ### Translation finished
+
+                    if not dryrun:
+                        store_translation(buffer, jp_text, cn_text, meta)
+                    if dryrun or not verified(buffer, jp_text, cn_text, name_convention):
+                        invalid.add(current_item)
+
+            cn_text = postprocessing(cn_text, verbose=not dryrun)
+            prev_jp_text.append(jp_text)
+            prev_cn_text.append(cn_text)
+            if len(prev_jp_text) > config["CONTEXT_LEN"]:
+                prev_jp_text.pop(0)
+                prev_cn_text.pop(0)
+
+        # Handle titles
+        else:
+            if len(jp_text.strip()) == 0:
+                cn_text = ""
+            elif jp_text in title_buffer and verified(title_buffer, jp_text, title_buffer[jp_text], None):
+                cn_text = title_buffer[jp_text]
+            elif not has_kana(jp_text) or "作者" in jp_text:
+                cn_text = jp_text
+            else:
+                ### Start translation
+                meta = {}
+                with usage_scope("titles", current_item):
+                    cn_text = translate(jp_text, dryrun=dryrun, skip_name_valid=True, meta=meta)
+                ### Translation finished
+                store_translation(title_buffer, jp_text, cn_text, meta)
+                if dryrun or not verified(title_buffer, jp_text, cn_text, None):
+                    invalid.add(current_item)
+            cn_text = postprocessing(cn_text)
+
+        segment.cn_text = cn_text
+
+    if current_item is not None:
+        tails[current_item] = [list(prev_jp_text), list(prev_cn_text)]
+    return {item_id: tail for item_id, tail in tails.items() if item_id not in invalid}
+
+
+def assemble_item(item, segments):
+    """
+    Rebuild the bilingual and the Chinese-only soup of a chapter from its translated segments.
+
+    The chapter is parsed once, and the Chinese-only soup is cloned from it.
+    """
+    soup = clean_html_content(item.content.decode("utf-8"), config, item.id)
+
+    if soup.body.find(["p", "h1", "h2", "h3", "h4", "h5", "h6"]):
+        groups = {}
+        for segment in segments:
+            groups.setdefault(segment.locator, []).append(segment)
+
+        paragraphs = extract_paragraphs(soup)
+        cn_soup, clones = clone_soup(soup)
+        for locator_idx, (_, name, ps) in enumerate(paragraphs):
+            locator = ps[0]
+            if locator.parent is None:
+                continue
+            ps_ = [clones[id(p_tag)] for p_tag in ps]
+            locator_ = ps_[0]
+            parts = groups.get(locator_idx, [])
+
+            # Handle paragraph
+            if name == "p":
+                decomposable = len(parts) > 0
+                for segment in parts:
+                    decomposable = len(segment.jp_text.strip()) > 0
+
+                    locator.insert_before(*txt_to_tags(soup, segment.jp_text))
+                    if decomposable:
+                        locator.insert_before(sep())
+                    locator.insert_before(*txt_to_tags(soup, segment.cn_text))
+                    if decomposable:
+                        locator.insert_before(sep())
+
+                    for img in segment.imgs:
+                        locator_.insert_before(BeautifulSoup(img, "html5lib").find("img"))
+                    locator_.insert_before(*txt_to_tags(cn_soup, segment.cn_text))
+
+                # Removing all <p> elements within the <body> tag
+                if decomposable:
+                    for p_tag in ps_ + ps:  # Combining the lists for simplicity
+                        imgs = p_tag.find_all("img")
+                        if not imgs:  # If there are no <img> tags, decompose the <p> tag
+                            p_tag.decompose()
+
+            # Handle titles
+            else:
+                segment = parts[0]
+                decomposable = len(segment.jp_text.strip()) > 0
+
+                locator.insert_before(*txt_to_tags(soup, segment.jp_text, tag=name))
+                locator.insert_before(soup.new_tag("br"))
+                locator.insert_before(*txt_to_tags(soup, segment.cn_text, tag=name))
+
+                locator_.insert_before(*txt_to_tags(cn_soup, segment.cn_text, tag=name))
+
+                if decomposable:
+                    for p_tag in ps_ + ps:  # Combining the lists for simplicity
+                        p_tag.decompose()
+    else:
+        cn_soup, _ = clone_soup(soup)
+        for s in [soup, cn_soup]:
+            # Now, check for SVG parent and alter if necessary
+            for svg in s.find_all("svg"):
+                parent = svg.parent
+                position_in_parent = parent.contents.index(svg)
+                svg.extract()
+                for image in svg.find_all("image"):
+                    new_img = soup.new_tag("img")  # Create a new <img> tag
+                    if 'width' in image.attrs:
+                        new_img['width'] = "100%"
+                    if 'height' in image.attrs:
+                        new_img['height'] = "auto"
+                    if 'xlink:href' in image.attrs:
+                        new_img['src'] = image['xlink:href']
+                    image.replace_with(new_img)
+
+                # Reinsert the contents of the original SVG in their original position
+                for content in reversed(svg.contents):
+                    if isinstance(content, str) and not content.strip():
+                        # Skip adding empty strings that might have been just whitespace
+                        continue
+                    parent.insert(position_in_parent, content)
+
+    return soup, cn_soup
+
+
+def assemble_book(book, segments, title_buffer, jp_titles, modified_book, cn_book,
+                  chapter_cache=None, reused=None, finished=None):
+    """
+    Pass 3: build the bilingual and the Chinese-only books from the translated segments.
+
+    Reused chapters are copied from the chapter cache, and the finished chapters (as returned by
+    `translate_book`) are stored in it.
+    """
+    reused = reused or {}
+    finished = finished or {}
+    item_segments = {}
+    for segment in segments:
+        item_segments.setdefault(segment.item_id, []).append(segment)
+
+    for item in tqdm(book.get_items(), unit="item"):
+        # Check if item is CSS
+        if item.media_type == "text/css":
+            css_content = item.content.decode('utf-8')
+            # Remove vertical-rl properties
+            modified_css = remove_vertical_rl(css_content)
+            item.content = modified_css.encode('utf-8')
+
+        if is_chapter(item) and item.id in reused:
+            artifact = reused[item.id]
+            append_item(item, modified_book, artifact["cnjp"].encode("utf-8"), artifact["stylesheets"])
+            append_item(item, cn_book, artifact["cn"].encode("utf-8"), artifact["stylesheets"])
+
+        elif is_chapter(item):
+            soup, cn_soup = assemble_item(item, item_segments.get(item.id, []))
+            # Link texts replaced by their translations below
+            links = [a_tag.get_text() for s in [soup, cn_soup] for a_tag in s.find_all('a')]
+            cnjp, stylesheets = update_content(item, modified_book, title_buffer, soup)
+            cn, _ = update_content(item, cn_book, title_buffer, cn_soup)
+            # Chapters without any segment have nothing to translate and are always complete
+            if chapter_cache is not None and (item.id in finished or item.id not in item_segments):
+                paragraphs = [segment for segment in item_segments.get(item.id, []) if segment.kind == "p"]
+                headings = [segment.jp_text for segment in item_segments.get(item.id, []) if segment.kind != "p"]
+                text = "\n".join([segment.jp_text for segment in paragraphs] + headings)
+                titles = list(dict.fromkeys(headings + links))
+                key = chapter_key(item.content.decode("utf-8"), config, name_convention, title_buffer, text, titles)
+                chapter_cache.put(item.id, key, cnjp.decode("utf-8"), cn.decode("utf-8"), stylesheets,
+                                  finished.get(item.id), text=text, titles=titles,
+                                  segments=[text_hash(segment.jp_text) for segment in paragraphs])
+
+        ### Handle TOC and Ncx updates
+        elif isinstance(item, epub.EpubNcx) or \
+        (isinstance(item, epub.EpubHtml) and ("TOC" in item.id or "toc" in item.id)):
+
+            # Update titles to CN titles or CN+JP titles in TOC
+            content = item.content.decode("utf-8")
+            cn_content = deepcopy(content)
+            jp_titles.sort(key=lambda x: len(x), reverse=True)
+            for jp_title in jp_titles:
+                if jp_title in title_buffer:
+                    cn_title = title_buffer[jp_title]
+                    content = content.replace(jp_title, cn_title)
+                    cn_content = cn_content.replace(jp_title, cn_title)
+
+            update_content(item, modified_book, title_buffer, content)
+            update_content(item, cn_book, title_buffer, cn_content)
+
+        else:
+            # Copy other items
+            modified_book.items.append(item)
+            cn_book.items.append(item)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--dryrun", action="store_true")
     parser.add_argument("--cn-title", type=str)
     parser.add_argument("--jp-title", type=str)
+    parser.add_argument("--concurrency", type=int, default=config.get('CONCURRENCY', 1))
+    parser.add_argument("--independent", action="store_true")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild every chapter, ignoring the chapter cache")
+    parser.add_argument("--record", type=str, help="Record every provider call to this cassette file")
+    parser.add_argument("--replay", type=str, help="Answer provider calls from this cassette file, offline")
+    parser.add_argument("--replay-latency", action="store_true", help="Wait as long as the recorded calls took")
     
     args = parser.parse_args()
+    if args.record or args.replay:
+        use_cassette(args.replay or args.record, mode="replay" if args.replay else "record",
+                     latency=args.replay_latency)
     if args.cn_title:
         config['CN_TITLE'] = args.cn_title
     if args.jp_title:
         config['JP_TITLE'] = args.jp_title
     
     logger.add(f"output/{config['CN_TITLE']}/info.log", colorize=True, level="DEBUG")
+    ledger = use_ledger(f"output/{config['CN_TITLE']}/usage.db", book=config['CN_TITLE'])
+    if memory is not None:
+        memory.book = config['CN_TITLE']
 
     # Open the EPUB file
     book = epub.read_epub(f"output/{config['CN_TITLE']}/input.epub", {"ignore_ncx": False})
@@ -183,376 +947,41 @@ def main():
     cn_book = deepcopy(book)
     cn_book.items = []
 
-    with SqlWrapper(f"output/{config['CN_TITLE']}/buffer.db") as buffer, \
-         SqlWrapper(f"output/{config['CN_TITLE']}/title_buffer.db") as title_buffer:
+    with ChapterCache(f"output/{config['CN_TITLE']}/chapter_cache.db") as chapter_cache, \
+         TranslationCache(f"output/{config['CN_TITLE']}/buffer.db", chapter_cache=chapter_cache,
+                          flush_interval=config.get('BUFFER_FLUSH_INTERVAL', 5)) as buffer, \
+         TranslationCache(f"output/{config['CN_TITLE']}/title_buffer.db") as title_buffer:
 
-        # Iterate through each item in the book (chapters, sections, etc.)
+        if config.get('CACHE_PRELOAD_MB', 256):
+            title_buffer.preload(max_mb=config.get('CACHE_PRELOAD_MB', 256))
         title_buffer[config['JP_TITLE']] = config['CN_TITLE']
 
         ############ Translate the chapter titles ############
-        jp_titles = extract_toc_titles(book)
-        output = ""
-        for i, name in enumerate(jp_titles):
-            output += str(i) + " " + name + "\n"
-        jp_titles_parts = split_string_by_length(output, config["TITLE_SPLIT_LEN"])
-
-        # Traverse the aggregated chapter titles
-        prev_jp_text = []
-        prev_cn_text = []
-
-        for jp_text in jp_titles_parts:
-            jp_titles_ = jp_text.strip().split('\n')
-            if len(jp_text.strip()) == 0:
-                continue
-            new_jp_titles = []
-            # Concatenate title to the previous one if it's a continuation
-            for jp_title in jp_titles_:
-                if jp_title[0].isdigit():
-                    new_jp_titles.append(jp_title)
-                else:
-                    new_jp_titles[-1] += jp_title
-            jp_titles_ = new_jp_titles
-
-            start_idx = get_leading_numbers(jp_titles_[0])
-            end_idx = get_leading_numbers(jp_titles_[-1])
-
-            if not all([remove_leading_numbers(title) in title_buffer for title in jp_titles_]):
-                cn_titles_ = []
-                title_retry_count = config['TRANSLATION_TITLE_RETRY_COUNT'] + 1
-
-                while len(cn_titles_) != len(jp_titles_) and title_retry_count > 0:
-                    ### Start translation
-                    if (not has_kana(jp_text) and not has_chinese(jp_text)) or args.dryrun:
-                        cn_text = jp_text
-                    elif jp_text in title_buffer and validate(jp_text, title_buffer[jp_text], name_convention):
-                        cn_text = title_buffer[jp_text]
-                    else:
-                        context = []
-                        for pj, pc in zip(prev_jp_text, prev_cn_text):
-                            context += [
-                                {"role": "user", "content": sakura_prompt(pj, name_convention, mode="soft")},
-                                {"role": "bot", "content": pc},
-                            ]
-                        if context == []:
-                            context = None
-                        cn_text = translate(
-                            jp_text,
-                            mode="title_translation",
-                            dryrun=args.dryrun,
-                            skip_name_valid=False,
-                            context=context,
-                        )
-                        title_buffer[jp_text] = cn_text
-                    ### Translation finished
-
-                    ### Match translated title to the corresponding indices
-                    cn_text = postprocessing(cn_text)
-                    cn_titles_ = cn_text.strip().split('\n')
-                    cn_titles_ = [title for title in cn_titles_ if get_leading_numbers(title) is not None]
-                    if len(cn_titles_) == 0:
-                        continue
-                    if get_leading_numbers(cn_titles_[0]) == start_idx and \
-                        get_leading_numbers(cn_titles_[-1]) == end_idx and \
-                            len(cn_titles_) == len(jp_titles_) and validate(jp_text, cn_text, name_convention):
-                        break
-                    else:
-                        title_retry_count -= 1
-
-                if len(cn_titles_) != len(jp_titles_):
-                    logger.error("Title translation failed.")
-                    cn_titles_ = jp_titles_
-
-                prev_jp_text.append(jp_text)
-                prev_cn_text.append(cn_text)
-                if len(prev_jp_text) > config["TITLE_CONTEXT_LEN"]:
-                    prev_jp_text.pop(0)
-                    prev_cn_text.pop(0)
-
-                if not args.dryrun:
-                    for cn_title, jp_title in zip(cn_titles_, jp_titles_):
-                        if not has_kana(jp_title) and not has_chinese(jp_title):
-                            cn_title = jp_title
-                        title_buffer[remove_leading_numbers(jp_title)] = remove_leading_numbers(cn_title)
-
+        with usage_scope("titles"):
+            jp_titles = translate_toc_titles(book, title_buffer, dryrun=args.dryrun)
         replace_section_titles(cn_book.toc, title_buffer)
         replace_section_titles(modified_book.toc, title_buffer, cnjp=True)
 
-        total_items = 0
-        for item in tqdm(list(book.get_items())):
-            if isinstance(item, epub.EpubHtml) and not isinstance(item, epub.EpubNav) \
-            and "TOC" not in item.id and "toc" not in item.id:
-                total_items += 1
-        current_items = 0
-        prev_jp_text = []
-        prev_cn_text = []
-
-        ############ Translate the chapters and TOCs ############
-        for item in tqdm(book.get_items(), total=total_items, unit="item"):
-            # Check if item is CSS
-            if item.media_type == "text/css":
-                css_content = item.content.decode('utf-8')
-                # Remove vertical-rl properties
-                modified_css = remove_vertical_rl(css_content)
-                item.content = modified_css.encode('utf-8')
-            
-            if isinstance(item, epub.EpubHtml) and not isinstance(item, epub.EpubNav) \
-            and "TOC" not in item.id and "toc" not in item.id:
-                logger.info(f"Translating {item.id} ({current_items}/{total_items}) ...")
-                current_items += 1
-
-                content = item.content.decode("utf-8")
-                # Parse HTML and extract text
-                soup = BeautifulSoup(item.content.decode("utf-8"), "html5lib")
-                cn_soup = BeautifulSoup(item.content.decode("utf-8"), "html5lib")
-
-                for rt_tag in soup.find_all("rp"):
-                    rt_tag.decompose()
-                for rt_tag in cn_soup.find_all("rp"):
-                    rt_tag.decompose()
-                for rt_tag in soup.find_all("rt"):
-                    rt_tag.decompose()
-                for rt_tag in cn_soup.find_all("rt"):
-                    rt_tag.decompose()
-
-                if item.id == "message.xhtml":
-                    # Find the div that comes after the <span>简介：</span>
-                    for soup_ in [soup, cn_soup]:
-                        intro_div = soup_.find('span', string='简介：')
-                        if intro_div:
-                            intro_div = intro_div.find_next_sibling('div')
-                        else:
-                            continue
-
-                        # Check if the content inside the div doesn't already contain a <p> tag
-                        if not intro_div.find('p'):
-                            # Split the content by <br/> tags
-                            parts = intro_div.decode_contents().split('<br/>')
-                            # Rebuild the content with <p> tags between parts
-                            new_content = ''.join(f'<p>{part}</p><br/>' if part.strip() else '<br/>' for part in parts)
-                            # Update the div's content
-                            intro_div.clear()
-                            intro_div.append(BeautifulSoup(new_content, 'html.parser'))  
-
-                if soup.body.find(["p", "h1", "h2", "h3", "h4", "h5", "h6"]):
-                    # Extract paragraphs and join them with new lines
-                    paragraphs = get_filtered_tags(soup)
-                    paragraphs_ = get_filtered_tags(cn_soup)
-
-                    # Get consecutive paragraphs and titles
-                    jp_text_collection = []
-                    last_p = False
-
-                    img_sets = []
-
-                    for p_tag, p_tag_ in zip(paragraphs, paragraphs_):
-                        if len(p_tag.get_text()) == 0:
-                            continue
-                        if p_tag.name in ["img", "image"]:
-                            img_sets.append((p_tag, p_tag_))
-                        if p_tag.name != "p":
-                            jp_text_collection.append((p_tag.get_text(), p_tag.name, [p_tag], [p_tag_]))
-                            last_p = False
-                        elif last_p:
-                            text, tag, ps, ps_ = jp_text_collection[-1]
-                            ps.append(p_tag)
-                            ps_.append(p_tag_)
-                            jp_text_collection[-1] = (text + '\n' + p_tag.get_text(), tag, ps, ps_)
-                        else:
-                            jp_text_collection.append((p_tag.get_text(), p_tag.name, [p_tag], [p_tag_]))
-                            last_p = True
-
-                    for jp_texts, name, ps, ps_ in jp_text_collection:
-                        locator = ps[0]
-                        if locator.parent is None:
-                            continue
-                        locator_ = ps_[0]
-
-                        # Handle paragraph
-                        if name == "p":
-                            # Modify chapter_text using change function
-                            jp_text_parts = split_string_by_length(jp_texts, config["MAX_LENGTH"])
-
-                            decomposable = len(jp_text_parts) > 0
-                            for jp_text in jp_text_parts:
-
-                                # Remove images
-                                img_pattern = re.compile(r'<img[^>]+>')
-                                imgs = img_pattern.findall(jp_text)
-                                jp_text = img_pattern.sub('', jp_text)
-                                jp_text = concat_kanji_rubi(jp_text)
-
-                                # Remove first line if contain title and 作
-                                first_line = jp_text.strip().split("\n")[0].strip()
-                                if "作" in first_line and re.sub(
-                                    r"\s", "", config["JP_TITLE"]
-                                ) in re.sub(r"\s", "", first_line):
-                                    jp_text = jp_text.replace(first_line + '\n', '')
-
-                                if len(jp_text.strip()) == 0:
-                                    cn_text = ""
-                                    decomposable = False
-                                elif (not has_kana(jp_text) and not has_chinese(jp_text)):
-                                    cn_text = jp_text
-                                    decomposable = True
-                                elif (
-                                    jp_text in buffer
-                                    and validate(
-                                        jp_text, buffer[jp_text], name_convention
-                                    )
-                                    and all(
-                                        [item not in jp_text for item in change_list]
-                                    )
-                                ):
-                                    decomposable = True
-                                    cn_text = buffer[jp_text]
-                                else:
-                                    decomposable = True
-                                    ### Start translation
-                                    context = []
-                                    for pj, pc in zip(prev_jp_text, prev_cn_text):
-                                        context += [
-                                            {"role": "user", 
-                                             "content": sakura_prompt(pj, name_convention, mode="soft")},
-                                            {"role": "bot", "content": pc},
-                                        ]
-                                    if context == []:
-                                        context = None
-                                    cn_text = translate(
-                                        jp_text,
-                                        dryrun=args.dryrun,
-                                        context=context,
-                                        skip_name_valid=False
-                                    )
-                                    cn_text = gemini_fix(cn_text)
-                                    cn_text = post_translate(cn_text)
-                                    ### Translation finished
-
-                                    cn_text = remove_duplicate(cn_text)
-                                    if not args.dryrun:
-                                        buffer[jp_text] = cn_text
-
-                                cn_text = postprocessing(cn_text, verbose=not args.dryrun)
-                                prev_jp_text.append(jp_text)
-                                prev_cn_text.append(cn_text)
-                                if len(prev_jp_text) > config["CONTEXT_LEN"]:
-                                    prev_jp_text.pop(0)
-                                    prev_cn_text.pop(0)
-
-                                jp_text = txt_to_html(jp_text)
-                                cn_text = txt_to_html(cn_text)
-
-                                jp_element = BeautifulSoup(jp_text, "html5lib").find()
-                                cn_element = BeautifulSoup(cn_text, "html5lib").find()
-
-                                locator.insert_before(jp_element)
-                                if decomposable:
-                                    locator.insert_before(sep())
-                                locator.insert_before(cn_element)
-                                if decomposable:
-                                    locator.insert_before(sep())
-
-                                cn_element_ = BeautifulSoup(cn_text, "html5lib").find()
-                                locator_.insert_before(cn_element_)
-
-                                for img in imgs:
-                                    img = BeautifulSoup(img, "html5lib")
-                                    cn_element.insert_before(img)
-                                    cn_element_.insert_before(img)
-
-                            # Removing all <p> elements within the <body> tag
-                            if decomposable:
-                                for p_tag in ps_ + ps:  # Combining the lists for simplicity
-                                    imgs = p_tag.find_all("img")
-                                    if not imgs:  # If there are no <img> tags, decompose the <p> tag
-                                        p_tag.decompose()
-
-                        # Handle images
-                        elif name in ["img", "image"]:
-                            # Do nothing
-                            pass
-
-                        # Handle titles
-                        else:
-                            decomposable = True
-
-                            jp_title = jp_texts
-                            if len(jp_title.strip()) == 0:
-                                cn_title = ""
-                                decomposable = False
-                            elif jp_title in title_buffer and validate(jp_title, title_buffer[jp_title], None):
-                                cn_title = title_buffer[jp_title]
-                            elif not has_kana(jp_title) or "作者" in jp_title:
-                                cn_title = jp_title
-                            else:
-                                ### Start translation
-                                cn_title = translate(jp_title, dryrun=args.dryrun, skip_name_valid=True)
-                                ### Translation finished
-                                title_buffer[jp_title] = cn_title
-
-                            cn_title = postprocessing(cn_title)
-                            jp_title = txt_to_html(jp_title, tag=name)
-                            cn_title = txt_to_html(cn_title, tag=name)
-
-                            jp_element = BeautifulSoup(jp_title, "html5lib").find()
-                            cn_element = BeautifulSoup(cn_title, "html5lib").find()
-                            locator.insert_before(jp_element)
-                            locator.insert_before(BeautifulSoup("<br/>", "html5lib").find())
-                            locator.insert_before(cn_element)
-
-                            cn_element_ = BeautifulSoup(cn_title, "html5lib").find()
-                            locator_.insert_before(cn_element_)
-
-                            if decomposable:
-                                for p_tag in ps_ + ps:  # Combining the lists for simplicity
-                                    p_tag.decompose()
-                else:
-                    for s in [soup, cn_soup]:
-                        # Now, check for SVG parent and alter if necessary
-                        for svg in s.find_all("svg"):
-                            parent = svg.parent
-                            position_in_parent = parent.contents.index(svg)
-                            svg.extract()
-                            for image in svg.find_all("image"):
-                                new_img = soup.new_tag("img")  # Create a new <img> tag
-                                if 'width' in image.attrs:
-                                    new_img['width'] = "100%"
-                                if 'height' in image.attrs:
-                                    new_img['height'] = "auto"
-                                if 'xlink:href' in image.attrs:
-                                    new_img['src'] = image['xlink:href']
-                                image.replace_with(new_img)
-
-                            # Reinsert the contents of the original SVG in their original position
-                            for content in reversed(svg.contents):
-                                if isinstance(content, str) and not content.strip():
-                                    # Skip adding empty strings that might have been just whitespace
-                                    continue
-                                parent.insert(position_in_parent, content)
-
-                update_content(item, modified_book, title_buffer, soup)
-                update_content(item, cn_book, title_buffer, cn_soup)
-
-            ### Handle TOC and Ncx updates
-            elif isinstance(item, epub.EpubNcx) or \
-            (isinstance(item, epub.EpubHtml) and ("TOC" in item.id or "toc" in item.id)):
-
-                # Update titles to CN titles or CN+JP titles in TOC
-                content = item.content.decode("utf-8")
-                cn_content = deepcopy(content)
-                jp_titles.sort(key=lambda x: len(x), reverse=True)
-                for jp_title in jp_titles:
-                    if jp_title in title_buffer:
-                        cn_title = title_buffer[jp_title]
-                        content = content.replace(jp_title, cn_title)
-                        cn_content = cn_content.replace(jp_title, cn_title)
-
-                update_content(item, modified_book, title_buffer, content)
-                update_content(item, cn_book, title_buffer, cn_content)
-
-            else:
-                # Copy other items
-                modified_book.items.append(item)
-                cn_book.items.append(item)
+        ############ Extract, translate and assemble the chapters ############
+        if args.dryrun:
+            chapter_cache = None
+        if not args.dryrun:
+            # Before reusing chapters, the ones built from the deleted translations are dropped
+            invalidate_stale_glossary(buffer)
+        reused = {}
+        if chapter_cache is not None and not args.rebuild:
+            reused = load_reusable_chapters(book, chapter_cache, title_buffer)
+        segments, contexts = extract_book(book, reused)
+        if config.get('CACHE_PRELOAD_MB', 256):
+            buffer.preload((segment.jp_text for segment in segments if segment.kind == "p"),
+                           max_mb=config.get('CACHE_PRELOAD_MB', 256))
+        if args.concurrency > 1 and not args.dryrun:
+            prefetch_translations(segments, buffer, args.concurrency, independent=args.independent)
+        finished = translate_book(segments, buffer, title_buffer, dryrun=args.dryrun, contexts=contexts)
+        assemble_book(book, segments, title_buffer, jp_titles, modified_book, cn_book,
+                      chapter_cache=chapter_cache, reused=reused, finished=finished)
+        log_health()
+        ledger.log_report()
 
     # Save EPUB output
     namespace = 'http://purl.org/dc/elements/1.1/'
@@ -1,28 +1,122 @@
 from ebooklib import epub
 from bs4 import BeautifulSoup
+from dataclasses import dataclass, field
+from lxml import etree
+import copy
 import re
 from tqdm import tqdm
 from utils import split_string_by_length, load_config, concat_kanji_rubi, get_filtered_tags
 
 
-def clean_html_content(html_content, config):
+@dataclass
+class Segment:
+    """
+    Intermediate representation of one translatable unit of a chapter.
+
+    Attributes:
+        item_id (str): Id of the EPUB item the segment belongs to
+        kind (str): Tag name of the text group, "p" for merged paragraphs, otherwise a title-like tag
+        locator (int): Index of the text group in `extract_paragraphs` of the item
+        part (int): Index of the part after splitting a paragraph group by MAX_LENGTH
+        jp_text (str): Japanese text to translate
+        imgs (list): <img> tags stripped from the text
+        title_removed (bool): Whether a leading "title + 作" line was removed from the text
+        cn_text (str): Translation, filled by the translation pass
+    """
+    item_id: str
+    kind: str
+    locator: int
+    part: int
+    jp_text: str
+    imgs: list = field(default_factory=list)
+    title_removed: bool = False
+    cn_text: str = None
+
+
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr",
+}
+
+
+def parse_xhtml(html_content):
+    """
+    Parse the XHTML of an EPUB item with lxml, or with the much slower html5lib when it is not
+    well-formed XML.
+
+    The text of the segments must not change with the parser, since the translation buffer is keyed
+    by it: unlike lxml's HTML parser, its XML parser keeps every text node as html5lib does.
+
+    Args:
+        html_content (str): XHTML content
+
+    Returns:
+        BeautifulSoup: Parsed document
+    """
+    try:
+        etree.fromstring(html_content.encode("utf-8"))
+    except (etree.XMLSyntaxError, ValueError):
+        return BeautifulSoup(html_content, "html5lib")
+    # Keep whitespace-only strings as they are, as html5lib does, instead of collapsing them
+    soup = BeautifulSoup(html_content, "lxml-xml", preserve_whitespace_tags={BeautifulSoup.ROOT_TAG_NAME})
+    # Serialize empty elements as HTML does, the output is parsed again as HTML by ebooklib
+    for tag in soup.find_all(True):
+        tag.can_be_empty_element = tag.name in VOID_ELEMENTS
+    return soup
+
+
+def clone_soup(soup):
+    """
+    Copy a parsed document tag by tag, without serializing and parsing it again.
+
+    Args:
+        soup (BeautifulSoup): Parsed document
+
+    Returns:
+        tuple: The copy, and a dict mapping the id() of every tag of `soup` to its copy
+    """
+    # html5lib would add an <html> skeleton to an empty document
+    clone = BeautifulSoup("", "lxml-xml" if soup.is_xml else "html.parser")
+    for child in soup.contents:
+        clone.append(copy.copy(child))
+    tags = {id(tag): tag_ for tag, tag_ in zip(soup.find_all(True), clone.find_all(True))}
+    return clone, tags
+
+
+def clean_html_content(html_content, config, item_id=None):
     """
     Clean and process HTML content by removing specific tags and extracting text.
     
     Args:
         html_content (str): HTML content to process
         config (dict): Configuration dictionary
+        item_id (str): Id of the EPUB item, enables item-specific fixes
         
     Returns:
         BeautifulSoup: Cleaned soup object
     """
-    soup = BeautifulSoup(html_content, "html5lib")
+    soup = parse_xhtml(html_content)
     
     # Remove ruby annotations
     for rt_tag in soup.find_all("rp"):
         rt_tag.decompose()
     for rt_tag in soup.find_all("rt"):
         rt_tag.decompose()
+
+    if item_id == "message.xhtml":
+        # Find the div that comes after the <span>简介：</span>
+        intro_div = soup.find('span', string='简介：')
+        if intro_div:
+            intro_div = intro_div.find_next_sibling('div')
+
+        # Check if the content inside the div doesn't already contain a <p> tag
+        if intro_div and not intro_div.find('p'):
+            # Split the content by <br/> tags
+            parts = intro_div.decode_contents().split('<br/>')
+            # Rebuild the content with <p> tags between parts
+            new_content = ''.join(f'<p>{part}</p><br/>' if part.strip() else '<br/>' for part in parts)
+            # Update the div's content
+            intro_div.clear()
+            intro_div.append(BeautifulSoup(new_content, 'html.parser'))
         
     return soup
 
@@ -35,7 +129,7 @@ def extract_paragraphs(soup):
         soup (BeautifulSoup): Parsed HTML
         
     Returns:
-        list: Collection of text segments with their tag information
+        list: Collection of (text, tag_name, tags) groups, consecutive paragraphs are merged into one group
     """
     if not soup.body.find(["p", "h1", "h2", "h3", "h4", "h5", "h6"]):
         return []
@@ -50,24 +144,56 @@ def extract_paragraphs(soup):
         if len(p_tag.get_text()) == 0:
             continue
         if p_tag.name != "p":
-            text_collection.append((p_tag.get_text(), p_tag.name))
+            text_collection.append((p_tag.get_text(), p_tag.name, [p_tag]))
             last_p = False
         elif last_p:
-            text, tag = text_collection[-1]
-            text_collection[-1] = (text + '\n' + p_tag.get_text(), tag)
+            text, tag, tags = text_collection[-1]
+            tags.append(p_tag)
+            text_collection[-1] = (text + '\n' + p_tag.get_text(), tag, tags)
         else:
-            text_collection.append((p_tag.get_text(), p_tag.name))
+            text_collection.append((p_tag.get_text(), p_tag.name, [p_tag]))
             last_p = True
             
     return text_collection
 
 
+def split_paragraphs(text, config):
+    """
+    Split a paragraph group into parts ready for translation.
+    
+    Args:
+        text (str): Text of a paragraph group
+        config (dict): Configuration dictionary
+        
+    Returns:
+        list: (text, imgs, title_removed) tuples, one per part
+    """
+    parts = []
+    for part in split_string_by_length(text, config["MAX_LENGTH"]):
+        # Remove images
+        img_pattern = re.compile(r'<img[^>]+>')
+        imgs = img_pattern.findall(part)
+        cleaned_text = img_pattern.sub('', part)
+        cleaned_text = concat_kanji_rubi(cleaned_text)
+        
+        # Remove first line if it contains title and 作
+        title_removed = False
+        first_line = cleaned_text.strip().split("\n")[0].strip()
+        jp_title_clean = re.sub(r"\s", "", config["JP_TITLE"])
+        if "作" in first_line and jp_title_clean in re.sub(r"\s", "", first_line):
+            title_removed = first_line + '\n' in cleaned_text
+            cleaned_text = cleaned_text.replace(first_line + '\n', '')
+
+        parts.append((cleaned_text, imgs, title_removed))
+    return parts
+
+
 def process_text_segments(text_collection, config):
     """
     Process text segments, clean them and prepare for translation.
     
     Args:
-        text_collection (list): List of (text, tag_name) tuples
+        text_collection (list): List of (text, tag_name, ...) tuples
         config (dict): Configuration dictionary
         
     Returns:
@@ -75,46 +201,67 @@ def process_text_segments(text_collection, config):
     """
     processed_segments = []
     
-    for text, tag_name in text_collection:
+    for text, tag_name, *_ in text_collection:
         # Currently only processing paragraph tags
         if tag_name == "p":
-            # Split long text
-            text_parts = split_string_by_length(text, config["MAX_LENGTH"])
-            
-            for part in text_parts:
-                # Remove images
-                img_pattern = re.compile(r'<img[^>]+>')
-                cleaned_text = img_pattern.sub('', part)
-                cleaned_text = concat_kanji_rubi(cleaned_text)
-                
-                # Remove first line if it contains title and 作
-                lines = cleaned_text.strip().split("\n")
-                if lines:
-                    first_line = lines[0].strip()
-                    jp_title_clean = re.sub(r"\s", "", config["JP_TITLE"])
-                    if "作" in first_line and jp_title_clean in re.sub(r"\s", "", first_line):
-                        cleaned_text = cleaned_text.replace(first_line + '\n', '')
-
+            for cleaned_text, _, _ in split_paragraphs(text, config):
                 if len(cleaned_text.strip()) != 0:
                     processed_segments.append(cleaned_text)
     
     return processed_segments
 
 
-def process_html_content(html_content, config):
+def extract_segments(item_id, soup, config):
+    """
+    Extract the segments of a cleaned chapter soup.
+
+    Groups that the assembly pass will never reach, because an earlier group replaces one of their
+    ancestors, produce no segments. Empty paragraph parts are kept since they still shape the output.
+    
+    Args:
+        item_id (str): Id of the EPUB item
+        soup (BeautifulSoup): Soup returned by `clean_html_content`
+        config (dict): Configuration dictionary
+        
+    Returns:
+        list: Segments in document order
+    """
+    segments = []
+    removed = set()
+    for locator, (text, tag_name, tags) in enumerate(extract_paragraphs(soup)):
+        if any(id(tag) in removed for tag in [tags[0], *tags[0].parents]):
+            continue
+
+        if tag_name == "p":
+            parts = split_paragraphs(text, config)
+            for part, (cleaned_text, imgs, title_removed) in enumerate(parts):
+                segments.append(Segment(item_id, tag_name, locator, part, cleaned_text, imgs, title_removed))
+            # Paragraphs are replaced unless the last part is empty, the ones holding images are kept
+            if parts and len(parts[-1][0].strip()) > 0:
+                removed.update(id(tag) for tag in tags if not tag.find_all("img"))
+        else:
+            segments.append(Segment(item_id, tag_name, locator, 0, text))
+            if len(text.strip()) > 0:
+                removed.update(id(tag) for tag in tags)
+
+    return segments
+
+
+def process_html_content(html_content, config, item_id=None):
     """
     Process any HTML content and extract cleaned text segments.
     
     Args:
         html_content (str): HTML content to process
         config (dict): Configuration dictionary
+        item_id (str): Id of the EPUB item
         
     Returns:
         list: Processed text segments
     """
-    soup = clean_html_content(html_content, config)
-    text_collection = extract_paragraphs(soup)
-    return process_text_segments(text_collection, config)
+    soup = clean_html_content(html_content, config, item_id)
+    segments = extract_segments(item_id, soup, config)
+    return [segment.jp_text for segment in segments if segment.kind == "p" and len(segment.jp_text.strip()) != 0]
 
 
 def process_epub_file(book_name, chapterwise=False):
@@ -146,7 +293,7 @@ def process_epub_file(book_name, chapterwise=False):
         ):
 
             html_content = item.content.decode("utf-8")
-            processed_segments = process_html_content(html_content, config)
+            processed_segments = process_html_content(html_content, config, item.id)
 
             if processed_segments:
                 if chapterwise:
@@ -0,0 +1,163 @@
+import time
+import threading
+from collections import deque
+from loguru import logger
+import apichat
+from apichat import create_chat_app
+
+
+PROBE_PROMPT = "将下面的日文文本翻译成中文：こんにちは"
+
+
+class ProviderHealth:
+    """
+    Rolling error rate and latency of one provider, with a circuit breaker on top.
+
+    The breaker opens when the error rate over the last `window` calls reaches `threshold`, or at once
+    on an outage (503). While open, the provider is skipped and a background thread probes it every
+    `cooldown` seconds (doubling up to `max_cooldown`) until it answers again.
+    """
+
+    def __init__(self, name, window=20, latency_window=200, min_calls=5, threshold=0.5, cooldown=60,
+                 max_cooldown=600, probe=None):
+        self.name = name
+        self.outcomes = deque(maxlen=window)
+        self.latencies = deque(maxlen=latency_window)
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe = probe
+        self.state = "closed"
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def percentile(self, q):
+        """Latency within which a fraction `q` of the recent successful calls answered, None without data."""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def latency(self):
+        """Median latency of the recent successful calls, None without data."""
+        return self.percentile(0.5)
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.probe is not None:
+                return False
+            # Without a probe, let real traffic through once the cooldown has passed
+            if self.state == "open" and time.time() - self.opened_at >= self.cooldown:
+                self.state = "half-open"
+            return self.state == "half-open"
+
+    def record_success(self, latency):
+        with self.lock:
+            self.outcomes.append(True)
+            self.latencies.append(latency)
+            if self.state != "closed":
+                self._close()
+
+    def record_failure(self, outage=False):
+        with self.lock:
+            self.outcomes.append(False)
+            if self.state == "half-open" or outage or (
+                len(self.outcomes) >= self.min_calls and self.error_rate() >= self.threshold
+            ):
+                self._open()
+
+    def _open(self):
+        if self.state == "open":
+            return
+        if self.state == "half-open":
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        self.state = "open"
+        self.opened_at = time.time()
+        logger.critical(f"Circuit of {self.name} opened (error rate {self.error_rate():.0%}), "
+                        f"routing to the next provider for {self.cooldown}s")
+        if self.probe is not None:
+            threading.Thread(target=self._probe_loop, daemon=True).start()
+
+    def _close(self):
+        self.state = "closed"
+        self.cooldown = self.base_cooldown
+        self.outcomes.clear()
+        logger.success(f"Circuit of {self.name} closed")
+        with _recovered:
+            _recovered.notify_all()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.cooldown)
+            with self.lock:
+                if self.state == "closed":
+                    return
+                self.state = "half-open"
+            start = time.time()
+            try:
+                ok = bool(self.probe())
+            except Exception as e:
+                logger.debug(f"Probe of {self.name} failed: {e}")
+                ok = False
+            if ok:
+                self.record_success(time.time() - start)
+                return
+            with self.lock:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def summary(self):
+        latency = self.latency()
+        latency = f"{latency:.1f}s" if latency is not None else "n/a"
+        return f"{self.name}: {self.state}, error rate {self.error_rate():.0%}, median latency {latency}"
+
+
+_healths = {}
+_healths_lock = threading.Lock()
+_recovered = threading.Condition()
+
+
+def probe_provider(name, model):
+    """
+    Send a probe request to a provider, bypassing the cassette and the usage ledger, so probes are
+    neither recorded nor billed. While a cassette replays there is no provider to probe.
+    """
+    if apichat.cassette is not None and apichat.cassette.mode == "replay":
+        return None
+    return create_chat_app(name, model)._call(PROBE_PROMPT)
+
+
+def provider_health(name, model):
+    """Return the process-wide health tracker of a translation config entry."""
+    with _healths_lock:
+        if name not in _healths:
+            _healths[name] = ProviderHealth(
+                name,
+                threshold=model.get('breaker_threshold', 0.5),
+                cooldown=model.get('breaker_cooldown', 60),
+                probe=lambda: probe_provider(name, model),
+            )
+        return _healths[name]
+
+
+def wait_for_recovery(healths, timeout=None):
+    """Block until one of the given providers closes its circuit, or the timeout passes."""
+    if timeout is None:
+        timeout = max(health.cooldown for health in healths) + 30
+    with _recovered:
+        _recovered.wait_for(lambda: any(health.state == "closed" for health in healths), timeout=timeout)
+
+
+def log_health():
+    for health in _healths.values():
+        logger.info(health.summary())
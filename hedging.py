@@ -0,0 +1,101 @@
+import time
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable
+from loguru import logger
+
+
+@dataclass
+class Attempt:
+    """One provider a hedged request may be sent to."""
+    name: str
+    call: Callable  # call() -> result, raises on failure
+    cancel: Callable  # cancel(), asks a running call to give up
+    deadline: float  # Seconds to wait for this attempt before starting the next one
+
+
+def hedge_deadline(health, percentile=0.95, min_samples=10, default=60):
+    """
+    Return how long to wait for a provider before hedging, from its latency histogram.
+
+    Args:
+        health (ProviderHealth): Health tracker of the provider
+        percentile (float): Latency percentile used as the deadline
+        min_samples (int): Successful calls needed before the histogram is trusted
+        default (float): Deadline used until then
+
+    Returns:
+        float: Deadline in seconds
+    """
+    if len(health.latencies) < min_samples:
+        return default
+    return health.percentile(percentile)
+
+
+def hedged_request(attempts, accept):
+    """
+    Send one request to several providers, starting the next one only when the previous one is late.
+
+    The first attempt starts at once. Whenever the latest attempt has not answered within its deadline,
+    or every attempt in flight has failed or been rejected, the next one starts. The first result
+    accepted wins and the attempts still running are cancelled.
+
+    Args:
+        attempts (list): Attempts in order of preference
+        accept (callable): accept(name, result) -> value, None to reject the result
+
+    Returns:
+        The value accepted first, None if no attempt produced an acceptable result
+    """
+    results = queue.Queue()
+    pending = set()
+    started = 0
+    started_at = None
+
+    def run(index, attempt):
+        try:
+            results.put((index, attempt.call(), None))
+        except Exception as e:
+            results.put((index, None, e))
+
+    def start_next():
+        nonlocal started, started_at
+        threading.Thread(target=run, args=(started, attempts[started]), daemon=True).start()
+        pending.add(started)
+        started += 1
+        started_at = time.time()
+
+    if not attempts:
+        return None
+    start_next()
+    accepted = None
+    while pending:
+        timeout = None
+        if started < len(attempts):
+            timeout = max(0, attempts[started - 1].deadline - (time.time() - started_at))
+        try:
+            index, result, error = results.get(timeout=timeout)
+        except queue.Empty:
+            logger.warning(f"{attempts[started - 1].name} did not answer within {attempts[started - 1].deadline:.1f}s, "
+                           f"hedging with {attempts[started].name}")
+            start_next()
+            continue
+
+        pending.discard(index)
+        name = attempts[index].name
+        if error is not None:
+            logger.warning(f"Hedged request to {name} failed: {error}")
+        else:
+            accepted = accept(name, result)
+            if accepted is not None:
+                if started > 1:
+                    logger.info(f"Hedged request answered by {name}")
+                break
+            logger.warning(f"Hedged request to {name} returned an invalid response")
+        if not pending and started < len(attempts):
+            start_next()
+
+    for index in pending:
+        attempts[index].cancel()
+    return accepted
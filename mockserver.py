@@ -0,0 +1,269 @@
+import re
+import sys
+import json
+import time
+import random
+import signal
+import hashlib
+import argparse
+import threading
+from collections import deque, Counter
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from loguru import logger
+from ratelimit import estimate_tokens
+
+
+# Stand-ins for kana, picked by code point so that a text always gets the same pseudo-translation.
+# Words that validate() reads as a refusal (翻译, 抱歉, ...) cannot be formed from them.
+PSEUDO_CHARS = "的一是了人我在有他这中大来上个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而能好都然"
+REFUSAL = "抱歉，作为一个AI语言模型，我无法翻译这段内容，因为它违反了平台政策与准则。"
+LATENCY_DISTRIBUTIONS = ["fixed", "uniform", "exponential", "lognormal"]
+
+
+@dataclass
+class MockOptions:
+    """How the mock server answers; every probability is per request."""
+    latency: float = 0.2  # Mean seconds before the first token
+    latency_dist: str = "fixed"  # One of LATENCY_DISTRIBUTIONS
+    jitter: float = 0.1  # Half-width of uniform, sigma of lognormal
+    token_latency: float = 0.0  # Seconds per completion token, streamed responses are paced by it
+    rate_limit: float = 0.0  # Probability of a 429
+    unavailable: float = 0.0  # Probability of a 503
+    refusal: float = 0.0  # Probability of a refusal that validate() rejects
+    truncate: float = 0.0  # Probability of losing the second half of the translation
+    rpm: int = None  # Requests per minute above which every request gets a 429
+    seed: int = 0
+
+
+def source_text(message):
+    """Extract the Japanese text from a prompt built by generate_prompt or sakura_prompt."""
+    match = re.search(r"以下是日文原文-*\n\n(.*?)\n\n-*以下是中文翻译", message, re.S)
+    if match:
+        return match.group(1)
+    for marker in ["翻译成中文：\n", "翻译成中文："]:
+        if marker in message:
+            return message.split(marker, 1)[1]
+    return message
+
+
+def glossary_pairs(message):
+    """Read the glossary of a prompt, in the formats of generate_prompt and sakura_prompt."""
+    pairs = re.findall(r"^([^\s\-]+)->(\S+)", message, re.M)
+    pairs += re.findall(r"【([^】]+)】[^\n]*?应翻译为【([^】]+)】", message)
+    pairs += re.findall(r"^(\S+) = (\S+)$", message, re.M)
+    return sorted(set(pairs), key=lambda pair: len(pair[0]), reverse=True)
+
+
+def pseudo_translate(text, glossary=()):
+    """
+    Deterministic stand-in for a translation: glossary names are replaced by their Chinese names and
+    kana by Chinese characters, line by line, so the result has the lines of the source.
+    """
+    lines = []
+    for line in text.split("\n"):
+        for jp_name, cn_name in glossary:
+            line = line.replace(jp_name, cn_name)
+        lines.append(re.sub(r"[ぁ-ヿ]", lambda m: PSEUDO_CHARS[ord(m.group()) % len(PSEUDO_CHARS)], line))
+    return "\n".join(lines)
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    OpenAI-compatible chat completions server answering with pseudo-translations, with injectable
+    latency and failures, as an offline target for OpenAIChatApp (`endpoint: http://host:port/v1`).
+
+    Failures are drawn from a generator seeded with the seed, the message and how many times it was
+    sent, so a run replays the same failures whatever the order of concurrent requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, options=None):
+        super().__init__(address, MockHandler)
+        self.options = options or MockOptions()
+        self.lock = threading.Lock()
+        self.attempts = Counter()  # Digest of a message -> times it was sent
+        self.recent = deque()  # Times of the requests of the last minute, for `rpm`
+        self.stats = Counter()  # Outcome -> requests
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def draw(self, message):
+        """Return the random generator of a request and whether it exceeds `rpm`."""
+        digest = hashlib.sha256(message.encode("utf-8")).hexdigest()
+        now = time.time()
+        with self.lock:
+            self.attempts[digest] += 1
+            attempt = self.attempts[digest]
+            while self.recent and self.recent[0] < now - 60:
+                self.recent.popleft()
+            self.recent.append(now)
+            over_limit = self.options.rpm is not None and len(self.recent) > self.options.rpm
+        return random.Random(f"{self.options.seed}:{digest}:{attempt}"), over_limit
+
+    def count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    def latency(self, rng):
+        options = self.options
+        if options.latency_dist == "uniform":
+            return max(0.0, rng.uniform(options.latency - options.jitter, options.latency + options.jitter))
+        if options.latency_dist == "exponential":
+            return rng.expovariate(1 / options.latency) if options.latency > 0 else 0.0
+        if options.latency_dist == "lognormal":
+            return options.latency * rng.lognormvariate(0, options.jitter)
+        return options.latency
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Outcomes are counted in the server stats instead
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, kind, headers=None):
+        self.send_json(status, {"error": {"message": message, "type": kind, "code": None}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}", "invalid_request_error")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error_json(404, f"Unknown path {self.path}", "invalid_request_error")
+            return
+        try:
+            request = json.loads(body)
+            message = request["messages"][-1]["content"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.send_error_json(400, "Invalid chat completion request", "invalid_request_error")
+            return
+        server = self.server
+        options = server.options
+        rng, over_limit = server.draw(message)
+        time.sleep(server.latency(rng))
+
+        if over_limit or rng.random() < options.rate_limit:
+            server.count("429")
+            self.send_error_json(429, "Rate limit reached for requests", "rate_limit_error", {"Retry-After": "1"})
+            return
+        if rng.random() < options.unavailable:
+            server.count("503")
+            self.send_error_json(503, "The server is overloaded or not ready yet.", "server_error")
+            return
+
+        finish_reason = "stop"
+        if rng.random() < options.refusal:
+            server.count("refusal")
+            content = REFUSAL
+        else:
+            content = pseudo_translate(source_text(message), glossary_pairs(message))
+            if rng.random() < options.truncate:
+                server.count("truncated")
+                lines = content.split("\n")
+                if len(lines) > 1:
+                    content = "\n".join(lines[:len(lines) // 2])
+                else:
+                    content = content[:max(1, len(content) // 2)]
+                finish_reason = "length"
+            else:
+                server.count("ok")
+
+        prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in request["messages"])
+        completion_tokens = estimate_tokens(content)
+        created = int(time.time())
+        model = request.get("model", "mock")
+        if request.get("stream"):
+            self.stream(content, model, created, finish_reason)
+            return
+        time.sleep(options.token_latency * completion_tokens)
+        self.send_json(200, {
+            "id": f"chatcmpl-mock-{created}",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def stream(self, content, model, created, finish_reason):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish=None):
+            chunk = {"id": f"chatcmpl-mock-{created}", "object": "chat.completion.chunk", "created": created,
+                     "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            self.wfile.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for i in range(0, len(content), 20):
+                time.sleep(self.server.options.token_latency * estimate_tokens(content[i:i + 20]))
+                event({"content": content[i:i + 20]})
+            event({}, finish_reason)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client aborted the stream
+            self.server.count("aborted")
+
+
+def start_mock_server(host="127.0.0.1", port=0, options=None):
+    """Serve in a daemon thread, port 0 picks a free port; return the server (see `endpoint`)."""
+    server = MockServer((host, port), options)
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible server returning pseudo-translations")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7999)
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean seconds before answering")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Half-width of uniform, sigma of lognormal")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per completion token")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Probability of a 429")
+    parser.add_argument("--unavailable", type=float, default=0.0, help="Probability of a 503")
+    parser.add_argument("--refusal", type=float, default=0.0, help="Probability of a refusal")
+    parser.add_argument("--truncate", type=float, default=0.0, help="Probability of a truncated translation")
+    parser.add_argument("--rpm", type=int, help="Answer 429 above this many requests per minute")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    options = MockOptions(**{k: v for k, v in vars(args).items() if k not in ("host", "port")})
+    server = MockServer((args.host, args.port), options)
+    logger.info(f"Mock provider listening on {server.endpoint}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Requests by outcome: {dict(server.stats)}")
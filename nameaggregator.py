@@ -5,7 +5,8 @@ from epubparser import main
 from utils import find_example_sentences
 import yaml
 from loguru import logger
-from apichat import GoogleChatApp, PoeAPIChatApp, OpenAIChatApp, AnthropicChatApp, APITranslationFailure
+from apichat import create_chat_app, APITranslationFailure
+from accounting import use_ledger
 from p_tqdm import p_map
 
 
@@ -17,6 +18,9 @@ with open("config/nameaggregator.yaml", "r") as f:
 logger.remove()
 logger.add(f"output/{config['CN_TITLE']}/agg.log", colorize=True, level="DEBUG")
 buffer = SqlWrapper(os.path.join('output', config['CN_TITLE'], 'agg.db'))
+# At import, so that the p_map workers record their calls too
+ledger = use_ledger(os.path.join('output', config['CN_TITLE'], 'usage.db'), book=config['CN_TITLE'],
+                    stage="aggregation")
 
 
 def check_conflicting_tags(tag1, tag2):
@@ -149,17 +153,10 @@ def classify(prompt: str, no_claude=False):
         return buffer[prompt]
         
     for name, model in translation_config.items():
-        if 'Claude' in name:
-            if no_claude:
-                continue
-            api_app = AnthropicChatApp(api_key=model['key'], model_name=model['name'])
-        elif 'Gemini' in name:
-            api_app = GoogleChatApp(api_key=model['key'], model_name=model['name'])
-        elif 'Poe' in name:
-            api_app = PoeAPIChatApp(api_key=model['key'], model_name=model['name'])
-        elif 'OpenAI' in name:
-            api_app = OpenAIChatApp(api_key=model['key'], model_name=model['name'], endpoint=model['endpoint'])
-        else:
+        if 'Claude' in name and no_claude:
+            continue
+        api_app = create_chat_app(name, model)
+        if api_app is None:
             continue
         
         try:
@@ -281,3 +278,4 @@ if __name__ == "__main__":
             f.write(json.dumps(names, ensure_ascii=False, indent=4))
             
         print(len(names))
+    ledger.log_report(by=("provider",))
@@ -1,7 +1,8 @@
 from utils import load_config, SqlWrapper
 from epubparser import main
 import os
-from apichat import GoogleChatApp, PoeAPIChatApp, OpenAIChatApp, APITranslationFailure
+from apichat import create_chat_app, provider_kind, APITranslationFailure
+from accounting import use_ledger
 import yaml
 from loguru import logger
 import json
@@ -17,11 +18,15 @@ with open('resource/namedetect_prompt_3.txt', 'r', encoding='utf-8') as f:
 
 with open("config/nameparser.yaml", "r") as f:
     translation_config = yaml.load(f, Loader=yaml.FullLoader)    
+# Kinds of API the name detection prompt is sent to, other entries of the config (Claude) are skipped
+PROVIDER_KINDS = {"gemini", "poe", "openai"}
     
 config = load_config()
 logger.remove()
 logger.add(f"output/{config['CN_TITLE']}/name.log", colorize=True, level="DEBUG")
 buffer = SqlWrapper(os.path.join('output', config['CN_TITLE'], 'name.db'))
+# At import, so that the p_map workers record their calls too
+ledger = use_ledger(os.path.join('output', config['CN_TITLE'], 'usage.db'), book=config['CN_TITLE'], stage="names")
                 
                 
 def to_json(s):
@@ -52,13 +57,10 @@ def extract(content: str):
         return
         
     for name, model in translation_config.items():
-        if 'Gemini' in name:
-            api_app = GoogleChatApp(api_key=model['key'], model_name=model['name'])
-        elif 'Poe' in name:
-            api_app = PoeAPIChatApp(api_key=model['key'], model_name=model['name'])
-        elif 'OpenAI' in name:
-            api_app = OpenAIChatApp(api_key=model['key'], model_name=model['name'], endpoint=model['endpoint'])
-        else:
+        if provider_kind(name) not in PROVIDER_KINDS:
+            continue
+        api_app = create_chat_app(name, model)
+        if api_app is None:
             continue
         
         try:
@@ -78,3 +80,4 @@ if __name__ == "__main__":
             extract(content)
     else:
         p_map(extract, book_contents, num_cpus=config['NUM_PROCS'])
+    ledger.log_report(by=("provider",))
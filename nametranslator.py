@@ -10,7 +10,8 @@ from utils import (
 import yaml
 import os
 import json
-from apichat import GoogleChatApp, PoeAPIChatApp, OpenAIChatApp, AnthropicChatApp
+from apichat import create_chat_app, GoogleChatApp, PoeAPIChatApp
+from accounting import use_ledger
 from loguru import logger
 import re
 from epubparser import main
@@ -149,6 +150,8 @@ if __name__ == "__main__":
         names = json.loads(f.read())
 
     logger.add(f"output/{config['CN_TITLE']}/name_translate.log", colorize=True, level="DEBUG")
+    ledger = use_ledger(os.path.join('output', config['CN_TITLE'], 'usage.db'), book=config['CN_TITLE'],
+                        stage="name_translation")
 
     # Load previous translations if provided
     previous_translations = {}
@@ -234,38 +237,13 @@ if __name__ == "__main__":
                 msg = add_translated(msg, names, relevant_entries)
                 flag = True
                 for jp_name, model in translation_config.items():
-                    if 'Gemini' in jp_name:
-                        api_app = GoogleChatApp(api_key=model['key'], model_name=model['name'])
-                        api_app.messages = previous_conservation
-                        if previous_conservation[-1]['role'] == 'assistant':
-                            previous_conservation[-1]['role'] = 'bot'
-                    elif 'Poe' in jp_name:
-                        api_app = PoeAPIChatApp(api_key=model['key'], model_name=model['name'])
-                        api_app.messages = previous_conservation
-                        if previous_conservation[-1]['role'] == 'assistant':
-                            previous_conservation[-1]['role'] = 'bot'
-                    elif 'Claude' in jp_name:
-                        api_app = AnthropicChatApp(
-                            api_key=model["key"],
-                            model_name=model["name"],
-                        )
-                        api_app.messages = previous_conservation
-                    elif 'Sakura' in jp_name:
-                        api_app = OpenAIChatApp(
-                            api_key=model["key"],
-                            model_name=model["name"],
-                            endpoint=model["endpoint"],
-                        )
-                        api_app.messages = previous_conservation
-                    elif 'OpenAI' in jp_name:
-                        api_app = OpenAIChatApp(
-                            api_key=model["key"],
-                            model_name=model["name"],
-                            endpoint=model["endpoint"],
-                        )
-                        api_app.messages = previous_conservation
-                    else:
+                    api_app = create_chat_app(jp_name, model)
+                    if api_app is None:
                         continue
+                    api_app.messages = previous_conservation
+                    if isinstance(api_app, (GoogleChatApp, PoeAPIChatApp)) \
+                    and previous_conservation[-1]['role'] == 'assistant':
+                        previous_conservation[-1]['role'] = 'bot'
 
                     retry_count = model['retry_count']
 
@@ -365,3 +343,4 @@ if __name__ == "__main__":
         print(len(names_processed))
         with open(os.path.join('output', config['CN_TITLE'], 'names.json'), "w", encoding="utf-8") as f:
             f.write(json.dumps(names_processed, ensure_ascii=False, indent=4))
+    ledger.log_report(by=("provider",))
@@ -1,5 +1,5 @@
 import json
-from utils import load_config, get_appeared_names
+from utils import load_config, get_appeared_names, Glossary
 from loguru import logger
 import os
 import re
@@ -14,6 +14,8 @@ if os.path.exists(f"output/{config['CN_TITLE']}/names.json"):
         name_convention = names
 else:
     name_convention = {}
+# Glossary of names.json, before the edits of names_updated.json
+base_name_convention = name_convention
 
 
 change_list = set()
@@ -35,6 +37,9 @@ soft_name_convention = {
 }
 
 name_convention.update(soft_name_convention)
+base_name_convention.update(soft_name_convention)
+# Compiled once, shared by prompt building, name validation and honorific fixing
+name_convention = Glossary(name_convention)
 
 
 def generate_prompt(text, mode="translation"):
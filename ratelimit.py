@@ -0,0 +1,143 @@
+import os
+import re
+import time
+import random
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from loguru import logger
+
+
+def estimate_tokens(text):
+    """Rough token count: one token per CJK/kana character, one per four other characters."""
+    if not text:
+        return 0
+    cjk = len(re.findall(r'[　-ヿ一-鿿豈-﫿＀-￯]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter shared by every process on the machine.
+
+    Bucket levels live in a small SQLite database and every acquisition runs in an immediate
+    transaction, so all `p_map` workers (and concurrent runs on other books) draw from one
+    requests-per-minute and tokens-per-minute budget per provider.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or os.path.join(tempfile.gettempdir(), "epubtranslator_ratelimit.db")
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        # Connections are neither shared between threads nor inherited by forked workers
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(provider TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL, blocked_until REAL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _refill(self, bucket, rpm, tpm, burst, now):
+        row = self.conn.execute(
+            "SELECT requests, tokens, updated, blocked_until FROM buckets WHERE provider=?", (bucket,)
+        ).fetchone()
+        request_cap = burst or rpm or 0
+        token_cap = tpm or 0
+        if row is None:
+            return request_cap, token_cap, 0
+        requests, tokens, updated, blocked_until = row
+        elapsed = max(0, now - updated)
+        if rpm:
+            requests = min(request_cap, requests + elapsed * rpm / 60)
+        if tpm:
+            tokens = min(token_cap, tokens + elapsed * tpm / 60)
+        return requests, tokens, blocked_until
+
+    def _try_acquire(self, bucket, rpm, tpm, burst, tokens):
+        """Take one request and `tokens` tokens from the bucket, return the seconds to wait if impossible."""
+        now = time.time()
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            requests, token_level, blocked_until = self._refill(bucket, rpm, tpm, burst, now)
+            # A request larger than the whole budget only waits for a full bucket
+            tokens = min(tokens, tpm) if tpm else 0
+
+            wait = max(0, blocked_until - now)
+            if rpm and requests < 1:
+                wait = max(wait, (1 - requests) * 60 / rpm)
+            if tpm and token_level < tokens:
+                wait = max(wait, (tokens - token_level) * 60 / tpm)
+            if wait == 0:
+                requests -= 1 if rpm else 0
+                token_level -= tokens
+
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                (bucket, requests, token_level, now, blocked_until)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def acquire(self, bucket, rpm=None, tpm=None, burst=None, tokens=0):
+        """Block until the bucket grants one request of `tokens` tokens. Return the seconds waited."""
+        waited = 0
+        while True:
+            wait = self._try_acquire(bucket, rpm, tpm, burst, tokens)
+            if wait == 0:
+                return waited
+            if waited == 0:
+                logger.debug(f"Rate limit of {bucket} reached, waiting {wait:.1f}s")
+            # Jitter keeps waiting workers from waking up at the same instant
+            wait += random.uniform(0, min(wait, 1) * 0.1)
+            time.sleep(wait)
+            waited += wait
+
+    def backoff(self, bucket, seconds):
+        """Block the bucket for every process for `seconds`, after the provider answered 429."""
+        now = time.time()
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, blocked_until FROM buckets WHERE provider=?", (bucket,)).fetchone()
+            tokens, blocked_until = row if row is not None else (0, 0)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                (bucket, 0, tokens, now, max(blocked_until, now + seconds))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.warning(f"{bucket} is rate limited, pausing all workers for {seconds}s")
+
+
+def rate_limit_for(kind, model):
+    """
+    Return the (bucket, rpm, tpm, burst) limits of a translation config entry, None if it is unlimited.
+
+    Buckets are keyed by model and API key, since that is what providers enforce limits on.
+    """
+    rpm = model.get('rpm')
+    tpm = model.get('tpm')
+    burst = model.get('burst')
+    if kind == "gemini" and rpm is None and tpm is None:
+        # One request per second, as GoogleChatApp always throttled itself
+        rpm, burst = 60, 1
+    if rpm is None and tpm is None:
+        return None
+    key_hash = hashlib.sha1(str(model.get('key')).encode()).hexdigest()[:8]
+    return f"{model['name']}:{key_hash}", rpm, tpm, burst
+
+
+limiter = RateLimiter()
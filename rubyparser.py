@@ -1,5 +1,5 @@
 from utils import parse_gpt_json, has_kana, load_config, extract_ruby_from_epub
-from apichat import GoogleChatApp, PoeAPIChatApp
+from apichat import create_chat_app, provider_kind
 import re
 import os
 import json
@@ -11,6 +11,8 @@ config = load_config()
 
 with open("config/rubyparser.yaml", "r") as f:
     translation_config = yaml.load(f, Loader=yaml.FullLoader)    
+# Kinds of API the ruby annotations are sent to, other entries of the config are skipped
+PROVIDER_KINDS = {"gemini", "poe"}
 
 
 def partition_json(input_json, max_length):
@@ -64,11 +66,10 @@ if __name__ == "__main__":
             prompt = ruby_prompt + multi_rubi
             logger.info(f"Prompt: {prompt}")
             for name, model in translation_config.items():
-                if 'Gemini' in name:
-                    api_app = GoogleChatApp(api_key=model['key'], model_name=model['name'])
-                elif 'Poe' in name:
-                    api_app = PoeAPIChatApp(api_key=model['key'], model_name=model['name'])
-                else:
+                if provider_kind(name) not in PROVIDER_KINDS:
+                    continue
+                api_app = create_chat_app(name, model)
+                if api_app is None:
                     continue
                 try: 
                     response = api_app.chat(prompt)
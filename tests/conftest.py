@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules load translation.yaml, .env and resource/ from the working directory at import
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,74 @@
+import time
+import asyncio
+import threading
+import pytest
+from apichat import OpenAIChatApp, ResponseAborted, run_async
+from mockserver import MockOptions, start_mock_server, pseudo_translate
+
+PROMPT = "将下面的日文文本翻译成中文："
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = start_mock_server(options=MockOptions(latency=0.3, jitter=0.0, token_latency=0.002))
+    yield server
+    server.shutdown()
+
+
+def make_app(server, stream=False):
+    app = OpenAIChatApp("EMPTY", "mock", endpoint=server.endpoint)
+    app.stream = stream
+    return app
+
+
+def test_achat_runs_requests_concurrently_on_the_shared_loop(server):
+    apps = [make_app(server) for _ in range(8)]
+    texts = [f"テスト{i}のぶんしょう" for i in range(8)]
+
+    async def translate_all():
+        return await asyncio.gather(*[app.achat(PROMPT + text) for app, text in zip(apps, texts)])
+
+    start = time.time()
+    results = run_async(translate_all())
+    # Eight requests of 0.3s each multiplexed on one loop, 2.4s one after the other
+    assert time.time() - start < 1.8
+    assert results == [pseudo_translate(text) for text in texts]
+    for app, result in zip(apps, results):
+        assert app.messages == [{"role": "assistant", "content": result}]
+        assert app.usage == app.reported_usage and app.usage["completion_tokens"] > 0
+
+
+def test_achat_streams_the_same_answer(server):
+    app = make_app(server, stream=True)
+    text = "あいうえお\nかきくけこ"
+    assert run_async(app.achat(PROMPT + text)) == pseudo_translate(text)
+    # Streamed usage is estimated
+    assert app.reported_usage is None and app.usage["completion_tokens"] > 0
+
+
+def test_achat_guard_aborts_the_stream(server):
+    app = make_app(server, stream=True)
+    checked = []
+
+    def guard(partial):
+        checked.append(len(partial))
+        return "too long" if len(partial) >= 400 else None
+
+    app.guard = guard
+    text = "あ" * 2000
+    start = time.time()
+    with pytest.raises(ResponseAborted) as aborted:
+        run_async(app.achat(PROMPT + text))
+    assert "too long" in str(aborted.value)
+    assert 400 <= len(aborted.value.partial) < len(text)
+    assert aborted.value.partial == pseudo_translate(text)[:len(aborted.value.partial)]
+    assert checked and checked[-1] == len(aborted.value.partial)
+    # The rest of the stream was not waited for
+    assert time.time() - start < 0.3 + 2000 * 0.002 / 2
+
+
+def test_achat_cancel_aborts_the_stream(server):
+    app = make_app(server, stream=True)
+    threading.Timer(0.5, app.cancel).start()
+    with pytest.raises(ResponseAborted, match="cancelled"):
+        run_async(app.achat(PROMPT + "い" * 2000))
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import cachetool
+from cache import AsyncTranslationCache, TranslationCache, text_hash
+from chaptercache import ChapterCache
+
+
+def test_async_cache_concurrent_get_and_set(tmp_path):
+    db_path = str(tmp_path / "buffer.db")
+    with TranslationCache(db_path) as cache:
+        cache.put("既存の文", "已有的句子", provider="a")
+
+    async def writer(cache, n):
+        for i in range(20):
+            await cache.set_many({f"文{n}-{i}-{j}": f"句{n}-{i}-{j}" for j in range(5)}, provider="b")
+            await asyncio.sleep(0)
+
+    async def reader(cache, n):
+        for i in range(20):
+            found = await cache.get_many([f"文{n}-{i}-{j}" for j in range(5)] + ["既存の文"])
+            assert found["既存の文"] == "已有的句子"
+            assert all(value == key.replace("文", "句") for key, value in found.items() if key != "既存の文")
+            await asyncio.sleep(0)
+
+    async def run():
+        async with AsyncTranslationCache(db_path, readers=3, flush_interval=0.05, batch_size=7) as cache:
+            await asyncio.gather(*[writer(cache, n) for n in range(4)], *[reader(cache, n) for n in range(4)])
+            # Stored entries are visible at once, committed or not
+            assert await cache.get("文0-19-4") == "句0-19-4"
+            await cache.flush()
+            found = await cache.get_many([f"文{n}-{i}-{j}" for n in range(4) for i in range(20) for j in range(5)])
+            assert len(found) == 400
+
+    asyncio.run(run())
+    with TranslationCache(db_path) as cache:
+        assert cache["文3-7-2"] == "句3-7-2"
+        assert cache.entry("文3-7-2")["provider"] == "b"
+        assert sum(count for *_, count in cache.stats()) == 401
+
+
+def test_async_cache_close_commits_pending_writes(tmp_path):
+    db_path = str(tmp_path / "buffer.db")
+
+    async def run():
+        cache = AsyncTranslationCache(db_path, flush_interval=60)
+        await cache.set("あ", "啊", provider="a")
+        await cache.close()
+        await cache.close()
+
+    asyncio.run(run())
+    with TranslationCache(db_path) as cache:
+        assert cache["あ"] == "啊"
+
+
+def test_book_title_is_not_a_glossary_edit(tmp_path):
+    import epubloader
+    title = epubloader.config['JP_TITLE']
+    with TranslationCache(str(tmp_path / "buffer.db")) as cache:
+        # Written by a version without the glossary index
+        cache.put(f"{title}の話をした。", "聊了这本书。")
+        epubloader.invalidate_stale_glossary(cache)
+        assert cache.get(f"{title}の話をした。") == "聊了这本书。"
+        # Indexed with the title entry, a later run finds nothing to translate again
+        assert cache.glossary_impact(epubloader.name_convention, epubloader.base_name_convention) == {}
+
+
+def test_merge_and_import_drop_the_chapters_built_from_replaced_translations(tmp_path):
+    book = tmp_path / "book"
+    book.mkdir()
+    target, chapters = str(book / "buffer.db"), str(book / "chapter_cache.db")
+    with TranslationCache(target) as cache:
+        cache.put("一つ目。", "第一句。")
+        cache.put("二つ目。", "第二句。")
+    with ChapterCache(chapters) as chapter_cache:
+        for item_id, source in [("c1", "一つ目。"), ("c2", "二つ目。")]:
+            chapter_cache.put(item_id, "key", "", "", [], [], segments=[text_hash(source)])
+
+    # A more recent translation of the first entry, the same one of the second
+    source = str(tmp_path / "series.db")
+    with TranslationCache(source) as cache:
+        cache.put("一つ目。", "第一个句子。")
+        cache.put("二つ目。", "第二句。")
+    cachetool.merge(target, [source])
+    with ChapterCache(chapters) as chapter_cache:
+        assert "c1" not in chapter_cache.db and "c2" in chapter_cache.db
+
+    export = tmp_path / "buffer.jsonl"
+    export.write_text(json.dumps({"table": "translations", "source": "二つ目。", "translation": "第二个句子。"},
+                                 ensure_ascii=False) + "\n", encoding="utf-8")
+    cachetool.import_jsonl(target, str(export))
+    with ChapterCache(chapters) as chapter_cache:
+        assert "c2" not in chapter_cache.db
+    with TranslationCache(target) as cache:
+        assert cache["一つ目。"] == "第一个句子。" and cache["二つ目。"] == "第二个句子。"
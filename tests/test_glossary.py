@@ -0,0 +1,72 @@
+import random
+import pytest
+from utils import Glossary
+
+
+def baseline_appeared_names(text, name_convention):
+    """get_appeared_names before Glossary: one `in` check per name, cutting each name found out of the text."""
+    appeared_names = {}
+    for jp_name in name_convention.keys():
+        if jp_name in text:
+            appeared_names[jp_name] = name_convention[jp_name]
+            text = text.replace(jp_name, "")
+    return appeared_names
+
+
+def entries(names):
+    return {name: {"cn_name": f"名{i}"} for i, name in enumerate(names)}
+
+
+@pytest.mark.parametrize("names, text", [
+    # Nested names, longest first as prompt.py loads them
+    (["アリスト", "アリス", "リス", "ス"], "アリストとアリスとリスがいた"),
+    # Shorter names first, so they are cut out before the longer ones can match
+    (["アリス", "アリスト"], "アリストテレス"),
+    # Overlapping names: the first one cut out breaks the second
+    (["ルイス", "スミス"], "ルイスミス"),
+    (["スミス", "ルイス"], "ルイスミス"),
+    # Cutting a name out joins its neighbours into a name checked later
+    (["ナナ", "アイ"], "アナナイ"),
+    (["ナナ", "アイ", "ア"], "アナナイア"),
+    (["ナ", "ナナ", "アイウ"], "アナナイナウ"),
+    (["ド", "ルド", "アルド", "アル"], "アルドドドルドドアル"),
+    # Cut out several times, each cut joining other text
+    (["ミ", "ルイス", "ルミイス"], "ルミイミス・ルミイス"),
+    # A joined name ranked before the cut one was already checked, so it is not reported
+    (["アイ", "ナナ"], "アナナイ"),
+    (["", "アイ"], "アイ"),
+    (["アイ"], ""),
+])
+def test_appeared_matches_baseline(names, text):
+    name_convention = entries(names)
+    expected = baseline_appeared_names(text, name_convention)
+    assert list(Glossary(name_convention).appeared(text).items()) == list(expected.items())
+
+
+def test_appeared_matches_baseline_on_random_texts():
+    rng = random.Random(0)
+    for _ in range(300):
+        names = list(dict.fromkeys("".join(rng.choices("アイウ", k=rng.randint(1, 4))) for _ in range(6)))
+        if rng.random() < 0.5:
+            names.sort(key=len, reverse=True)
+        name_convention = entries(names)
+        glossary = Glossary(name_convention)
+        for _ in range(20):
+            text = "".join(rng.choices("アイウエ", k=rng.randint(0, 16)))
+            assert list(glossary.appeared(text).items()) == \
+                list(baseline_appeared_names(text, name_convention).items()), (names, text)
+
+
+def test_appeared_memo_is_bounded_and_follows_edits():
+    glossary = Glossary(entries(["アリス", "ボブ"]))
+    for i in range(1100):
+        text = f"アリス{i}"
+        assert glossary.appeared(text) == baseline_appeared_names(text, glossary)
+        assert len(glossary._appeared) <= 1024
+    # Cached results are copies, and edits of the glossary are seen at once
+    glossary.appeared("アリス1099").clear()
+    assert "アリス" in glossary.appeared("アリス1099")
+    glossary["1099"] = {"cn_name": "数"}
+    assert glossary.appeared("アリス1099") == baseline_appeared_names("アリス1099", glossary)
+    del glossary["アリス"]
+    assert glossary.appeared("アリス1099") == {"1099": {"cn_name": "数"}}
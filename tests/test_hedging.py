@@ -0,0 +1,125 @@
+import time
+import threading
+from hedging import Attempt, hedged_request, hedge_deadline
+from health import ProviderHealth
+from apichat import OpenAIChatApp, ResponseAborted
+from mockserver import MockOptions, start_mock_server
+
+
+class FakeProvider:
+    """A provider answering `result` after `delay` seconds, or raising, unless cancelled first."""
+
+    def __init__(self, name, delay, result=None, error=None, deadline=0.1):
+        self.name = name
+        self.delay = delay
+        self.result = result if result is not None else f"{name} result"
+        self.error = error
+        self.deadline = deadline
+        self.started = None
+        self.cancelled = threading.Event()
+
+    def call(self):
+        self.started = time.time()
+        if self.cancelled.wait(self.delay):
+            raise RuntimeError("cancelled")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def attempt(self):
+        return Attempt(self.name, self.call, self.cancelled.set, self.deadline)
+
+
+def hedge(providers, accept=lambda name, result: result):
+    start = time.time()
+    return hedged_request([provider.attempt() for provider in providers], accept), start
+
+
+def test_fast_answer_is_not_hedged():
+    first, second = FakeProvider("a", 0.01), FakeProvider("b", 0.01)
+    assert hedge([first, second])[0] == "a result"
+    time.sleep(0.15)
+    assert second.started is None
+    assert not first.cancelled.is_set()
+
+
+def test_late_answer_is_hedged_after_the_deadline_and_the_loser_cancelled():
+    first, second = FakeProvider("a", 5, deadline=0.2), FakeProvider("b", 0.05)
+    result, start = hedge([first, second])
+    assert result == "b result"
+    assert 0.2 <= second.started - start < 0.3
+    assert first.cancelled.is_set() and not second.cancelled.is_set()
+
+
+def test_hedged_provider_may_still_lose_to_the_first_one():
+    first, second = FakeProvider("a", 0.2, deadline=0.1), FakeProvider("b", 5)
+    result, start = hedge([first, second])
+    assert result == "a result"
+    assert time.time() - start < 1
+    assert second.started is not None and second.cancelled.is_set()
+
+
+def test_failure_or_rejection_starts_the_next_attempt_at_once():
+    first = FakeProvider("a", 0.01, error=RuntimeError("503"), deadline=10)
+    second = FakeProvider("b", 0.01, result="invalid", deadline=10)
+    third = FakeProvider("c", 0.01)
+    result, start = hedge([first, second, third], accept=lambda name, result: None if result == "invalid" else result)
+    assert result == "c result"
+    assert time.time() - start < 1
+
+
+def test_every_attempt_failing_returns_none():
+    providers = [FakeProvider(name, 0.01, error=RuntimeError("503")) for name in "abc"]
+    assert hedge(providers)[0] is None
+    assert all(provider.started is not None for provider in providers)
+    assert hedged_request([], lambda name, result: result) is None
+
+
+def test_last_attempt_has_no_deadline():
+    first, second = FakeProvider("a", 0.3, deadline=0.05), FakeProvider("b", 0.5, deadline=0.05)
+    result, start = hedge([first, second])
+    assert result == "a result"
+    assert time.time() - start >= 0.3
+
+
+def test_hedge_deadline_follows_the_latency_percentile():
+    health = ProviderHealth("a")
+    for latency in range(1, 10):
+        health.record_success(latency)
+    assert hedge_deadline(health, default=60) == 60
+    health.record_success(10)
+    assert hedge_deadline(health, percentile=0.95) == 10
+    assert hedge_deadline(health, percentile=0.5) == 6
+
+
+def test_streamed_loser_stops_generating_once_cancelled():
+    server = start_mock_server(options=MockOptions(latency=0.0, token_latency=0.002))
+    try:
+        app = OpenAIChatApp("EMPTY", "mock", endpoint=server.endpoint)
+        app.stream = True
+        finished = {}
+
+        def slow_call():
+            try:
+                # About 4s to stream in full
+                return app.chat("将下面的日文文本翻译成中文：" + "あ" * 2000)
+            except ResponseAborted as e:
+                finished["aborted"] = e.partial
+                raise
+            finally:
+                finished["at"] = time.time()
+
+        fast = FakeProvider("b", 0.01)
+        result = hedged_request([Attempt("a", slow_call, app.cancel, 0.3), fast.attempt()],
+                                lambda name, result: result)
+        returned = time.time()
+        assert result == "b result"
+        for _ in range(50):
+            if "at" in finished:
+                break
+            time.sleep(0.05)
+        # The loser gave up within a chunk or so, instead of streaming the rest
+        assert finished["at"] - returned < 0.5
+        assert 0 < len(finished["aborted"]) < 2000
+    finally:
+        server.shutdown()
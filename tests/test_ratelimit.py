@@ -0,0 +1,71 @@
+import time
+import multiprocessing
+import pytest
+from ratelimit import RateLimiter, estimate_tokens, rate_limit_for
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "ratelimit.db")
+
+
+def acquire_many(db_path, bucket, rpm, burst, count, barrier):
+    limiter = RateLimiter(db_path)
+    barrier.wait()
+    return [limiter.acquire(bucket, rpm=rpm, burst=burst) for _ in range(count)]
+
+
+def run_workers(target, *args, processes=2):
+    """Run `target` in forked workers, as p_map does, and return what each one returned."""
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Manager().Barrier(processes)
+    with ctx.Pool(processes) as pool:
+        return pool.starmap(target, [args + (barrier,)] * processes)
+
+
+def test_burst_then_refill(db_path):
+    limiter = RateLimiter(db_path)
+    start = time.time()
+    waits = [limiter.acquire("m:k", rpm=600, burst=3) for _ in range(5)]
+    # Three at once, then one every 0.1s
+    assert waits[:3] == [0, 0, 0]
+    assert all(wait > 0 for wait in waits[3:])
+    assert 0.15 <= time.time() - start < 1
+
+
+def test_tokens_per_minute(db_path):
+    limiter = RateLimiter(db_path)
+    assert limiter.acquire("m:k", tpm=6000, tokens=100) == 0
+    # 100 tokens are refilled in 1s
+    assert limiter._try_acquire("m:k", None, 6000, None, 6000) == pytest.approx(1, abs=0.1)
+    # A request larger than the budget waits for a full bucket only
+    assert limiter._try_acquire("m:k", None, 6000, None, 10 ** 6) == pytest.approx(1, abs=0.1)
+
+
+def test_burst_is_shared_across_processes(db_path):
+    waits = [wait for waits in run_workers(acquire_many, db_path, "m:k", 60, 2, 2) for wait in waits]
+    # A burst of two between both processes, the other two requests wait for refills of one per second
+    assert waits.count(0) == 2
+    assert sum(waits) > 1.8
+
+
+def test_backoff_blocks_other_processes(db_path):
+    RateLimiter(db_path).backoff("m:k", 1)
+    waits = [wait for waits in run_workers(acquire_many, db_path, "m:k", 6000, None, 1) for wait in waits]
+    assert all(0.9 <= wait < 1.5 for wait in waits)
+    # Other buckets are not blocked
+    assert RateLimiter(db_path).acquire("other:k", rpm=60) == 0
+
+
+def test_rate_limit_for():
+    assert rate_limit_for("openai", {"name": "gpt", "key": "a"}) is None
+    bucket, rpm, tpm, burst = rate_limit_for("gemini", {"name": "gemini-pro", "key": "a"})
+    assert (rpm, tpm, burst) == (60, None, 1)
+    assert bucket != rate_limit_for("gemini", {"name": "gemini-pro", "key": "b"})[0]
+    assert rate_limit_for("openai", {"name": "gpt", "key": "a", "tpm": 1000})[1:] == (None, 1000, None)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("日本語のテキスト") == 8
+    assert estimate_tokens("abcdefgh") == 2
@@ -0,0 +1,76 @@
+import sys
+import signal
+import sqlite3
+import subprocess
+import pytest
+from utils import SqlWrapper
+
+WRITER = """
+import sys, time
+from utils import SqlWrapper
+# Garbage collection at shutdown would close the wrapper too, leave it to the exit hooks
+SqlWrapper.__del__ = lambda self: None
+wrapper = SqlWrapper(sys.argv[1], flush_interval=60, batch_size=1000)
+for i in range(10):
+    wrapper[f"key{i}"] = f"value{i}"
+print("written", flush=True)
+if sys.argv[2] == "wait":
+    time.sleep(60)
+elif sys.argv[2] == "exit":
+    sys.exit(3)
+"""
+
+
+def committed(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return dict(conn.execute("SELECT key, value FROM data"))
+    finally:
+        conn.close()
+
+
+def test_pending_writes_are_visible_and_committed_in_batches(tmp_path):
+    db_path = str(tmp_path / "data.db")
+    with SqlWrapper(db_path, flush_interval=60, batch_size=3) as wrapper:
+        wrapper["a"] = "1"
+        wrapper["b"] = "2"
+        assert wrapper["a"] == "1" and "b" in wrapper and wrapper.get("c") is None
+        assert committed(db_path) == {}
+        wrapper["c"] = "3"
+        assert committed(db_path) == {"a": "1", "b": "2", "c": "3"}
+        wrapper["a"] = "4"
+        wrapper.flush()
+        assert committed(db_path)["a"] == "4"
+        del wrapper["b"]
+        assert "b" not in committed(db_path)
+    assert committed(db_path) == {"a": "4", "c": "3"}
+
+
+def test_writes_are_committed_once_the_interval_passed(tmp_path):
+    db_path = str(tmp_path / "data.db")
+    wrapper = SqlWrapper(db_path, flush_interval=0.1)
+    wrapper["a"] = "1"
+    assert committed(db_path) == {}
+    wrapper.last_flush -= 1
+    wrapper["b"] = "2"
+    assert committed(db_path) == {"a": "1", "b": "2"}
+    wrapper.close()
+    wrapper.close()
+
+
+@pytest.mark.parametrize("how, returncode", [("return", 0), ("exit", 3)])
+def test_pending_writes_are_committed_at_exit(tmp_path, how, returncode):
+    db_path = str(tmp_path / "data.db")
+    process = subprocess.run([sys.executable, "-c", WRITER, db_path, how], capture_output=True, text=True)
+    assert process.returncode == returncode, process.stderr
+    assert committed(db_path) == {f"key{i}": f"value{i}" for i in range(10)}
+
+
+@pytest.mark.parametrize("signum", [signal.SIGTERM, signal.SIGHUP])
+def test_pending_writes_are_committed_on_signal(tmp_path, signum):
+    db_path = str(tmp_path / "data.db")
+    process = subprocess.Popen([sys.executable, "-c", WRITER, db_path, "wait"], stdout=subprocess.PIPE, text=True)
+    assert process.stdout.readline().strip() == "written"
+    process.send_signal(signum)
+    assert process.wait(timeout=30) == 128 + signum
+    assert committed(db_path) == {f"key{i}": f"value{i}" for i in range(10)}
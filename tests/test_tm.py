@@ -0,0 +1,59 @@
+import random
+from tm import TranslationMemory, jaccard, normalize, shingles
+
+ALPHABET = [chr(code) for code in range(0x4E00, 0x4E00 + 500)] + [chr(code) for code in range(0x3041, 0x3097)]
+
+
+def random_line(rng, length=40):
+    return "".join(rng.choices(ALPHABET, k=length))
+
+
+def near_duplicate(rng, line, edits):
+    chars = list(line)
+    for position in rng.sample(range(len(chars)), edits):
+        chars[position] = rng.choice(ALPHABET)
+    return "".join(chars)
+
+
+def test_near_duplicates_are_recalled(tmp_path):
+    rng = random.Random(0)
+    memory = TranslationMemory(str(tmp_path / "tm.db"), book="vol1", threshold=0.7)
+    lines = [random_line(rng) for _ in range(300)]
+    for i, line in enumerate(lines):
+        memory.add(line, f"译文{i}")
+
+    expected, found = 0, 0
+    for i, line in enumerate(lines[:200]):
+        query = near_duplicate(rng, line, edits=rng.choice([1, 2]))
+        # Every stored line as similar as the threshold, by brute force
+        similar = {j for j, other in enumerate(lines) if jaccard(shingles(query), shingles(other)) >= 0.7}
+        matches = memory.lookup(query, limit=10)
+        assert all(match.similarity >= 0.7 and not match.exact for match in matches)
+        expected += len(similar)
+        found += len(similar & {int(match.translation[2:]) for match in matches})
+        if matches:
+            assert matches[0].translation == f"译文{i}" and matches[0].book == "vol1"
+    assert expected >= 200
+    assert found / expected >= 0.95
+
+
+def test_unrelated_lines_are_not_matched(tmp_path):
+    rng = random.Random(1)
+    memory = TranslationMemory(str(tmp_path / "tm.db"))
+    for i in range(200):
+        memory.add(random_line(rng), f"译文{i}")
+    assert all(memory.lookup(random_line(rng)) == [] for _ in range(100))
+
+
+def test_exact_matches_ignore_width_and_whitespace(tmp_path):
+    memory = TranslationMemory(str(tmp_path / "tm.db"), book="vol1")
+    memory.add("「ＡＢＣ」と言った。", "说了“ABC”。")
+    assert normalize("「ABC」 と\n言った。") == normalize("「ＡＢＣ」と言った。")
+    [match] = memory.lookup("「ABC」 と\n言った。")
+    assert match.exact and match.similarity == 1.0 and match.translation == "说了“ABC”。"
+    # Short segments are only matched exactly
+    assert memory.lookup("「ABD」と言った。") == []
+    # Adding the same text again replaces its translation
+    memory.add("「ABC」と言った。", "说了ABC。", book="vol2")
+    assert len(memory) == 1
+    assert memory.lookup("「ＡＢＣ」と言った。")[0].book == "vol2"
@@ -0,0 +1,73 @@
+import pytest
+import epubloader
+from apichat import APITranslationFailure
+
+
+class FailingApp:
+    """A chat app whose every request fails."""
+
+    def __init__(self):
+        self.messages = []
+        self.usage = None
+        self.calls = 0
+
+    def chat(self, prompt):
+        self.calls += 1
+        raise APITranslationFailure("API connection failed after retries.")
+
+
+@pytest.fixture
+def failing(monkeypatch):
+    app = FailingApp()
+    monkeypatch.setattr(epubloader, "translation_config",
+                        {"OpenAI-test": {"type": "api", "name": "mock", "retry_count": 2}})
+    monkeypatch.setattr(epubloader, "create_chat_app", lambda name, model: app)
+    monkeypatch.setitem(epubloader.config, "HEDGING", False)
+    monkeypatch.setitem(epubloader.config, "OUTAGE_ROUNDS", 1)
+    return app
+
+
+def test_exhausted_fallback_chain_raises(failing):
+    meta = {}
+    with pytest.raises(APITranslationFailure):
+        epubloader.translate("テストの文章。", meta=meta)
+    assert failing.calls == 2
+    assert meta == {}
+
+
+def scripted_translate(monkeypatch, answers):
+    """Make translate() answer each source from `answers`, with 10 prompt and 5 completion tokens."""
+    requests = []
+
+    def translate(jp_text, meta=None, **kwargs):
+        requests.append(jp_text)
+        if meta is not None:
+            meta.update(provider="OpenAI-test", model="mock", mode="translation", latency=1.0,
+                        prompt_tokens=10, completion_tokens=5)
+        return answers[jp_text]
+
+    monkeypatch.setattr(epubloader, "translate", translate)
+    monkeypatch.setattr(epubloader, "memory", None)
+    return requests
+
+
+def test_uncached_runs_add_up_their_usage(monkeypatch):
+    requests = scripted_translate(monkeypatch, {"一行目。": "第一行。", "三行目。\n四行目。": "第三行。\n第四行。"})
+    meta = {}
+    cn_text = epubloader.translate_segment("一行目。\n二行目。\n三行目。\n四行目。", meta=meta,
+                                           lines=[None, "第二行。", None, None])
+    assert cn_text == "第一行。\n第二行。\n第三行。\n第四行。"
+    assert requests == ["一行目。", "三行目。\n四行目。"]
+    assert meta == {"provider": "OpenAI-test", "model": "mock", "mode": "translation", "latency": 2.0,
+                    "prompt_tokens": 20, "completion_tokens": 10}
+
+
+def test_run_with_a_wrong_line_count_translates_the_whole_segment(monkeypatch):
+    jp_text = "一行目。\n二行目。\n三行目。"
+    requests = scripted_translate(monkeypatch, {"一行目。\n二行目。": "第一行和第二行。",
+                                                jp_text: "第一行。\n第二行。\n第三行。"})
+    meta = {}
+    cn_text = epubloader.translate_segment(jp_text, meta=meta, lines=[None, None, "第三行。"])
+    assert cn_text == "第一行。\n第二行。\n第三行。"
+    assert requests == ["一行目。\n二行目。", jp_text]
+    assert meta["prompt_tokens"] == 20 and meta["completion_tokens"] == 10
@@ -0,0 +1,192 @@
+import os
+import re
+import time
+import struct
+import hashlib
+import sqlite3
+import argparse
+import threading
+import unicodedata
+from dataclasses import dataclass
+from loguru import logger
+
+
+SHINGLE_SIZE = 3  # Characters per shingle
+NUM_PERM = 32  # MinHash permutations, split into BANDS bands of NUM_PERM // BANDS rows for LSH
+BANDS = 8
+MIN_FUZZY_LEN = 20  # Shorter segments are only matched exactly, near-duplicates of them are noise
+_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % (_PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _PRIME)
+    for i in range(NUM_PERM)
+]
+
+
+def normalize(text):
+    """Fold width variants and drop whitespace, so that reformatted copies of a text compare equal."""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", text))
+
+
+def shingles(text):
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(shingle_set):
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+              for s in shingle_set]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def band_buckets(signature):
+    rows = NUM_PERM // BANDS
+    return [
+        (band, struct.unpack("<q", hashlib.blake2b(
+            struct.pack(f"<{rows}Q", *signature[band * rows:(band + 1) * rows]), digest_size=8
+        ).digest())[0])
+        for band in range(BANDS)
+    ]
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+@dataclass
+class Match:
+    """A segment of the translation memory similar to the one being translated."""
+    source: str
+    translation: str
+    book: str
+    similarity: float  # Jaccard similarity of the character shingles
+    exact: bool  # Equal to the looked up text after normalization
+
+
+class TranslationMemory:
+    """
+    Translated segments of every book of a series, searchable by similarity.
+
+    Segments are indexed by the hash of their normalized text for exact reuse, and by MinHash
+    signatures of their character shingles in LSH bands to find near-duplicates (a changed
+    character, a different segment split) without comparing against every stored segment.
+
+    Args:
+        db_path (str): Path of the memory, shared by all the books of a series
+        book (str): Book the segments added from now on come from
+        threshold (float): Minimum shingle similarity of a near-duplicate
+    """
+
+    def __init__(self, db_path, book=None, threshold=0.7):
+        self.db_path = db_path
+        self.book = book
+        self.threshold = threshold
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        # Lookups run in the translation worker threads, each gets its own connection
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, hash BLOB UNIQUE, source TEXT, "
+                "translation TEXT, book TEXT, created REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, segment INTEGER, "
+                "PRIMARY KEY (band, bucket, segment)) WITHOUT ROWID"
+            )
+            conn.commit()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def add(self, source, translation, book=None):
+        """Remember the translation of a segment, replacing the previous one of the same normalized text."""
+        norm = normalize(source)
+        if not norm:
+            return
+        key = hashlib.sha256(norm.encode("utf-8")).digest()
+        conn = self.conn
+        with conn:
+            row = conn.execute("SELECT id FROM segments WHERE hash=?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE segments SET source=?, translation=?, book=?, created=? WHERE id=?",
+                             (source, translation, book or self.book, time.time(), row[0]))
+                return
+            segment = conn.execute(
+                "INSERT INTO segments (hash, source, translation, book, created) VALUES (?, ?, ?, ?, ?)",
+                (key, source, translation, book or self.book, time.time())
+            ).lastrowid
+            if len(norm) >= MIN_FUZZY_LEN:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO buckets (band, bucket, segment) VALUES (?, ?, ?)",
+                    [(band, bucket, segment) for band, bucket in band_buckets(minhash(shingles(norm)))]
+                )
+
+    def lookup(self, text, limit=3):
+        """
+        Find the stored segments most similar to a text.
+
+        Args:
+            text (str): Segment about to be translated
+            limit (int): Maximum number of matches
+
+        Returns:
+            list: Matches above the threshold, most similar first; an exact match comes alone
+        """
+        norm = normalize(text)
+        if not norm:
+            return []
+        conn = self.conn
+        row = conn.execute(
+            "SELECT source, translation, book FROM segments WHERE hash=?",
+            (hashlib.sha256(norm.encode("utf-8")).digest(),)
+        ).fetchone()
+        if row is not None:
+            return [Match(*row, similarity=1.0, exact=True)]
+        if len(norm) < MIN_FUZZY_LEN:
+            return []
+
+        text_shingles = shingles(norm)
+        candidates = set()
+        for band, bucket in band_buckets(minhash(text_shingles)):
+            candidates.update(segment for segment, in conn.execute(
+                "SELECT segment FROM buckets WHERE band=? AND bucket=?", (band, bucket)
+            ))
+        matches = []
+        for segment in candidates:
+            source, translation, book = conn.execute(
+                "SELECT source, translation, book FROM segments WHERE id=?", (segment,)
+            ).fetchone()
+            similarity = jaccard(text_shingles, shingles(normalize(source)))
+            if similarity >= self.threshold:
+                matches.append(Match(source, translation, book, similarity, exact=False))
+        matches.sort(key=lambda match: match.similarity, reverse=True)
+        return matches[:limit]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill a series translation memory from translated books")
+    parser.add_argument("memory", help="Path of the translation memory, e.g. output/series.tm.db")
+    parser.add_argument("books", nargs="+", help="Book folders in output/, their buffer.db is imported")
+    args = parser.parse_args()
+
+    from cache import TranslationCache
+    from utils import validate
+
+    memory = TranslationMemory(args.memory)
+    for folder in args.books:
+        book = os.path.basename(os.path.normpath(folder))
+        with TranslationCache(os.path.join(folder, "buffer.db")) as buffer:
+            entries = [(source, translation) for source, translation in buffer.items()
+                       if validate(source, translation)]
+        for source, translation in entries:
+            memory.add(source, translation, book=book)
+        logger.info(f"Imported {len(entries)} segments of {book}, {len(memory)} in the translation memory")
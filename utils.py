@@ -13,12 +13,20 @@ import zipfile
 import py7zr
 from py7zr import FILTER_LZMA
 import functools
+import heapq
 from ja_sentence_segmenter.common.pipeline import make_pipeline
 from ja_sentence_segmenter.concatenate.simple_concatenator import concatenate_matching
 from ja_sentence_segmenter.normalize.neologd_normalizer import normalize
 from ja_sentence_segmenter.split.simple_splitter import split_newline, split_punctuation
 import sqlite3
 import json
+import time
+import atexit
+import signal
+import weakref
+import threading
+import zlib
+from collections import deque
 from lxml import etree
 
 
@@ -81,6 +89,29 @@ def txt_to_html(text, tag="p"):
     return "\n".join(html_paragraphs)
 
 
+def txt_to_tags(soup, text, tag="p"):
+    """
+    Build the nodes of `txt_to_html(text, tag)` directly in `soup`.
+
+    Lines containing markup are still parsed, so that it is interpreted the same way.
+    """
+    nodes = []
+    for line in text.strip().split('\n'):
+        line = line.strip()
+        if line == '':
+            continue
+        if nodes:
+            nodes.append(NavigableString("\n"))
+        if '<' in line or '&' in line:
+            body = BeautifulSoup(f"<{tag}>{line}</{tag}>", "html5lib").body
+            nodes += [node.extract() for node in list(body.contents)]
+        else:
+            element = soup.new_tag(tag)
+            element.string = line
+            nodes.append(element)
+    return nodes
+
+
 def split_string_by_length(text, max_length=500):
     parts = []
     count = 0
@@ -435,7 +466,178 @@ def num_failure(input, text, name_convention=None):
     return count
 
 
+def cn_name_forms(cn_name):
+    """
+    Normalize the Chinese name of a glossary entry and list the forms a translation may use.
+
+    Args:
+        cn_name (str or dict): Chinese name, or an entry with a "cn_name" key
+
+    Returns:
+        tuple: (normalized name, list of accepted forms)
+    """
+    if type(cn_name) is dict:
+        cn_name = cn_name["cn_name"]
+    cn_name = cn_name.replace("＝", "=").replace("・", "·").replace(" ", "")
+    alt_forms = [cn_name]
+    if convert_jp_char(cn_name) != cn_name:
+        alt_forms.append(convert_jp_char(cn_name))
+    if len(cn_name) > 3:
+        alt_forms.append(cn_name[:-1])
+    if len(cn_name) > 5:
+        alt_forms.append(cn_name[:-2])
+    return cn_name, alt_forms
+
+
+class Glossary(dict):
+    """
+    Name convention (jp_name -> cn_name or entry dict) compiled for repeated lookups.
+
+    The Japanese names are indexed in an Aho-Corasick automaton, so the names appearing in a text are
+    found in one pass over it instead of one `in` check per entry. The accepted Chinese forms of each
+    entry and the reverse cn_name -> jp_name map are computed once. The index is rebuilt lazily after
+    the dict is modified.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._index = None
+        self._cn_names = None
+        self._forms = {}
+        self._appeared = {}
+
+    def _invalidate(self):
+        self._index = None
+        self._cn_names = None
+        self._forms = {}
+        self._appeared = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._invalidate()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._invalidate()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._invalidate()
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self._invalidate()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._invalidate()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self._invalidate()
+
+    def _build(self):
+        goto, fail, out = [{}], [0], [[]]
+        for jp_name in self:
+            node = 0
+            for char in jp_name:
+                if char not in goto[node]:
+                    goto[node][char] = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    out.append([])
+                node = goto[node][char]
+            if node:
+                out[node].append(jp_name)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                out[child] = out[child] + out[fail[child]]
+        order = {jp_name: i for i, jp_name in enumerate(self)}
+        longest = max(map(len, self), default=0)
+        return goto, fail, out, order, longest
+
+    def _scan(self, text):
+        goto, fail, out = self._index[:3]
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+    def appeared(self, text):
+        """
+        Return the entries whose Japanese name appears in the text, same as `get_appeared_names`.
+
+        Names are taken in dict order (longest first as loaded by prompt.py) and each one found is cut
+        out of the text, so a name inside a longer one that already matched is not reported.
+        """
+        if text in self._appeared:
+            return dict(self._appeared[text])
+        if self._index is None:
+            self._index = self._build()
+        order, longest = self._index[3:]
+        found = self._scan(text)
+        if "" in self:
+            found.add("")
+        candidates = [(order[jp_name], jp_name) for jp_name in found]
+        heapq.heapify(candidates)
+        appeared_names = {}
+        remaining = text
+        while candidates:
+            rank, jp_name = heapq.heappop(candidates)
+            if jp_name not in remaining:
+                continue
+            appeared_names[jp_name] = self[jp_name]
+            if not jp_name:
+                continue
+            parts = remaining.split(jp_name)
+            remaining = "".join(parts)
+            # Cutting a name out joins the text around it, which may form a name checked later
+            position = 0
+            for part in parts[:-1]:
+                position += len(part)
+                window = remaining[max(0, position - longest + 1):position + longest - 1]
+                for joined in self._scan(window) - found:
+                    if order[joined] > rank:
+                        found.add(joined)
+                        heapq.heappush(candidates, (order[joined], joined))
+        if len(self._appeared) >= 1024:
+            self._appeared = {}
+        self._appeared[text] = appeared_names
+        return dict(appeared_names)
+
+    def cn_forms(self, jp_name):
+        """Return `cn_name_forms` of an entry, computed once."""
+        if jp_name not in self._forms:
+            self._forms[jp_name] = cn_name_forms(self[jp_name])
+        return self._forms[jp_name]
+
+    def cn_names(self):
+        """Return the cn_name -> jp_name map of the entries, computed once."""
+        if self._cn_names is None:
+            self._cn_names = {self[jp_name]["cn_name"]: jp_name for jp_name in self}
+        return self._cn_names
+
+
 def get_appeared_names(text, name_convention=None):
+    if isinstance(name_convention, Glossary):
+        return name_convention.appeared(text)
     appeared_names = {}
     for jp_name in name_convention.keys():
         if jp_name in text:
@@ -454,16 +656,10 @@ def validate_name_convention(input, text, name_convention=None):
         for jp_name, cn_name in appeared_names.items():
             if len(jp_name) < 2:
                 continue
-            if type(cn_name) is dict:
-                cn_name = cn_name["cn_name"]
-            cn_name = cn_name.replace("＝", "=").replace("・", "·").replace(" ", "")
-            alt_forms = [cn_name]
-            if convert_jp_char(cn_name) != cn_name:
-                alt_forms.append(convert_jp_char(cn_name))
-            if len(cn_name) > 3:
-                alt_forms.append(cn_name[:-1])
-            if len(cn_name) > 5:
-                alt_forms.append(cn_name[:-2])
+            if isinstance(name_convention, Glossary):
+                cn_name, alt_forms = name_convention.cn_forms(jp_name)
+            else:
+                cn_name, alt_forms = cn_name_forms(cn_name)
             if all(
                 [alt_form not in text for alt_form in alt_forms]
             ):
@@ -473,9 +669,12 @@ def validate_name_convention(input, text, name_convention=None):
 
 
 def convert_san(text, name_convention):
-    cn_names = {name_convention[jp_name]["cn_name"]: jp_name for jp_name in name_convention}
-    for cn_name in cn_names:
-        text = text.replace(f"【{cn_name}】", cn_name)
+    if isinstance(name_convention, Glossary):
+        cn_names = name_convention.cn_names()
+    else:
+        cn_names = {name_convention[jp_name]["cn_name"]: jp_name for jp_name in name_convention}
+    # Unwrap 【cn_name】 in one pass instead of one replace per entry
+    text = re.sub(r"【([^【】]*)】", lambda m: m.group(1) if m.group(1) in cn_names else m.group(0), text)
     
     def replace_san(match):
         before_san = match.group(1)
@@ -511,6 +710,74 @@ def convert_san(text, name_convention):
 
 
 ## Check if the translation is valid
+def check_line(i, line, complete=True):
+    """
+    Look for a refusal or leaked prompt background in one line of a translation.
+
+    Args:
+        i (int): Index of the line in the translation
+        line (str): The line
+        complete (bool): False for the last line of a partial, still streaming translation
+
+    Returns:
+        str: Why the line is rejected, None if it looks fine
+    """
+    if (
+        "】是女性" in line
+        or "】是男性" in line
+        or ("身份有" in line and "别名" in line)
+    ):
+        return "Translation background entered content"
+    if i == 0 and "翻译" in line and ("：" in line or ":" in line):
+        return None
+    if "翻译" in line or "orry" in line or "抱歉" in line or "对不起" in line \
+    or "pologize" in line or "language model" in line or "able" in line or "性描写" in line \
+    or "AU" in line or "policy" in line:
+        score = 0
+        for keyword in ["（", "【", "注", "成人", "敏感", "章节", "冒犯", "翻译",
+                        "Sorry", "sorry", "but", "continue", "chat", "conversation", "story", "generate", "able",
+                        "violate", "violating", "violation", "story", "safety", "policies", "language", "model", 
+                        "中文", "日语", "小说", "露骨", "侵略", "准则", "规定", "性描写", "AI", "不适当", "淫秽",
+                        "平台", "政策", "以下", "日中", "这段内容", "完成你的请求", "版权", "原文", "尽量"]:
+            score += int(keyword in line)
+        # An unfinished line may still grow past 10 characters
+        score += int(complete and len(line) < 10)
+        if score >= 3:
+            return f"Unethical translation detected.: {line}"
+    return None
+
+
+def validate_partial(input, text, min_line_len=100, max_ratio=3):
+    """
+    Incremental version of `validate` for a translation that is still being streamed.
+
+    Only checks that cannot be undone by the rest of the output are run: refusals and leaked
+    background in finished lines (or in an unfinished line of at least `min_line_len` characters),
+    and a runaway generation far longer than the input.
+
+    Returns:
+        str: Why the generation should be aborted, None to let it continue
+    """
+    if contains_tibetan_characters(text):
+        return "Tibetan characters detected."
+    if len(text) > max_ratio * len(input) + 200:
+        return f"Runaway generation: {len(text)}/{len(input)}"
+    lines = text.split("\n")
+    for i, line in enumerate(lines):
+        complete = i < len(lines) - 1
+        if not complete and len(line) < min_line_len:
+            continue
+        reason = check_line(i, line, complete=complete)
+        if reason is not None:
+            return reason
+    return None
+
+
+# Bump whenever validate() or postprocessing() accept or reject translations differently, cached verdicts
+# of older versions are then checked again
+VALIDATOR_VERSION = 1
+
+
 def validate(input, text, name_convention=None):
     lines = text.split("\n")
 
@@ -537,29 +804,10 @@ def validate(input, text, name_convention=None):
         logger.critical("Tibetan characters detected.")
         return False
     for i, line in enumerate(lines):
-        if (
-            "】是女性" in line
-            or "】是男性" in line
-            or ("身份有" in line and "别名" in line)
-        ):
-            logger.critical("Translation background entered content")
+        reason = check_line(i, line)
+        if reason is not None:
+            logger.critical(reason)
             return False
-        if i == 0 and "翻译" in line and ("：" in line or ":" in line):
-            continue
-        if "翻译" in line or "orry" in line or "抱歉" in line or "对不起" in line \
-        or "pologize" in line or "language model" in line or "able" in line or "性描写" in line \
-        or "AU" in line or "policy" in line:
-            score = 0
-            for keyword in ["（", "【", "注", "成人", "敏感", "章节", "冒犯", "翻译",
-                            "Sorry", "sorry", "but", "continue", "chat", "conversation", "story", "generate", "able",
-                            "violate", "violating", "violation", "story", "safety", "policies", "language", "model", 
-                            "中文", "日语", "小说", "露骨", "侵略", "准则", "规定", "性描写", "AI", "不适当", "淫秽",
-                            "平台", "政策", "以下", "日中", "这段内容", "完成你的请求", "版权", "原文", "尽量"]:
-                score += int(keyword in line)
-            score += int(len(line) < 10)
-            if score >= 3:
-                logger.critical(f"Unethical translation detected.: {line}")
-                return False
     if len(text) == 0:
         logger.critical("No translation provided.")
         return False
@@ -702,16 +950,25 @@ def update_content(item, new_book, title_buffer, updated_content):
         if jp_text in title_buffer:
             a_tag.string = title_buffer[jp_text]
         
-    modified_item = deepcopy(item)
-    modified_item.set_content(soup.encode("utf-8"))
-    new_book.items.append(modified_item)
-    
+    content = soup.encode("utf-8")
+    stylesheets = []
     if isinstance(item, epub.EpubHtml):
         links = soup.find_all('link')
         for link in links:
             href = link.attrs['href']
             if href.endswith('css'):
-                modified_item.add_link(href=href, rel='stylesheet', type='text/css')
+                stylesheets.append(href)
+    append_item(item, new_book, content, stylesheets)
+    return content, stylesheets
+
+
+def append_item(item, new_book, content, stylesheets=()):
+    """Add a copy of `item` with the given content and stylesheet links to `new_book`."""
+    modified_item = deepcopy(item)
+    modified_item.set_content(content)
+    new_book.items.append(modified_item)
+    for href in stylesheets:
+        modified_item.add_link(href=href, rel='stylesheet', type='text/css')
 
 
 def zip_folder_7z(folder_path, output_path, password='114514'):
@@ -754,42 +1011,184 @@ def zip_folder_7z(folder_path, output_path, password='114514'):
         archive.set_encrypted_header(True)
 
 
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for caches compressed with zstd
+    zstandard = None
+
+
+def pack_value(value, method="zlib"):
+    """
+    Compress a cached string into a BLOB that `unpack_value` recognizes.
+
+    Args:
+        value (str): Value to compress
+        method (str): "zlib", or "zstd" if the zstandard package is installed
+
+    Returns:
+        bytes: Compression method prefix followed by the compressed UTF-8 text
+    """
+    data = value.encode("utf-8")
+    if method == "zlib":
+        return b"zlib:" + zlib.compress(data, 9)
+    if method == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return b"zstd:" + zstandard.ZstdCompressor(level=19).compress(data)
+    raise ValueError(f"Unknown compression method: {method}")
+
+
+def unpack_value(value):
+    """Return a cached value as text, decompressing it if it was stored by `pack_value`."""
+    if not isinstance(value, bytes):
+        return value
+    if value.startswith(b"zlib:"):
+        return zlib.decompress(value[5:]).decode("utf-8")
+    if value.startswith(b"zstd:"):
+        if zstandard is None:
+            raise ValueError("Reading a zstd-compressed cache needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(value[5:]).decode("utf-8")
+    return value.decode("utf-8")
+
+
+_open_wrappers = weakref.WeakSet()
+
+
+def _flush_open_wrappers():
+    for wrapper in list(_open_wrappers):
+        try:
+            wrapper.flush()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to flush {wrapper.db_path}: {e}")
+
+
+def _exit_on_signal(signum, frame):
+    # Unwind normally so that `with` blocks close their wrappers and atexit flushes the rest
+    raise SystemExit(128 + signum)
+
+
+def _install_signal_handlers():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for signum in (signal.SIGTERM, getattr(signal, "SIGHUP", None)):
+        if signum is not None and signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, _exit_on_signal)
+
+
+atexit.register(_flush_open_wrappers)
+
+
 class SqlWrapper:
-    def __init__(self, db_path):
+    """
+    Dict-like string store backed by a SQLite file shared between processes.
+
+    The database runs in WAL mode with a busy timeout, so concurrent writers wait for each other
+    instead of failing with "database is locked", and commits no longer fsync. Values compressed by
+    cachetool.py are decompressed transparently. Subclasses with
+    another schema override `_create`, `_select`, `_delete`, `items` and `INSERT`.
+
+    Args:
+        db_path (str): Path of the database file
+        flush_interval (float): If set, writes are kept in memory and committed together once this
+            many seconds have passed since the last commit, or `batch_size` writes are pending. Pending
+            writes are also committed on `flush()`, `close()`, at exit and on SIGTERM/SIGHUP.
+        batch_size (int): Maximum number of pending writes with `flush_interval`
+        timeout (float): Seconds to wait for another process holding the write lock
+    """
+
+    INSERT = 'INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)'
+
+    def __init__(self, db_path, flush_interval=None, batch_size=100, timeout=60):
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}  # key -> (row to insert, value)
+        self.last_flush = time.time()
+        self.conn = sqlite3.connect(self.db_path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
         self.cursor = self.conn.cursor()
-        self.cursor.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT)')
+        self._create()
         self.conn.commit()
+        if self.flush_interval is not None:
+            _open_wrappers.add(self)
+            _install_signal_handlers()
+
+    def _create(self):
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _select(self, key):
+        self.cursor.execute('SELECT value FROM data WHERE key=?', (key,))
+        result = self.cursor.fetchone()
+        return unpack_value(result[0]) if result else None
+
+    def _delete(self, key):
+        self.cursor.execute('DELETE FROM data WHERE key=?', (key,))
+
+    def _write(self, key, row, value):
+        """Insert `row` now, or queue it with write-behind. `value` is what reads of `key` return meanwhile."""
+        if self.flush_interval is None:
+            self.cursor.execute(self.INSERT, row)
+            self.conn.commit()
+            return
+        self.pending[key] = (row, value)
+        if len(self.pending) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
     
     def items(self):
+        self.flush()
         self.cursor.execute('SELECT key, value FROM data')
-        return self.cursor.fetchall()
+        return [(key, unpack_value(value)) for key, value in self.cursor.fetchall()]
 
     def __getitem__(self, key):
-        self.cursor.execute('SELECT value FROM data WHERE key=?', (key,))
-        result = self.cursor.fetchone()
-        if result:
-            return result[0]
-        raise KeyError(key)
+        if key in self.pending:
+            return self.pending[key][1]
+        value = self._select(key)
+        if value is None:
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
-        self.cursor.execute('INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)', (key, value))
-        self.conn.commit()
+        self._write(key, (key, value), value)
 
     def __delitem__(self, key):
+        self.flush()
         if key in self:
-            self.cursor.execute('DELETE FROM data WHERE key=?', (key,))
+            self._delete(key)
             self.conn.commit()
         else:
             raise KeyError(key)
 
     def __contains__(self, key):
-        self.cursor.execute('SELECT 1 FROM data WHERE key=?', (key,))
-        return self.cursor.fetchone() is not None
+        return key in self.pending or self._select(key) is not None
+
+    def get(self, key, default=None):
+        if key in self.pending:
+            return self.pending[key][1]
+        value = self._select(key)
+        return default if value is None else value
+
+    def flush(self):
+        """Commit the pending writes in one transaction."""
+        self.last_flush = time.time()
+        if not self.pending or self.conn is None:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            with self.conn:
+                self.conn.executemany(self.INSERT, [row for row, _ in pending.values()])
+        except sqlite3.Error:
+            self.pending = {**pending, **self.pending}
+            raise
 
     def close(self):
+        if getattr(self, "conn", None) is None:
+            return
+        self.flush()
         self.conn.close()
+        self.conn = None
+        _open_wrappers.discard(self)
 
     def __enter__(self):
         return self